@@ -32,6 +32,7 @@ from . import photeq
 from . import processInput
 from . import resetbits
 from . import sky
+from . import sparsecontext
 from . import staticMask
 from . import util
 from . import wcs_functions
@@ -10,6 +10,8 @@ cosmic-rays.
 """
 import os
 import sys
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from stsci.tools import fileutil, teal, logutil
 from . import outputimage
@@ -200,7 +202,8 @@ def buildBlotParamDict(configObj):
                 'blot_sinscl':configObj[blot_name]['blot_sinscl'],
                 'blot_addsky':configObj[blot_name]['blot_addsky'],
                 'blot_skyval':configObj[blot_name]['blot_skyval'],
-                'coeffs':configObj['coeffs']}
+                'coeffs':configObj['coeffs'],
+                'num_cores':configObj.get('num_cores')}
     return paramDict
 
 def _setDefaults(configObj={}):
@@ -251,61 +254,65 @@ def run_blot(imageObjectList,output_wcs,paramDict,wcsmap=wcs_functions.WCSMap):
                  'PyFITS':util.__fits_version__,
                  'Numpy':util.__numpy_version__}
 
-    _hdrlist = []
-
+    # Collect all of the chips to be blotted, each with the median image
+    # it gets blotted from.  The median gets read only once for all of
+    # the images sharing it.
+    medians = {}
+    chips = []
     for img in imageObjectList:
-
+        _insci = _get_median(img, medians)
         for chip in img.returnAllChips(extname=img.scienceExt):
-
-            print('    Blot: creating blotted image: ',chip.outputNames['data'])
-
             #### Check to see what names need to be included here for use in _hdrlist
             chip.outputNames['driz_version'] = _versions['AstroDrizzle']
+            chips.append((img, chip, _insci))
+    del medians
+
+    def blot_chip(args):
+        img, chip, _insci = args
+        print('    Blot: creating blotted image: ',chip.outputNames['data'])
+
+        _outsci = do_blot(_insci, output_wcs,
+               chip.wcs, chip._exptime, coeffs=paramDict['coeffs'],
+               interp=paramDict['blot_interp'], sinscl=paramDict['blot_sinscl'],
+               wcsmap=wcsmap,
+               pixmap_file=None if img.inmemory else chip.outputNames['pixmap'])
+        # Apply sky subtraction and unit conversion to blotted array to
+        # match un-modified input array
+        if paramDict['blot_addsky']:
+            skyval = chip.computedSky
+        else:
+            skyval = paramDict['blot_skyval']
+        _outsci /= chip._conversionFactor
+        if skyval is not None:
+            _outsci += skyval
+            log.info('Applying sky value of %0.6f to blotted image %s'%
+                        (skyval,chip.outputNames['data']))
+        return _outsci
+
+    # The chips get blotted concurrently, as cdriz.tblot does not hold
+    # the GIL with the default C-based mapping, but their blotted images
+    # get written out in order, one at a time.
+    pool_size = util.get_pool_size(paramDict.get('num_cores'), len(chips))
+    if pool_size > 1:
+        print('Blotting {:d} chips using {:d} threads'
+              .format(len(chips), pool_size))
+        pool = ThreadPool(pool_size)
+        results = pool.imap(blot_chip, chips)
+    else:
+        pool = None
+        results = map(blot_chip, chips)
+
+    try:
+        for (img, chip, _insci), _outsci in zip(chips, results):
             outputvals = chip.outputNames.copy()
             outputvals.update(img.outputValues)
             outputvals['blotnx'] = chip.wcs.naxis1
             outputvals['blotny'] = chip.wcs.naxis2
-            _hdrlist.append(outputvals)
+            _hdrlist = [outputvals]
 
             plist = outputvals.copy()
             plist.update(paramDict)
 
-            # PyFITS can be used here as it will always operate on
-            # output from PyDrizzle (which will always be a FITS file)
-            # Open the input science file
-            medianPar = 'outMedian'
-            outMedianObj = img.getOutputName(medianPar)
-            if img.inmemory:
-                outMedian = img.outputNames[medianPar]
-                _fname,_sciextn = fileutil.parseFilename(outMedian)
-                _inimg = outMedianObj
-            else:
-                outMedian = outMedianObj
-                _fname,_sciextn = fileutil.parseFilename(outMedian)
-                _inimg = fileutil.openImage(_fname, memmap=False)
-
-            # Return the PyFITS HDU corresponding to the named extension
-            _scihdu = fileutil.getExtn(_inimg,_sciextn)
-            _insci = _scihdu.data.copy()
-            _inimg.close()
-            del _inimg, _scihdu
-
-            _outsci = do_blot(_insci, output_wcs,
-                   chip.wcs, chip._exptime, coeffs=paramDict['coeffs'],
-                   interp=paramDict['blot_interp'], sinscl=paramDict['blot_sinscl'],
-                   wcsmap=wcsmap)
-            # Apply sky subtraction and unit conversion to blotted array to
-            # match un-modified input array
-            if paramDict['blot_addsky']:
-                skyval = chip.computedSky
-            else:
-                skyval = paramDict['blot_skyval']
-            _outsci /= chip._conversionFactor
-            if skyval is not None:
-                _outsci += skyval
-                log.info('Applying sky value of %0.6f to blotted image %s'%
-                            (skyval,chip.outputNames['data']))
-
             # Write output Numpy objects to a PyFITS file
             # Blotting only occurs from a drizzled SCI extension
             # to a blotted SCI extension...
@@ -319,22 +326,62 @@ def run_blot(imageObjectList,output_wcs,paramDict,wcsmap=wcs_functions.WCSMap):
 
             img.saveVirtualOutputs(outimgs)
             #_buildOutputFits(_outsci,None,plist['outblot'])
-            _hdrlist = []
 
-            del _outsci
+            del _outsci, _outimg
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _get_median(img, medians):
+    """ Return the science array of the median image that the chips of
+    ``img`` get blotted from, read from its file, or taken from memory,
+    only the first time it is needed and kept in ``medians``.
+    """
+    # PyFITS can be used here as it will always operate on
+    # output from PyDrizzle (which will always be a FITS file)
+    # Open the input science file
+    medianPar = 'outMedian'
+    outMedianObj = img.getOutputName(medianPar)
+    if img.inmemory:
+        outMedian = img.outputNames[medianPar]
+    else:
+        outMedian = outMedianObj
+
+    if outMedian in medians:
+        return medians[outMedian]
+
+    _fname,_sciextn = fileutil.parseFilename(outMedian)
+    if img.inmemory:
+        _inimg = outMedianObj
+    else:
+        _inimg = fileutil.openImage(_fname, memmap=False)
+
+    # Return the PyFITS HDU corresponding to the named extension
+    _scihdu = fileutil.getExtn(_inimg,_sciextn)
+    # Copy in native byte order, which cdriz.tblot would otherwise convert
+    # to for every chip, and share it read-only between all of the chips
+    _insci = np.array(_scihdu.data, dtype=np.float32)
+    _insci.flags.writeable = False
+    _inimg.close()
+    del _inimg, _scihdu
 
-        del _outimg
+    medians[outMedian] = _insci
+    return _insci
 
 
 def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
-            interp='poly5', sinscl=1.0, stepsize=10, wcsmap=None):
+            interp='poly5', sinscl=1.0, stepsize=10, wcsmap=None,
+            pixmap_file=None):
     """ Core functionality of performing the 'blot' operation to create a single
         blotted image from a single source image.
         All distortion information is assumed to be included in the WCS specification
         of the 'output' blotted image given in 'blot_wcs'.
 
         This is the simplest interface that can be called for stand-alone
-        use of the blotting function.
+        use of the blotting function.  Only the part of the source image
+        which the blotted image maps onto gets passed on to be resampled.
 
         Parameters
         ----------
@@ -363,6 +410,10 @@ def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
             Custom mapping class to use to provide transformation from
             drizzled to blotted WCS.  Default will be to use
             `drizzlepac.wcs_functions.WCSMap`.
+        pixmap_file
+            Rootname of the sidecar files used to save and re-use the pixel
+            map computed for the default C-based mapping, as done by
+            `drizzlepac.wcs_functions.get_pixel_map`.
 
     """
     _outsci = np.zeros(blot_wcs.array_shape, dtype=np.float32)
@@ -391,11 +442,8 @@ def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
         Use default C mapping function.
         """
         print('Using default C-based coordinate transformation...')
-        mapping = cdriz.DefaultWCSMapping(
-            blot_wcs, source_wcs,
-            blot_wcs.pixel_shape[0], blot_wcs.pixel_shape[1],
-            stepsize
-        )
+        mapping = wcs_functions.get_pixel_map(blot_wcs, source_wcs,
+                                              stepsize, sidecar=pixmap_file)
         pix_ratio = source_wcs.pscale/wcslin.pscale
     else:
         #
@@ -409,6 +457,15 @@ def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
         mapping = wmap.forward
         pix_ratio = source_wcs.pscale/wcslin.pscale
 
+    # Only pass on the part of the source image the blotted image maps
+    # onto, with the interpolation kernel around it
+    bbox = _blot_source_bbox(mapping, _outsci.shape, source.shape, interp)
+    if bbox is not None:
+        x0, x1, y0, y1 = bbox
+        source = np.ascontiguousarray(source[y0:y1, x0:x1], dtype=np.float32)
+        xmin, xmax = x0 + 1, x1
+        ymin, ymax = y0 + 1, y1
+
     t = cdriz.tblot(
         source, _outsci,xmin,xmax,ymin,ymax,
         pix_ratio, kscale, 1.0, 1.0,
@@ -419,6 +476,56 @@ def do_blot(source, source_wcs, blot_wcs, exptime, coeffs = True,
     return _outsci
 
 
+# Number of source pixels, on each side of an interpolated position, which
+# each interpolation method may use, with a pixel to spare.  The other
+# methods (spline3, and sinc and lsinc whose reach depends on sinscl) get
+# the whole source image.
+_INTERP_MARGIN = {'nearest': 2, 'linear': 2, 'poly3': 3, 'poly5': 4}
+
+
+def _blot_source_bbox(mapping, blot_shape, source_shape, interp):
+    """ Return the (0-based) columns ``x0:x1`` and rows ``y0:y1`` of the
+    source image needed to blot an image of shape ``blot_shape`` with
+    ``mapping``, as ``(x0, x1, y0, y1)``: the footprint of the edges of the
+    blotted image padded by the reach of the ``interp`` interpolation.
+    Returns None when all of the source image is needed.
+    """
+    margin = _INTERP_MARGIN.get(interp)
+    if margin is None:
+        return None
+
+    ny, nx = blot_shape
+    xedge = np.arange(1.0, nx + 1.0)
+    yedge = np.arange(1.0, ny + 1.0)
+    xpix = np.concatenate([xedge, np.full_like(yedge, nx),
+                           xedge, np.full_like(yedge, 1.0)])
+    ypix = np.concatenate([np.full_like(xedge, 1.0), yedge,
+                           np.full_like(xedge, ny), yedge])
+    xout, yout = mapping(xpix, ypix)
+    xout = np.asarray(xout)
+    yout = np.asarray(yout)
+    if not (np.all(np.isfinite(xout)) and np.all(np.isfinite(yout))):
+        # Play it safe and blot from the whole source image
+        return None
+
+    sny, snx = source_shape
+    x0 = max(0, int(np.floor(xout.min())) - 1 - margin)
+    x1 = min(snx, int(np.ceil(xout.max())) + margin)
+    y0 = max(0, int(np.floor(yout.min())) - 1 - margin)
+    y1 = min(sny, int(np.ceil(yout.max())) + margin)
+    if x1 == snx:
+        # Positions up to a pixel past the last column get interpolated
+        # from the start of the next row, so keep whole rows
+        x0 = 0
+    if x0 >= x1 or y0 >= y1:
+        # No overlap with the source image at all: keep a single pixel
+        x0, x1, y0, y1 = 0, 1, 0, 1
+    elif x0 == 0 and y0 == 0 and x1 == snx and y1 == sny:
+        return None
+
+    return x0, x1, y0, y1
+
+
 def help(file=None):
     """
     Print out syntax help for running astrodrizzle
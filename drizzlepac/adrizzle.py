@@ -6,12 +6,12 @@ Interfaces to main drizzle functions.
 :License: :doc:`LICENSE`
 
 """
-import sys,os,copy,time
+import sys,os,copy,tempfile,time
 from . import util
 import numpy as np
 from astropy.io import fits
 from stsci.tools import fileutil, logutil, mputil, teal
-from . import outputimage, wcs_functions, processInput, util
+from . import outputimage, wcs_functions, processInput, util, sparsecontext
 import stwcs
 from stwcs import distortion
 
@@ -30,7 +30,8 @@ if util.can_parallel:
 
 __all__ = ['drizzle', 'run', 'drizSeparate', 'drizFinal', 'mergeDQarray',
            'updateInputDQArray', 'buildDrizParamDict', 'interpret_maskval',
-           'run_driz', 'run_driz_img', 'run_driz_chip', 'do_driz',
+           'run_driz', 'run_driz_img', 'run_driz_chip', 'run_driz_tiles',
+           'run_driz_tile', 'run_driz_img_shared', 'do_driz',
            'get_data', 'create_output', 'help', 'getHelpAsString']
 
 
@@ -38,6 +39,10 @@ __taskname__ = "drizzlepac.adrizzle"
 _single_step_num_ = 3
 _final_step_num_ = 7
 
+# Largest size (in bytes) of the output arrays of each tile drizzled
+# out-of-core (final_memmap=True)
+_MEMMAP_TILE_SIZE = 256 * 1024 * 1024
+
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
 time_pre_all = []
@@ -237,7 +242,9 @@ def run(configObj, wcsmap=None):
             wt_scl, wcslin_pscale=wcslin.pscale ,uniqid=uniqid,
             pixfrac=configObj['pixfrac'], kernel=configObj['kernel'],
             fillval=scale_pars['fillval'], stepsize=configObj['stepsize'],
-            wcsmap=None)
+            wcsmap=None,
+            num_threads=util.get_pool_size(configObj.get('num_threads'), None),
+            max_error=configObj.get('max_map_error'))
 
     out_sci_handle,outextn = create_output(configObj['outdata'])
     if not output_exists:
@@ -323,7 +330,8 @@ def run(configObj, wcsmap=None):
 #
 #### Top-level interface from inside MultiDrizzle
 #
-def drizSeparate(imageObjectList,output_wcs,configObj,wcsmap=None,procSteps=None):
+def drizSeparate(imageObjectList,output_wcs,configObj,wcsmap=None,procSteps=None,
+                 pool=None):
     if procSteps is not None:
         procSteps.addStep('Separate Drizzle')
 
@@ -349,8 +357,19 @@ def drizSeparate(imageObjectList,output_wcs,configObj,wcsmap=None,procSteps=None
         # override configObj[build] value with the value of the build parameter
         # this is necessary in order for AstroDrizzle to always have build=False
         # for single-drizzle step when called from the top-level.
-        run_driz(imageObjectList, output_wcs.single_wcs, paramDict, single=True,
-                 build=False, wcsmap=wcsmap)
+        # Images processed on disk get drizzled by the pool of worker
+        # processes of the run, or else by one started only for this step
+        step_pool = None
+        if pool is None:
+            pool = step_pool = util.get_worker_pool(
+                imageObjectList, paramDict['num_cores'],
+                len(imageObjectList))
+        try:
+            run_driz(imageObjectList, output_wcs.single_wcs, paramDict,
+                     single=True, build=False, wcsmap=wcsmap, pool=pool)
+        finally:
+            if step_pool is not None:
+                step_pool.close()
     else:
         log.info('Single drizzle step not performed.')
 
@@ -358,7 +377,8 @@ def drizSeparate(imageObjectList,output_wcs,configObj,wcsmap=None,procSteps=None
         procSteps.endStep('Separate Drizzle')
 
 
-def drizFinal(imageObjectList, output_wcs, configObj,build=None,wcsmap=None,procSteps=None):
+def drizFinal(imageObjectList, output_wcs, configObj,build=None,wcsmap=None,procSteps=None,
+              pool=None):
 
     if procSteps is not None:
         procSteps.addStep('Final Drizzle')
@@ -379,12 +399,13 @@ def drizFinal(imageObjectList, output_wcs, configObj,build=None,wcsmap=None,proc
             build = paramDict['build']
         # Record whether or not intermediate files should be deleted when finished
         paramDict['clean'] = configObj['STATE OF INPUT FILES']['clean']
+        paramDict['num_cores'] = configObj.get('num_cores')
 
         log.info('USER INPUT PARAMETERS for Final Drizzle Step:')
         util.printParams(paramDict, log=log)
 
         run_driz(imageObjectList, output_wcs.final_wcs, paramDict, single=False,
-                 build=build, wcsmap=wcsmap)
+                 build=build, wcsmap=wcsmap, pool=pool)
     else:
         log.info('Final drizzle step not performed.')
 
@@ -442,7 +463,11 @@ def buildDrizParamDict(configObj,single=True):
 
     # Initialize paramDict with global parameter(s)
     paramDict = {'build':configObj['build'],'stepsize':configObj['stepsize'],
-                'coeffs':configObj['coeffs'],'wcskey':configObj['wcskey']}
+                'coeffs':configObj['coeffs'],'wcskey':configObj['wcskey'],
+                'num_threads':configObj.get('num_threads'),
+                'context_type':configObj.get('context_type', 'planes'),
+                'exact_kernel':configObj.get('exact_kernel', False),
+                'max_map_error':configObj.get('max_map_error')}
 
     # build appro
     if single:
@@ -520,7 +545,8 @@ def interpret_maskval(paramDict):
         maskval = float(maskval) # just to be clear and absolutely sure...
     return maskval
 
-def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
+def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None,
+             pool=None):
     """ Perform drizzle operation on input to create output.
     The input parameters originally was a list
     of dictionaries, one for each input, that matches the
@@ -532,6 +558,10 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
     Parameters required for input in paramDict:
         build,single,units,wt_scl,pixfrac,kernel,fillval,
         rot,scale,xsh,ysh,blotnx,blotny,outnx,outny,data
+
+    A `~drizzlepac.util.WorkerPool` can be given as ``pool`` to run the
+    separate drizzle of images processed on disk, or the tiles of the
+    final drizzle, in its workers.
     """
     # Insure that input imageObject is a list
     if not isinstance(imageObjectList, list):
@@ -564,14 +594,27 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
     log.info("Running Drizzle to create output frame with WCS of: ")
     output_wcs.printwcs()
 
-    # Will we be running in parallel?
-    pool_size = util.get_pool_size(paramDict.get('num_cores'), len(imageObjectList))
-    will_parallel = single and pool_size > 1
+    # Will we be running in parallel?  Separate drizzle runs one worker
+    # per input image, while final drizzle runs one worker per tile of
+    # the output frame.
+    if single:
+        num_tasks = len(imageObjectList)
+    else:
+        num_tasks = output_wcs.array_shape[0]
+    pool_size = util.get_pool_size(paramDict.get('num_cores'), num_tasks)
+    will_parallel = pool_size > 1
     if will_parallel:
         log.info('Executing %d parallel workers' % pool_size)
     else:
-        if single: # not yet an option for final drizzle, msg would confuse
-            log.info('Executing serially')
+        log.info('Executing serially')
+
+    # Parallel workers each drizzle with a single thread, otherwise the
+    # drizzle kernel itself may spread each image over several threads
+    if will_parallel:
+        paramDict['num_threads'] = 1
+    else:
+        paramDict['num_threads'] = util.get_pool_size(
+            paramDict.get('num_threads'), None)
 
     # Set parameters for each input and run drizzle on it here.
     #
@@ -597,6 +640,16 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
     if single or imageObjectList[0][1].outputNames['outContext'] in [None,'',' ']:
         _nplanes = 1
 
+    # A compact context image only needs a single scratch plane, which gets
+    # turned into runs of pixels (and cleared) after drizzling each chip
+    sparse = (not single and paramDict.get('context_type') == 'runs' and
+              imageObjectList[0][1].outputNames['outContext'] not in
+              [None,'',' '])
+    ctxruns = None
+    if sparse:
+        _nplanes = 1
+        ctxruns = []
+
     #
     # An image buffer needs to be setup for converting the input
     # arrays (sci and wht) from FITS format to native format
@@ -604,8 +657,23 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
     # This buffer should be reused for each input if possible.
     #
     _outsci = _outwht = _outctx = _hdrlist = None
-    if (not single) or \
-       (single and (not will_parallel) and (not imageObjectList[0].inmemory)):
+    memmap = not single and paramDict.get('memmap', False)
+    tiled = not single and (will_parallel or memmap)
+    if tiled:
+        # Drizzle every tile of the output frame first (in parallel, or one
+        # at a time to bound the memory used by out-of-core drizzling); the
+        # loop below then only takes care of the bookkeeping and writes
+        # out the final product.
+        _outsci, _outwht, _outctx, tile_runs = run_driz_tiles(
+            imageObjectList, output_wcs, outwcs, paramDict, maskval,
+            _nplanes, pool_size, wcsmap, memmap=memmap, sparse=sparse,
+            pool=pool)
+        if sparse:
+            ctxruns.append(tile_runs)
+        _hdrlist = []
+    elif (not single) or \
+       (single and (not will_parallel) and (not imageObjectList[0].inmemory)
+        and (not paramDict.get('crop'))):
         # Note there are four cases/combinations for single drizzle alone here:
         # (not-inmem, serial), (not-inmem, parallel), (inmem, serial), (inmem, parallel)
         _outsci=np.empty(output_wcs.array_shape, dtype=np.float32)
@@ -629,6 +697,8 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
     # Work on each image
     #
     subprocs = []
+    shared_outputs = []
+    pool_tasks = []
     for img in imageObjectList:
 
         chiplist = img.returnAllChips(extname=img.scienceExt)
@@ -648,26 +718,50 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
         else:
             template.extend(fnames)
 
-        # Work each image, possibly in parallel
-        if will_parallel:
-            # use multiprocessing.Manager only if in parallel and in memory
-            if img.inmemory:
-                manager = multiprocessing.Manager()
-                dproxy = manager.dict(img.virtualOutputs) # copy & wrap it in proxy
-                img.virtualOutputs = dproxy
+        # Separate drizzle products may only cover the footprint of the image
+        crop = None
+        img_output_wcs, img_outwcs = output_wcs, outwcs
+        if single and paramDict.get('crop'):
+            crop = _get_output_crop(img, chiplist, output_wcs, outwcs,
+                                    paramDict)
+        if crop is not None:
+            img_output_wcs = _crop_wcs(output_wcs, crop)
+            img_outwcs = _crop_wcs(outwcs, crop)
 
+        # Work each image, possibly in parallel
+        if will_parallel and single and img.inmemory:
+            # Drizzle into output arrays in shared memory, which become the
+            # in-memory product of this image once all workers are done
+            bufs = _alloc_shared_outputs(img_output_wcs.array_shape, _nplanes)
+            shared_outputs.append((img, chiplist, img_output_wcs, img_outwcs,
+                                   template, num_in_prod, _chipIdx, bufs,
+                                   crop))
+            p = multiprocessing.Process(target=run_driz_img_shared,
+                name='adrizzle.run_driz_img_shared()', # for err msgs
+                args=(img, chiplist, img_output_wcs, img_outwcs, paramDict,
+                      _nplanes, _chipIdx, bufs, wcsmap))
+            subprocs.append(p)
+        elif will_parallel and single and pool is not None:
+            # run in the workers of the pool
+            pool_tasks.append((img, (img_output_wcs, img_outwcs, template,
+                                     paramDict, single, num_in_prod, build,
+                                     _versions, _numctx, _nplanes, _chipIdx,
+                                     wcsmap, crop)))
+        elif will_parallel and single:
             # parallelize run_driz_img (currently for separate drizzle only)
             p = multiprocessing.Process(target=run_driz_img,
                 name='adrizzle.run_driz_img()', # for err msgs
-                args=(img,chiplist,output_wcs,outwcs,template,paramDict,
+                args=(img,chiplist,img_output_wcs,img_outwcs,template,paramDict,
                       single,num_in_prod,build,_versions,_numctx,_nplanes,
-                      _chipIdx,None,None,None,None,wcsmap))
+                      _chipIdx,None,None,None,None,wcsmap),
+                kwargs={'crop': crop})
             subprocs.append(p)
         else:
             # serial run_driz_img run (either separate drizzle or final drizzle)
-            run_driz_img(img,chiplist,output_wcs,outwcs,template,paramDict,
-                         single,num_in_prod,build,_versions,_numctx,_nplanes,
-                         _chipIdx,_outsci,_outwht,_outctx,_hdrlist,wcsmap)
+            run_driz_img(img,chiplist,img_output_wcs,img_outwcs,template,
+                         paramDict,single,num_in_prod,build,_versions,_numctx,
+                         _nplanes,_chipIdx,_outsci,_outwht,_outctx,_hdrlist,
+                         wcsmap,drizzle=not tiled,crop=crop,ctxruns=ctxruns)
 
         # Increment/reset master chip counter
         _chipIdx += len(chiplist)
@@ -675,12 +769,33 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
             _chipIdx = 0
 
     # do the join if we spawned tasks
-    if will_parallel:
+    if will_parallel and single:
+        if pool_tasks:
+            log.info('Using pool of %d worker processes' % pool.size)
+            pool.map(_run_driz_img_task, pool_tasks)
         mputil.launch_and_wait(subprocs, pool_size) # blocks till all done
 
+    # Wrap the shared output arrays into the in-memory products, without
+    # copying them
+    for (img, chiplist, img_output_wcs, img_outwcs, template, num_in_prod,
+         chipIdx, bufs, crop) in shared_outputs:
+        _outsci, _outwht, _outctx = _shared_output_views(
+            bufs, img_output_wcs.array_shape, _nplanes)
+        run_driz_img(img, chiplist, img_output_wcs, img_outwcs, template,
+                     paramDict, single, num_in_prod, build, _versions,
+                     _numctx, _nplanes, chipIdx, _outsci, _outwht, _outctx,
+                     [], wcsmap, drizzle=False, crop=crop)
+
+    # Remove the scratch files of out-of-core drizzling
+    memmap_files = [getattr(a, 'filename', None) for a in
+                    (_outsci, _outwht, _outctx) if isinstance(a, np.memmap)]
+
     del _outsci,_outwht,_outctx,_hdrlist
     # have looped over each img/chip
 
+    for fname in memmap_files:
+        util.removeFileSafely(fname)
+
 
 #
 # Still to check:
@@ -688,7 +803,8 @@ def run_driz(imageObjectList,output_wcs,paramDict,single,build,wcsmap=None):
 
 def run_driz_img(img,chiplist,output_wcs,outwcs,template,paramDict,single,
                  num_in_prod,build,_versions,_numctx,_nplanes,chipIdxCopy,
-                 _outsci,_outwht,_outctx,_hdrlist,wcsmap):
+                 _outsci,_outwht,_outctx,_hdrlist,wcsmap,drizzle=True,
+                 crop=None,ctxruns=None):
     """ Perform the drizzle operation on a single image.
     This is separated out from :py:func:`run_driz` so as to keep together
     the entirety of the code which is inside the loop over
@@ -724,7 +840,8 @@ def run_driz_img(img,chiplist,output_wcs,outwcs,template,paramDict,single,
         # run_driz_chip
         run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,
                       single,doWrite,build,_versions,_numctx,_nplanes,
-                      chipIdxCopy,_outsci,_outwht,_outctx,_hdrlist,wcsmap)
+                      chipIdxCopy,_outsci,_outwht,_outctx,_hdrlist,wcsmap,
+                      drizzle=drizzle,crop=crop,ctxruns=ctxruns)
 
         # Increment chip counter (also done outside of this function)
         chipIdxCopy += 1
@@ -734,30 +851,422 @@ def run_driz_img(img,chiplist,output_wcs,outwcs,template,paramDict,single,
     #
     if here:
         del _outsci,_outwht,_outctx,_hdrlist
-    elif single:
+    elif single and drizzle:
         np.multiply(_outsci,0.,_outsci)
         np.multiply(_outwht,0.,_outwht)
         np.multiply(_outctx,0,_outctx)
         # this was "_hdrlist=[]", but we need to preserve the var ptr itself
         while len(_hdrlist)>0: _hdrlist.pop()
     # else, these were intended to live and be used beyond this function call
+    # (including arrays drizzled in parallel, which now hold the product)
 
     # img.saveVirtualOutputs() has already been done in run_driz_chip (but
     # only if single and doWrite)
 
 
-def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
-                  doWrite,build,_versions,_numctx,_nplanes,_numchips,
-                  _outsci,_outwht,_outctx,_hdrlist,wcsmap):
-    """ Perform the drizzle operation on a single chip.
-    This is separated out from `run_driz_img` so as to keep together
-    the entirety of the code which is inside the loop over
-    chips.  See the `run_driz` code for more documentation.
+def _run_driz_img_task(img, output_wcs, outwcs, template, paramDict, single,
+                       num_in_prod, build, _versions, _numctx, _nplanes,
+                       chipIdx, wcsmap, crop):
+    """ Run :py:func:`run_driz_img` on all chips of ``img`` as a task of a
+    `~drizzlepac.util.WorkerPool`.
     """
-    global time_pre_all, time_driz_all, time_post_all, time_write_all
+    chiplist = img.returnAllChips(extname=img.scienceExt)
+    run_driz_img(img, chiplist, output_wcs, outwcs, template, paramDict,
+                 single, num_in_prod, build, _versions, _numctx, _nplanes,
+                 chipIdx, None, None, None, None, wcsmap, crop=crop)
+
+
+def run_driz_tiles(imageObjectList, output_wcs, outwcs, paramDict, maskval,
+                   _nplanes, pool_size, wcsmap, memmap=False, sparse=False,
+                   pool=None):
+    """ Perform the final drizzle in parallel by splitting the output frame
+    into ``pool_size`` tiles of contiguous rows, each one drizzled by a
+    separate process using only those chips which overlap it.
+
+    The output arrays are allocated in shared memory and each worker only
+    updates the rows of its own tile, so no stitching of the tiles is
+    needed once they are all done.  The drizzled arrays are returned.
+
+    With ``memmap`` set, the output arrays are instead memory-mapped scratch
+    files and the output frame gets split into as many more tiles as needed
+    for the output rows of each tile to fit within ``_MEMMAP_TILE_SIZE``
+    bytes, so that frames larger than the available memory can be drizzled.
+
+    With ``sparse`` set, the context gets collected as runs of pixels (see
+    :py:mod:`drizzlepac.sparsecontext`) which are returned along with the
+    arrays, or `None` otherwise.
+
+    With a `~drizzlepac.util.WorkerPool` given as ``pool``, the tiles get
+    drizzled by its workers instead of by processes started for each tile.
+    Shared buffers cannot be handed to workers started beforehand, so
+    unless the output arrays are memory-mapped, each worker drizzles its
+    tile into arrays of its own, which then get copied into the output.
+    """
+    shape = output_wcs.array_shape
+    ntiles = pool_size
+    if memmap:
+        bufs = _alloc_memmap_outputs(shape, _nplanes,
+                                     imageObjectList[0].outputNames['outFinal'])
+        tile_bytes = 4 * (2 + _nplanes) * shape[0] * shape[1]
+        ntiles = max(ntiles, int(np.ceil(tile_bytes / _MEMMAP_TILE_SIZE)))
+        ntiles = min(ntiles, shape[0])
+        log.info('Drizzling out-of-core using %d tiles' % ntiles)
+    if pool_size < 2:
+        pool = None
+    if memmap:
+        _outsci, _outwht, _outctx = _shared_output_views(bufs, shape,
+                                                         _nplanes)
+    elif pool is not None:
+        bufs = None
+        _outsci = np.empty(shape, dtype=np.float32)
+        _outwht = np.zeros(shape, dtype=np.float32)
+        _outctx = np.zeros((_nplanes,) + tuple(shape), dtype=np.int32)
+    else:
+        bufs = _alloc_shared_outputs(shape, _nplanes)
+        _outsci, _outwht, _outctx = _shared_output_views(bufs, shape,
+                                                         _nplanes)
+    _outsci.fill(maskval)
+
+    # Range of output rows covered by each chip, in the same order
+    # as the chips get drizzled
+    chip_rows = []
+    for img in imageObjectList:
+        for chip in img.returnAllChips(extname=img.scienceExt):
+            chip_rows.append(_chip_output_rows(chip, outwcs, paramDict))
 
-    epoch = time.time()
+    edges = np.linspace(0, shape[0], ntiles + 1).astype(int)
+    subprocs = []
+    tile_runs = []
+    runs_files = []
+    pool_tasks = []
+    for y0, y1 in zip(edges[:-1], edges[1:]):
+        if pool is not None:
+            # run in the workers of the pool, on all the images
+            pool_tasks.append((None, ((y0, y1), chip_rows, output_wcs,
+                                      outwcs, paramDict, _nplanes, bufs,
+                                      wcsmap, maskval, sparse)))
+            continue
+        if pool_size < 2:
+            # Out-of-core drizzling done serially, one tile at a time
+            tile_runs.append(run_driz_tile(imageObjectList, (y0, y1),
+                chip_rows, output_wcs, outwcs, paramDict, _nplanes, bufs,
+                wcsmap, sparse=sparse))
+            continue
+        runs_file = None
+        if sparse:
+            # Runs found by the workers get handed back through .npy files
+            fd, runs_file = tempfile.mkstemp(suffix='_ctx.npy')
+            os.close(fd)
+            runs_files.append(runs_file)
+        p = multiprocessing.Process(target=run_driz_tile,
+            name='adrizzle.run_driz_tile()', # for err msgs
+            args=(imageObjectList, (y0, y1), chip_rows, output_wcs, outwcs,
+                  paramDict, _nplanes, bufs, wcsmap),
+            kwargs={'sparse': sparse, 'runs_file': runs_file})
+        subprocs.append(p)
+    if subprocs:
+        mputil.launch_and_wait(subprocs, pool_size) # blocks till all done
+    if pool_tasks:
+        log.info('Using pool of %d worker processes' % pool.size)
+        results = pool.map(_run_driz_tile_task, pool_tasks)
+        for (img, args), (arrays, runs) in zip(pool_tasks, results):
+            if arrays is not None:
+                y0, y1 = args[0]
+                _outsci[y0:y1] = arrays[0]
+                _outwht[y0:y1] = arrays[1]
+                _outctx[:, y0:y1] = arrays[2]
+            tile_runs.append(runs)
+
+    for runs_file in runs_files:
+        tile_runs.append(np.load(runs_file))
+        util.removeFileSafely(runs_file)
+
+    runs = sparsecontext.sort_runs(tile_runs) if sparse else None
+    return _outsci, _outwht, _outctx, runs
+
+
+def run_driz_tile(imageObjectList, tile, chip_rows, output_wcs, outwcs,
+                  paramDict, _nplanes, bufs, wcsmap, sparse=False,
+                  runs_file=None):
+    """ Drizzle all chips overlapping the output rows ``tile[0]:tile[1]``
+    onto the shared output arrays set up by :py:func:`run_driz_tiles`.
+
+    With ``sparse`` set, the runs of the compact context image within the
+    tile are returned, and also saved to ``runs_file`` if given.
+    """
+    y0, y1 = tile
+    _outsci, _outwht, _outctx = _shared_output_views(
+        bufs, output_wcs.array_shape, _nplanes)
+    ctxruns = _driz_tile(imageObjectList, tile, chip_rows, outwcs, paramDict,
+                         _nplanes, _outsci[y0:y1], _outwht[y0:y1],
+                         _outctx[:, y0:y1], wcsmap, sparse=sparse)
+    if ctxruns is not None and runs_file is not None:
+        np.save(runs_file, ctxruns)
+    return ctxruns
+
+
+def _run_driz_tile_task(imageObjectList, tile, chip_rows, output_wcs,
+                        outwcs, paramDict, _nplanes, bufs, wcsmap, maskval,
+                        sparse):
+    """ Drizzle a tile as a task of a `~drizzlepac.util.WorkerPool`, into
+    the memory-mapped output arrays ``bufs``, or else into arrays of its
+    own.  Returns those arrays (`None` with ``bufs``) and the runs of the
+    compact context image of the tile.
+    """
+    if bufs is not None:
+        return None, run_driz_tile(imageObjectList, tile, chip_rows,
+                                   output_wcs, outwcs, paramDict, _nplanes,
+                                   bufs, wcsmap, sparse=sparse)
+    y0, y1 = tile
+    shape = (y1 - y0, output_wcs.array_shape[1])
+    _outsci = np.empty(shape, dtype=np.float32)
+    _outsci.fill(maskval)
+    _outwht = np.zeros(shape, dtype=np.float32)
+    _outctx = np.zeros((_nplanes,) + shape, dtype=np.int32)
+    ctxruns = _driz_tile(imageObjectList, tile, chip_rows, outwcs, paramDict,
+                         _nplanes, _outsci, _outwht, _outctx, wcsmap,
+                         sparse=sparse)
+    return (_outsci, _outwht, _outctx), ctxruns
+
+
+def _driz_tile(imageObjectList, tile, chip_rows, outwcs, paramDict, _nplanes,
+               _outsci, _outwht, _outctx, wcsmap, sparse=False):
+    """ Drizzle all chips overlapping the output rows ``tile[0]:tile[1]``
+    onto the output arrays of those rows.  Returns the runs of the compact
+    context image within the tile with ``sparse`` set, `None` otherwise.
+    """
+    y0, y1 = tile
+    # Tiles drizzled one at a time may still use threads
+    num_threads = paramDict.get('num_threads') or 1
+
+    ctxruns = []
+    _numchips = 0
+    for img in imageObjectList:
+        for chip in img.returnAllChips(extname=img.scienceExt):
+            rowmin, rowmax = chip_rows[_numchips]
+            if rowmin < y1 and rowmax >= y0:
+                _expname = _get_chip_input_name(chip)
+                img.set_wtscl(chip._chip, paramDict['wt_scl'])
+                _inwht = _build_chip_weights(img, chip, outwcs, paramDict,
+                                             False, _expname)
+                _insci, _expin, _in_units = _get_chip_sci(chip, _expname)
+
+                do_driz(_insci, chip.wcs, _inwht, outwcs, _outsci, _outwht,
+                        _outctx, _expin, _in_units, chip._wtscl,
+                        wcslin_pscale=chip.wcslin_pscale,
+                        uniqid=1 if sparse else
+                            _get_chip_uniqid(_numchips, _nplanes),
+                        pixfrac=paramDict['pixfrac'],
+                        kernel=paramDict['kernel'],
+                        fillval=paramDict['fillval'],
+                        stepsize=paramDict['stepsize'], wcsmap=wcsmap,
+                        ymin=y0 + 1, num_threads=num_threads,
+                        pixmap_file=_get_pixmap_file(img, chip),
+                        exact_kernel=paramDict.get('exact_kernel', False),
+                        max_error=paramDict.get('max_map_error'))
+                if sparse:
+                    ctxruns.append(_collect_context_runs(chip, outwcs,
+                        paramDict, _outctx[0], _numchips + 1, yoffset=y0))
+            _numchips += 1
+
+    if not sparse:
+        return None
+    return sparsecontext.sort_runs(ctxruns)
+
+
+def run_driz_img_shared(img, chiplist, output_wcs, outwcs, paramDict,
+                        _nplanes, chipIdx, bufs, wcsmap):
+    """ Drizzle all chips of an image onto the output arrays in shared
+    memory set up by :py:func:`run_driz` for a parallel separate drizzle
+    run in memory.  Creating the in-memory product itself is left to the
+    parent process, which has access to the drizzled arrays directly.
+    """
+    _outsci, _outwht, _outctx = _shared_output_views(
+        bufs, output_wcs.array_shape, _nplanes)
+
+    for chip in chiplist:
+        _expname = _get_chip_input_name(chip)
+        img.set_wtscl(chip._chip, paramDict['wt_scl'])
+        _inwht = _build_chip_weights(img, chip, outwcs, paramDict, True,
+                                     _expname)
+        _insci, _expin, _in_units = _get_chip_sci(chip, _expname)
+
+        do_driz(_insci, chip.wcs, _inwht, outwcs, _outsci, _outwht, _outctx,
+                _expin, _in_units, chip._wtscl,
+                wcslin_pscale=chip.wcslin_pscale,
+                uniqid=_get_chip_uniqid(chipIdx, _nplanes),
+                pixfrac=paramDict['pixfrac'], kernel=paramDict['kernel'],
+                fillval=paramDict['fillval'], stepsize=paramDict['stepsize'],
+                wcsmap=wcsmap, num_threads=1,
+                pixmap_file=_get_pixmap_file(img, chip),
+                exact_kernel=paramDict.get('exact_kernel', False),
+                max_error=paramDict.get('max_map_error'))
+        chipIdx += 1
 
+
+def _alloc_shared_outputs(shape, _nplanes):
+    """ Allocate buffers in shared memory for the science, weight and
+    context output arrays of the given shape.  The buffers are initialized
+    to zero and can be passed on to worker processes.
+    """
+    npix = shape[0] * shape[1]
+    return (multiprocessing.RawArray('f', npix),
+            multiprocessing.RawArray('f', npix),
+            multiprocessing.RawArray('i', _nplanes * npix))
+
+
+def _alloc_memmap_outputs(shape, _nplanes, rootname):
+    """ Create scratch files, in the default directory for temporary files,
+    for memory-mapping the science, weight and context output arrays of the
+    given shape, and return their names.  These can be passed on to worker
+    processes in place of the buffers returned by
+    :py:func:`_alloc_shared_outputs`.
+    """
+    prefix = os.path.basename(os.path.splitext(rootname)[0]) + '_'
+    fnames = []
+    for suffix, dtype, nplanes in [('sci', np.float32, 1),
+                                   ('wht', np.float32, 1),
+                                   ('ctx', np.int32, _nplanes)]:
+        fd, fname = tempfile.mkstemp(prefix=prefix, suffix='_%s.dat' % suffix)
+        os.close(fd)
+        # Allocate the (zero-initialized) file
+        arr = np.memmap(fname, dtype=dtype, mode='w+',
+                        shape=(nplanes,) + tuple(shape))
+        del arr
+        fnames.append(fname)
+    return tuple(fnames)
+
+
+def _shared_output_views(bufs, shape, _nplanes):
+    """ Return the science, weight and context arrays backed by the
+    buffers returned by :py:func:`_alloc_shared_outputs` or by the scratch
+    files created by :py:func:`_alloc_memmap_outputs`.
+    """
+    sci_buf, wht_buf, ctx_buf = bufs
+    if isinstance(sci_buf, str):
+        _outsci = np.memmap(sci_buf, dtype=np.float32, mode='r+', shape=shape)
+        _outwht = np.memmap(wht_buf, dtype=np.float32, mode='r+', shape=shape)
+        _outctx = np.memmap(ctx_buf, dtype=np.int32, mode='r+',
+                            shape=(_nplanes,) + tuple(shape))
+        return _outsci, _outwht, _outctx
+    _outsci = np.frombuffer(sci_buf, dtype=np.float32).reshape(shape)
+    _outwht = np.frombuffer(wht_buf, dtype=np.float32).reshape(shape)
+    _outctx = np.frombuffer(ctx_buf, dtype=np.int32).reshape(
+        (_nplanes,) + tuple(shape))
+    return _outsci, _outwht, _outctx
+
+
+def _chip_output_rows(chip, outwcs, paramDict):
+    """ Return the first and last (0-based) rows of the output frame
+    which could receive flux from this chip, based on the footprint of the
+    chip padded by the size of the drizzle kernel.
+    """
+    xmin, xmax, ymin, ymax = _chip_output_bbox(chip, outwcs, paramDict)
+    return ymin, ymax
+
+
+def _chip_output_bbox(chip, outwcs, paramDict):
+    """ Return the first and last (0-based) columns and rows of the output
+    frame which could receive flux from this chip, as
+    ``(xmin, xmax, ymin, ymax)``, based on the footprint of the chip padded
+    by the size of the drizzle kernel.
+    """
+    nx, ny = chip.wcs.pixel_shape
+    xedge = np.linspace(0.5, nx + 0.5, 33)
+    yedge = np.linspace(0.5, ny + 0.5, 33)
+    xpix = np.concatenate([xedge, np.full_like(yedge, nx + 0.5),
+                           xedge, np.full_like(yedge, 0.5)])
+    ypix = np.concatenate([np.full_like(xedge, 0.5), yedge,
+                           np.full_like(xedge, ny + 0.5), yedge])
+
+    ra, dec = chip.wcs.all_pix2world(xpix, ypix, 1)
+    xout, yout = outwcs.all_world2pix(ra, dec, 1)
+    if not (np.all(np.isfinite(xout)) and np.all(np.isfinite(yout))):
+        # Play it safe and let drizzle itself work out the overlap
+        ny, nx = outwcs.array_shape
+        return 0, nx - 1, 0, ny - 1
+
+    # The widest kernels (lanczos3) reach out 3 input pixels
+    pix_ratio = outwcs.pscale / chip.wcslin_pscale
+    margin = int(np.ceil(3.0 * max(paramDict['pixfrac'], 1.0) / pix_ratio)) + 2
+
+    return (int(np.floor(xout.min())) - 1 - margin,
+            int(np.ceil(xout.max())) - 1 + margin,
+            int(np.floor(yout.min())) - 1 - margin,
+            int(np.ceil(yout.max())) - 1 + margin)
+
+
+def _get_output_crop(img, chiplist, output_wcs, outwcs, paramDict):
+    """ Work out the cutout of the output frame covering the footprint of
+    all chips of an image, for writing footprint-cropped separate drizzle
+    products.
+
+    Returns ``(x0, y0, cutout_shape, frame_shape, fill)``, with ``(x0, y0)``
+    the (0-based) position of the first pixel of the cutout in the output
+    frame, ``cutout_shape`` and ``frame_shape`` the shapes of the cutout and
+    of the full output frame and ``fill`` the value of the pixels of that
+    frame outside of the cutout.  Returns None when the cutout would cover
+    the whole output frame.
+    """
+    ny, nx = output_wcs.array_shape
+    bboxes = np.array([_chip_output_bbox(chip, outwcs, paramDict)
+                       for chip in chiplist])
+    x0 = max(0, bboxes[:, 0].min())
+    x1 = min(nx - 1, bboxes[:, 1].max())
+    y0 = max(0, bboxes[:, 2].min())
+    y1 = min(ny - 1, bboxes[:, 3].max())
+    if x0 > x1 or y0 > y1:
+        # No overlap with the output frame at all: keep a single pixel
+        x1, y1 = x0, y0 = 0, 0
+    elif x0 == 0 and y0 == 0 and x1 == nx - 1 and y1 == ny - 1:
+        return None
+
+    fillval = paramDict['fillval']
+    if util.is_blank(fillval) or str(fillval).upper() == 'INDEF':
+        fill = 0.0
+    else:
+        fill = float(fillval)
+
+    log.info('Cropping separate drizzle product of %s to [%d:%d,%d:%d]' %
+             (img._filename, x0 + 1, x1 + 1, y0 + 1, y1 + 1))
+    return (int(x0), int(y0), (int(y1 - y0 + 1), int(x1 - x0 + 1)),
+            (ny, nx), fill)
+
+
+def _collect_context_runs(chip, outwcs, paramDict, _outctx, uniqid,
+                          yoffset=0):
+    """ Return the runs of pixels (see :py:mod:`drizzlepac.sparsecontext`)
+    of the context plane ``_outctx`` which received flux from ``chip``, with
+    ID ``uniqid``, and then clear them for the next chip.  ``yoffset`` gives
+    the first output row covered by ``_outctx``.
+    """
+    xmin, xmax, ymin, ymax = _chip_output_bbox(chip, outwcs, paramDict)
+    ny, nx = _outctx.shape
+    x0, x1 = max(xmin, 0), min(xmax + 1, nx)
+    y0, y1 = max(ymin - yoffset, 0), min(ymax + 1 - yoffset, ny)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    region = _outctx[y0:y1, x0:x1]
+    runs = sparsecontext.find_runs(region != 0, uniqid, y0 + yoffset, x0)
+    region[...] = 0
+    return runs
+
+
+def _crop_wcs(wcs, crop):
+    """ Return a copy of the output WCS ``wcs`` describing the cutout of
+    it which gets used for a footprint-cropped separate drizzle product.
+    """
+    x0, y0, cutout_shape, frame_shape, fill = crop
+    cropped = copy.deepcopy(wcs)
+    cropped.wcs.crpix = cropped.wcs.crpix - np.array([x0, y0])
+    cropped.pixel_shape = (cutout_shape[1], cutout_shape[0])
+    return cropped
+
+
+def _get_chip_input_name(chip):
+    """ Return the name of the (possibly sky-subtracted) SCI extension to be
+    drizzled for this chip.
+    """
     # Look for sky-subtracted product
     if os.path.exists(chip.outputNames['outSky']):
         chipextn = '['+chip.header['extname']+','+str(chip.header['extver'])+']'
@@ -765,8 +1274,23 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
     else:
         # If sky-subtracted product does not exist, use regular input
         _expname = chip.outputNames['data']
-    log.info('-Drizzle input: %s' % _expname)
+    return _expname
+
+
+def _get_pixmap_file(img, chip):
+    """ Return the rootname of the sidecar files used to share the pixel
+    maps of this chip between processing steps, or None when working in
+    memory.
+    """
+    if img.inmemory:
+        return None
+    return chip.outputNames.get('pixmap')
 
+
+def _get_chip_sci(chip, _expname):
+    """ Read in the SCI array for this chip ready to be drizzled.
+    Returns the array along with the exposure time and units of the input.
+    """
     # Open the SCI image
     _handle = fileutil.openImage(_expname, mode='readonly', memmap=False)
     _sciext = _handle[chip.header['extname'],chip.header['extver']]
@@ -792,35 +1316,12 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
     else:
         _expin = chip._exptime
 
-    ####
-    #
-    # Put the units keyword handling in the imageObject class
-    #
-    ####
-    # Determine output value of BUNITS
-    # and make sure it is not specified as 'ergs/cm...'
-    _bunit = chip._bunit
+    return _insci, _expin, _in_units
 
-    _bindx = _bunit.find('/')
-
-    if paramDict['units'] == 'cps':
-        # If BUNIT value does not specify count rate already...
-        if _bindx < 1:
-            # ... append '/SEC' to value
-            _bunit += '/S'
-        else:
-            # reset _bunit here to None so it does not
-            #    overwrite what is already in header
-            _bunit = None
-    else:
-        if _bindx > 0:
-            # remove '/S'
-            _bunit = _bunit[:_bindx]
-        else:
-            # reset _bunit here to None so it does not
-            #    overwrite what is already in header
-            _bunit = None
 
+def _get_chip_uniqid(_numchips, _nplanes):
+    """ Return the context image ID for the chip with this (0-based) index.
+    """
     _uniqid = _numchips + 1
     if _nplanes == 1:
         # We need to reset what gets passed to TDRIZ
@@ -828,7 +1329,13 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
         # to prevent overflow problems with trying to access
         # planes that weren't created for large numbers of inputs.
         _uniqid = ((_uniqid-1) % 32) + 1
+    return _uniqid
+
 
+def _build_chip_weights(img, chip, outwcs, paramDict, single, _expname):
+    """ Build the weight array used to drizzle this chip from its DQ array
+    and the static and cosmic-ray masks.
+    """
     # Select which mask needs to be read in for drizzling
     ####
     #
@@ -867,10 +1374,6 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
             if dqarr.sum() == 0:
                 log.warning('WARNING: All pixels masked out when applying '
                             'cosmic ray mask to %s' % _expname)
-        updateInputDQArray(chip.dqfile,chip.dq_extn,chip._chip,
-                           crMaskName, paramDict['crbit'])
-
-    img.set_wtscl(chip._chip,paramDict['wt_scl'])
 
     pix_ratio = outwcs.pscale / chip.wcslin_pscale
 
@@ -887,6 +1390,83 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
     else:  # wht_type == None, used for single drizzle images
         _inwht = chip._exptime * dqarr.astype(np.float32)
 
+    return _inwht
+
+
+def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
+                  doWrite,build,_versions,_numctx,_nplanes,_numchips,
+                  _outsci,_outwht,_outctx,_hdrlist,wcsmap,drizzle=True,
+                  crop=None,ctxruns=None):
+    """ Perform the drizzle operation on a single chip.
+    This is separated out from `run_driz_img` so as to keep together
+    the entirety of the code which is inside the loop over
+    chips.  See the `run_driz` code for more documentation.
+
+    When ``drizzle`` is False, the chip has already been drizzled onto
+    the output arrays (by the workers of a parallel final drizzle) and
+    only the remaining updates to the inputs and outputs get performed.
+
+    ``crop`` describes the cutout of the output frame covered by the output
+    arrays, as returned by :py:func:`_get_output_crop`, for footprint-cropped
+    separate drizzle products.
+
+    ``ctxruns`` collects the runs of the compact context image, when one is
+    being created instead of the standard context image.
+    """
+    global time_pre_all, time_driz_all, time_post_all, time_write_all
+
+    epoch = time.time()
+
+    _expname = _get_chip_input_name(chip)
+    log.info('-Drizzle input: %s' % _expname)
+
+    ####
+    #
+    # Put the units keyword handling in the imageObject class
+    #
+    ####
+    # Determine output value of BUNITS
+    # and make sure it is not specified as 'ergs/cm...'
+    _bunit = chip._bunit
+
+    _bindx = _bunit.find('/')
+
+    if paramDict['units'] == 'cps':
+        # If BUNIT value does not specify count rate already...
+        if _bindx < 1:
+            # ... append '/SEC' to value
+            _bunit += '/S'
+        else:
+            # reset _bunit here to None so it does not
+            #    overwrite what is already in header
+            _bunit = None
+    else:
+        if _bindx > 0:
+            # remove '/S'
+            _bunit = _bunit[:_bindx]
+        else:
+            # reset _bunit here to None so it does not
+            #    overwrite what is already in header
+            _bunit = None
+
+    _uniqid = _get_chip_uniqid(_numchips, _nplanes)
+    if ctxruns is not None:
+        # Drizzle onto the single scratch plane of the compact context
+        _uniqid = 1
+
+    img.set_wtscl(chip._chip,paramDict['wt_scl'])
+
+    if drizzle or not paramDict['clean']:
+        _inwht = _build_chip_weights(img, chip, outwcs, paramDict, single,
+                                     _expname)
+
+    if not single:
+        crMaskName = chip.outputNames['crmaskImage']
+        if img.inmemory and crMaskName in img.virtualOutputs:
+            crMaskName = img.virtualOutputs[crMaskName]
+        updateInputDQArray(chip.dqfile,chip.dq_extn,chip._chip,
+                           crMaskName, paramDict['crbit'])
+
     if not(paramDict['clean']):
         # Write out mask file if 'clean' has been turned off
         if single:
@@ -905,13 +1485,23 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
             log.info('Writing out mask file: %s' % _outmaskname)
 
     time_pre = time.time() - epoch; epoch = time.time()
-    # New interface to performing the drizzle operation on a single chip/image
-    _vers = do_driz(_insci, chip.wcs, _inwht, outwcs, _outsci, _outwht, _outctx,
-                _expin, _in_units, chip._wtscl,
-                wcslin_pscale=chip.wcslin_pscale, uniqid=_uniqid,
-                pixfrac=paramDict['pixfrac'], kernel=paramDict['kernel'],
-                fillval=paramDict['fillval'], stepsize=paramDict['stepsize'],
-                wcsmap=wcsmap)
+    if drizzle:
+        _insci, _expin, _in_units = _get_chip_sci(chip, _expname)
+        # New interface to performing the drizzle operation on a single chip/image
+        _vers = do_driz(_insci, chip.wcs, _inwht, outwcs, _outsci, _outwht,
+                    _outctx, _expin, _in_units, chip._wtscl,
+                    wcslin_pscale=chip.wcslin_pscale, uniqid=_uniqid,
+                    pixfrac=paramDict['pixfrac'], kernel=paramDict['kernel'],
+                    fillval=paramDict['fillval'], stepsize=paramDict['stepsize'],
+                    wcsmap=wcsmap, num_threads=paramDict.get('num_threads', 1),
+                    pixmap_file=_get_pixmap_file(img, chip),
+                    exact_kernel=paramDict.get('exact_kernel', False),
+                    max_error=paramDict.get('max_map_error'))
+        if ctxruns is not None:
+            ctxruns.append(_collect_context_runs(chip, outwcs, paramDict,
+                                                 _outctx[0], _numchips + 1))
+    else:
+        _vers = _versions['AstroDrizzle']
     time_driz = time.time() - epoch; epoch = time.time()
 
     # Set up information for generating output FITS image
@@ -975,8 +1565,14 @@ def run_driz_chip(img,chip,output_wcs,outwcs,template,paramDict,single,
                                           wcs=output_wcs, single=single)
         _outimg.set_bunit(_bunit)
         _outimg.set_units(paramDict['units'])
+        if crop is not None:
+            x0, y0, cutout_shape, frame_shape, fill = crop
+            _outimg.set_crop(x0, y0, frame_shape, fill)
+        if ctxruns is not None:
+            ctxruns = sparsecontext.sort_runs(ctxruns)
         outimgs = _outimg.writeFITS(template,_outsci,_outwht,ctxarr=_outctx,
-                                        versions=_versions,virtual=img.inmemory)
+                                        versions=_versions,virtual=img.inmemory,
+                                        ctxruns=ctxruns)
         del _outimg
 
         # update imageObject with product in memory
@@ -1012,13 +1608,35 @@ def do_driz(insci, input_wcs, inwht,
             output_wcs, outsci, outwht, outcon,
             expin, in_units, wt_scl,
             wcslin_pscale=1.0,uniqid=1, pixfrac=1.0, kernel='square',
-            fillval="INDEF", stepsize=10,wcsmap=None):
+            fillval="INDEF", stepsize=10,wcsmap=None, xmin=1, ymin=1,
+            num_threads=1, pixmap_file=None, exact_kernel=False,
+            max_error=None):
     """
     Core routine for performing 'drizzle' operation on a single input image
     All input values will be Python objects such as ndarrays, instead
     of filenames.
     File handling (input and output) will be performed by calling routine.
 
+    The drizzle kernel will split the work over ``num_threads`` threads
+    when the default (interpolated) WCS mapping is used; the result is
+    identical to that of a single thread.  User-supplied mappings are
+    always drizzled with one thread.
+
+    The output arrays may cover only a section of the frame described by
+    ``output_wcs``, in which case ``xmin`` and ``ymin`` give the (1-based)
+    position in that frame of their first pixel.  Such a section receives
+    the same flux as it would from drizzling the whole frame.
+
+    The default mapping re-uses the pixel map computed earlier for the same
+    pair of WCSs, if any (see :py:func:`wcs_functions.get_pixel_map`), which
+    can also be shared through sidecar files named after ``pixmap_file``.
+    With ``max_error`` set, the pixel map gets refined wherever needed to
+    stay within ``max_error`` output pixels of the WCSs.
+
+    The ``gaussian`` and ``lanczos`` kernels are interpolated from finely
+    sampled look-up tables, within 1e-6 of the analytic kernels (relative to
+    their peak value), unless ``exact_kernel`` is set.
+
     """
     # Insure that the fillval parameter gets properly interpreted for use with tdriz
     if util.is_blank(fillval):
@@ -1057,11 +1675,9 @@ def do_driz(insci, input_wcs, inwht,
     if wcsmap is None and cdriz is not None:
         log.info('Using WCSLIB-based coordinate transformation...')
         log.info('stepsize = %s' % stepsize)
-        mapping = cdriz.DefaultWCSMapping(
-            input_wcs, output_wcs,
-            input_wcs.pixel_shape[0], input_wcs.pixel_shape[1],
-            stepsize
-        )
+        mapping = wcs_functions.get_pixel_map(input_wcs, output_wcs,
+                                              stepsize, sidecar=pixmap_file,
+                                              max_error=max_error)
     else:
         #
         ##Using the Python class for the WCS-based transformation
@@ -1087,11 +1703,18 @@ def do_driz(insci, input_wcs, inwht,
         #WARNING: Input array recast as a float32 array
         insci = insci.astype(np.float32)
 
+    # Size of the output frame, for drizzling sections of it
+    if output_wcs.pixel_shape is None:
+        frame_nx, frame_ny = 0, 0
+    else:
+        frame_nx, frame_ny = output_wcs.pixel_shape
+
     _vers,nmiss,nskip = cdriz.tdriz(insci, inwht, outsci, outwht,
-        outctx, uniqid, ystart, 1, 1, _dny,
+        outctx, uniqid, ystart, xmin, ymin, _dny,
         pix_ratio, 1.0, 1.0, 'center', pixfrac,
         kernel, in_units, expscale, wt_scl,
-        fillval, nmiss, nskip, 1, mapping)
+        fillval, nmiss, nskip, 1, mapping, num_threads, int(exact_kernel),
+        int(frame_nx), int(frame_ny))
 
     if nmiss > 0:
         log.warning('! %s points were outside the output image.' % nmiss)
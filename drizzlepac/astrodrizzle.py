@@ -177,6 +177,7 @@ def run(configobj, wcsmap=None):
         # Define list of imageObject instances and output WCSObject instance
         # based on input paramters
         imgObjList = None
+        pool = None
         procSteps.addStep('Initialization')
         imgObjList, outwcs = processInput.setCommonInput(configobj)
         procSteps.endStep('Initialization')
@@ -195,6 +196,9 @@ def run(configobj, wcsmap=None):
         log.info("USER INPUT PARAMETERS common to all Processing Steps:")
         util.printParams(configobj, log=log)
 
+        # Start the worker processes shared by the steps run in parallel
+        pool = util.get_worker_pool(imgObjList, configobj.get('num_cores'))
+
         # Call rest of MD steps...
         #create static masks for each image
         staticMask.createStaticMask(imgObjList, configobj,
@@ -207,7 +211,7 @@ def run(configobj, wcsmap=None):
 
         #drizzle to separate images
         adrizzle.drizSeparate(imgObjList, outwcs, configobj, wcsmap=wcsmap,
-                              procSteps=procSteps)
+                              procSteps=procSteps, pool=pool)
 
 #       _dbg_dump_virtual_outputs(imgObjList)
 
@@ -223,7 +227,7 @@ def run(configobj, wcsmap=None):
 
         #Make your final drizzled image
         adrizzle.drizFinal(imgObjList, outwcs, configobj, wcsmap=wcsmap,
-                           procSteps=procSteps)
+                           procSteps=procSteps, pool=pool)
 
         print()
         print("AstroDrizzle Version {:s} is finished processing at {:s}.\n"
@@ -241,6 +245,8 @@ def run(configobj, wcsmap=None):
 
     finally:
         procSteps.reportTimes()
+        if pool is not None:
+            pool.close()
         if imgObjList:
             for image in imgObjList:
                 if clean:
@@ -248,6 +254,7 @@ def run(configobj, wcsmap=None):
                 image.close()
             del imgObjList
             del outwcs
+        wcs_functions.clear_pixel_maps()
 
 
 def help(file=None):
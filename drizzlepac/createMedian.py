@@ -9,6 +9,10 @@ Create a median image from the singly drizzled images.
 import os
 import sys
 import math
+import threading
+import contextlib
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from astropy.io import fits
 
@@ -18,10 +22,15 @@ from stsci.tools import iterfile, teal, logutil
 
 from . import imageObject
 from . import util
-from .minmed import min_med
+from .minmed import min_med, approx_min_med, approx_median, approx_state_size
 from . import processInput
 from .adrizzle import _single_step_num_
 
+try:
+    from . import cdriz
+except ImportError:
+    cdriz = None
+
 from .version import *
 
 # look in drizzlepac for createMedian.cfg:
@@ -29,6 +38,7 @@ __taskname__ = "drizzlepac.createMedian"
 _step_num_ = 4  # this relates directly to the syntax in the cfg file
 
 BUFSIZE = 1024*1024   # 1MB cache size
+APPROX_BUFSIZE = 64 * BUFSIZE  # default memory for approximate combinations
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
@@ -87,6 +97,7 @@ def createMedian(imgObjList, configObj, procSteps=None):
 
     paramDict = configObj[step_name]
     paramDict['proc_unit'] = configObj['proc_unit']
+    paramDict['num_cores'] = configObj.get('num_cores')
 
     # include whether or not compression was performed
     driz_sep_name = util.getSectionName(configObj, _single_step_num_)
@@ -116,6 +127,9 @@ def _median(imageObjectList, paramDict):
     proc_units = paramDict['proc_unit']
     compress = paramDict['compress']
     bufsizeMB = paramDict['combine_bufsize']
+    nbins = paramDict.get('combine_nbins', 100)
+    # 'amedian' and 'aminmed' read the stack one image at a time
+    approx = comb_type in ['amedian', 'aminmed']
 
     sigma = paramDict["combine_nsigma"]
     sigmaSplit = sigma.split()
@@ -149,7 +163,11 @@ def _median(imageObjectList, paramDict):
     backgroundValueList = []  # list of  MDRIZSKY *platescale values
     singleDrizList = []  # these are the input images
     singleWeightList = []  # pointers to the data arrays
+    singleCropList = []  # cutouts of footprint-cropped input images
+    weightCropList = []
     wht_mean = []  # Compute the mean value of each wht image
+    weightRowsList = []  # rows of the output frame with non-zero weight
+    openedList = []  # single drizzle products opened from disk
 
     single_hdr = None
     virtual = None
@@ -190,54 +208,52 @@ def _median(imageObjectList, paramDict):
         # If compression was used, reference ext=1 as CompImageHDU only writes
         # out MEF files, not simple FITS.
         if compress:
-            wcs_ext = '[1]'
             wcs_extnum = 1
         else:
-            wcs_ext = '[0]'
             wcs_extnum = 0
 
-        if not virtual:
-            if isinstance(singleDriz, str):
-                iter_singleDriz = singleDriz + wcs_ext
-                iter_singleWeight = singleWeight + wcs_ext
-            else:
-                iter_singleDriz = singleDriz[wcs_extnum]
-                iter_singleWeight = singleWeight[wcs_extnum]
+        if virtual:
+            hdr = singleDriz[wcs_extnum].header
         else:
-            iter_singleDriz = singleDriz_name + wcs_ext
-            iter_singleWeight = singleWeight_name + wcs_ext
+            hdr = fits.getheader(singleDriz_name, ext=wcs_extnum,
+                                 memmap=False)
+        crop = _get_crop(hdr)
 
         # read in WCS from first single drizzle image to use as WCS for
         # median image
         if single_hdr is None:
-            if virtual:
-                single_hdr = singleDriz[wcs_extnum].header
-            else:
-                single_hdr = fits.getheader(singleDriz_name, ext=wcs_extnum,
-                                            memmap=False)
+            single_hdr = _uncrop_header(hdr, crop)
 
-        single_image = iterfile.IterFitsFile(iter_singleDriz)
-        if virtual:
-            single_image.handle = singleDriz
-            single_image.inmemory = True
+        single_image, hdulist = _open_stack_image(
+            singleDriz_name, wcs_extnum, singleDriz if virtual else None)
+        if hdulist is not None:
+            openedList.append(hdulist)
 
         singleDrizList.append(single_image)  # add to an array for bookkeeping
+        singleCropList.append(crop)
 
         # If it exists, extract the corresponding weight images
         if (not virtual and os.access(singleWeight, os.F_OK)) or (
                 virtual and singleWeight):
-            weight_file = iterfile.IterFitsFile(iter_singleWeight)
-            if virtual:
-                weight_file.handle = singleWeight
-                weight_file.inmemory = True
+            weight_file, hdulist = _open_stack_image(
+                singleWeight_name, wcs_extnum,
+                singleWeight if virtual else None)
+            if hdulist is not None:
+                openedList.append(hdulist)
 
             singleWeightList.append(weight_file)
+            weightCropList.append(crop)
+            if isinstance(weight_file, iterfile.IterFitsFile):
+                weight_data = weight_file.data
+            else:
+                weight_data = weight_file
             try:
-                tmp_mean_value = ImageStats(weight_file.data, lower=1e-8,
+                tmp_mean_value = ImageStats(weight_data, lower=1e-8,
                                             fields="mean", nclip=0).mean
             except ValueError:
                 tmp_mean_value = 0.0
             wht_mean.append(tmp_mean_value * maskpt)
+            weightRowsList.append(_weighted_rows(weight_data, crop))
 
             # Extract instrument specific parameters and place in lists
 
@@ -292,16 +308,21 @@ def _median(imageObjectList, paramDict):
 
     # create an array for the median output image, use the size of the first
     # image in the list. Store other useful image characteristics:
-    single_driz_data = singleDrizList[0].data
+    single_driz_data = singleDrizList[0]
+    if isinstance(single_driz_data, iterfile.IterFitsFile):
+        single_driz_data = single_driz_data.data
     data_item_size = single_driz_data.itemsize
-    single_data_dtype = single_driz_data.dtype
-    imrows, imcols = single_driz_data.shape
+    single_data_dtype = single_driz_data.dtype.newbyteorder('=')
+    if singleCropList[0] is None:
+        imrows, imcols = single_driz_data.shape
+    else:
+        imrows, imcols = singleCropList[0][1]
 
-    medianImageArray = np.zeros_like(single_driz_data)
+    medianImageArray = np.zeros((imrows, imcols), dtype=single_data_dtype)
 
     del single_driz_data
 
-    if comb_type == "minmed" and not newmasks:
+    if comb_type in ["minmed", "aminmed"] and not newmasks:
         # Issue a warning if minmed is being run with newmasks turned off.
         print('\nWARNING: Creating median image without the application of '
               'bad pixel masks!\n')
@@ -312,11 +333,49 @@ def _median(imageObjectList, paramDict):
     # has enough rows to span the kernel used in the boxcar method
     # within minmed.
     overlap = 2 * grow
-    buffsize = BUFSIZE if bufsizeMB is None else (BUFSIZE * bufsizeMB)
-    section_nrows = min(imrows, int(buffsize / (imcols * data_item_size)))
+    nimages = len(singleDrizList)
+
+    # Sections get combined by a pool of threads, each working on one
+    # section at a time, so the memory gets split between them.
+    pool_size = util.get_pool_size(paramDict.get('num_cores'), imrows)
+
+    # Peak memory used per pixel of a section, all buffers and temporaries
+    # included
+    footprint = _section_pixel_size(
+        comb_type, nimages, len(singleWeightList), data_item_size,
+        newmasks, lthresh is not None or hthresh is not None, nbins
+    )
+
+    if bufsizeMB is None:
+        budget = _memory_budget(paramDict.get('combine_maxmem'),
+                                medianImageArray.nbytes)
+    else:
+        budget = None
+
+    if budget is not None:
+        buffsize = budget
+        pixel_size = footprint
+    elif approx:
+        # The buffer holds the state of the approximate combination of a
+        # whole section, which does not depend on the number of images.
+        if bufsizeMB is None:
+            buffsize = APPROX_BUFSIZE
+        else:
+            buffsize = BUFSIZE * bufsizeMB
+        pixel_size = approx_state_size(nbins)
+    else:
+        buffsize = BUFSIZE if bufsizeMB is None else (BUFSIZE * bufsizeMB)
+        pixel_size = data_item_size
+
+    row_size = pool_size * imcols * pixel_size
+    section_nrows = min(imrows, int(buffsize / row_size))
+    if pool_size > 1:
+        # Give each thread at least one section to work on
+        section_nrows = min(section_nrows,
+                            -(-(imrows - overlap) // pool_size) + overlap)
 
     if section_nrows == 0:
-        buffsize = imcols * data_item_size
+        buffsize = imcols * pixel_size
         print("WARNING: Buffer size is too small to hold a single row.\n"
               "         Buffer size size will be increased to minimal "
               "required: {}MB".format(float(buffsize) / 1048576.0))
@@ -337,8 +396,97 @@ def _median(imageObjectList, paramDict):
     nsec = (imrows - overlap) // nbr
     if (imrows - overlap) % nbr > 0:
         nsec += 1
+    pool_size = min(pool_size, nsec)
+
+    if budget is not None:
+        print("Memory available for the median: {:.1f}MB"
+              .format(budget / 1048576.0))
+    print("Combining {:d} sections of {:d} rows using {:d} thread(s), "
+          "each needing about {:.1f}MB"
+          .format(nsec, section_nrows, pool_size,
+                  section_nrows * imcols * footprint / 1048576.0))
+
+    # Compressed single drizzle products get re-opened for each read,
+    # so reading them is serialized
+    if any(isinstance(w, iterfile.IterFitsFile)
+           for w in singleDrizList + singleWeightList):
+        read_lock = threading.Lock()
+    else:
+        read_lock = contextlib.nullcontext()
+
+    # Images with zero weight over a whole section are masked out there, and
+    # so can be left out of the stack for that section, as long as masks
+    # are used and the combination depends on the unmasked pixels alone.
+    # 'imedian' takes the median of all pixels where all are masked.
+    skip_empty = all([newmasks, len(singleWeightList) == nimages,
+                      comb_type not in ['sum', 'imedian', 'iminmed']])
+    # Approximate combinations only hold one image of the stack at a time
+    buffer_depth = 1 if approx else nimages
+    if 'minmed' in comb_type:
+        min_depth = 2 if nimages > 2 else 1
+    else:
+        min_depth = nlow + nhigh + 1
+
+    # Each thread gathers the rows of its sections into the same buffers
+    buffers = threading.local()
+
+    def section_buffer(name, nimages, nrows):
+        buf = getattr(buffers, name, None)
+        if buf is None:
+            buf = np.empty(buffer_depth * section_nrows * imcols,
+                           dtype=single_data_dtype)
+            setattr(buffers, name, buf)
+        return buf[:nimages * nrows * imcols].reshape(nimages, nrows, imcols)
+
+    def approx_section(stack, e1, e2):
+        has_weights = len(singleWeightList) == nimages
+
+        def read_image(j):
+            i = stack[j]
+            sci = section_buffer('sci', 1, e2 - e1)[0]
+            wht = None
+            with read_lock:
+                _read_section(singleDrizList[i], singleCropList[i], e1, e2,
+                              sci)
+                if has_weights:
+                    wht = section_buffer('wht', 1, e2 - e1)[0]
+                    _read_section(singleWeightList[i], weightCropList[i], e1,
+                                  e2, wht, fill=0)
+            return sci, wht
+
+        # Same masks as for the exact combinations, built one image at a time
+        if newmasks and has_weights:
+            thresholds = [wht_mean[i] for i in stack]
+        else:
+            thresholds = None
+
+        if comb_type == 'aminmed':
+            return approx_min_med(
+                read_image,
+                len(stack),
+                [readnoiseList[i] for i in stack],
+                [exposureTimeList[i] for i in stack],
+                [backgroundValueList[i] for i in stack],
+                weight_thresholds=thresholds,
+                combine_grow=grow,
+                combine_nsigma1=nsigma1,
+                combine_nsigma2=nsigma2,
+                nbins=nbins,
+                nstack=nimages
+            )
+
+        return approx_median(
+            read_image,
+            len(stack),
+            weight_thresholds=thresholds,
+            nlow=nlow,
+            nhigh=nhigh,
+            lower=lthresh,
+            upper=hthresh,
+            nbins=nbins
+        )
 
-    for k in range(nsec):
+    def combine_section(k):
         e1 = k * nbr
         e2 = e1 + section_nrows
         u1 = grow
@@ -352,23 +500,34 @@ def _median(imageObjectList, paramDict):
             e1 = min(e1, e2 - overlap - 1)
             u2 = e2 - e1
 
-        imdrizSectionsList = np.empty(
-            (len(singleDrizList), e2 - e1, imcols),
-            dtype=single_data_dtype
-        )
-        for i, w in enumerate(singleDrizList):
-            imdrizSectionsList[i, :, :] = w[e1:e2]
+        if skip_empty:
+            stack = _section_stack(weightRowsList, wht_mean, e1, e2,
+                                   min_depth)
+            weight_stack = stack
+        else:
+            stack = range(nimages)
+            weight_stack = range(len(singleWeightList))
+
+        if approx:
+            result = approx_section(stack, e1, e2)
+            medianImageArray[e1 + u1:e1 + u2, :] = result[u1:u2, :]
+            return
 
+        imdrizSectionsList = section_buffer('sci', len(stack), e2 - e1)
         if singleWeightList:
-            weightSectionsList = np.empty(
-                (len(singleWeightList), e2 - e1, imcols),
-                dtype=single_data_dtype
-            )
-            for i, w in enumerate(singleWeightList):
-                weightSectionsList[i, :, :] = w[e1:e2]
+            weightSectionsList = section_buffer('wht', len(weight_stack),
+                                                e2 - e1)
         else:
             weightSectionsList = None
 
+        with read_lock:
+            for j, i in enumerate(stack):
+                _read_section(singleDrizList[i], singleCropList[i], e1, e2,
+                              imdrizSectionsList[j])
+            for j, i in enumerate(weight_stack):
+                _read_section(singleWeightList[i], weightCropList[i], e1, e2,
+                              weightSectionsList[j], fill=0)
+
         weight_mask_list = None
 
         if newmasks and weightSectionsList is not None:
@@ -384,7 +543,7 @@ def _median(imageObjectList, paramDict):
             # 0 means good, 1 means bad here...
             weight_mask_list = np.less(
                 weightSectionsList,
-                np.asarray(wht_mean)[:, None, None]
+                np.asarray(wht_mean)[weight_stack, None, None]
             ).astype(np.uint8)
 
         if 'minmed' in comb_type:  # Do MINMED
@@ -395,16 +554,31 @@ def _median(imageObjectList, paramDict):
             result = min_med(
                 imdrizSectionsList,
                 weightSectionsList,
-                readnoiseList,
-                exposureTimeList,
-                backgroundValueList,
+                [readnoiseList[i] for i in weight_stack],
+                [exposureTimeList[i] for i in weight_stack],
+                [backgroundValueList[i] for i in weight_stack],
                 weight_masks=weight_mask_list,
                 combine_grow=grow,
                 combine_nsigma1=nsigma1,
                 combine_nsigma2=nsigma2,
-                fillval=fillval
+                fillval=fillval,
+                nstack=nimages
             )
 
+        elif all([cdriz is not None, comb_type in ['median', 'mean'],
+                  lthresh is None, hthresh is None,
+                  imdrizSectionsList.dtype == np.float32,
+                  len(stack) - nlow - nhigh >= 1]):
+            # Same rejection rules as numcombine, in a single pass through
+            # the stack
+            result = cdriz.combine_stack(
+                imdrizSectionsList,
+                masks=weight_mask_list,
+                nlow=nlow,
+                nhigh=nhigh,
+                average=comb_type == 'mean'
+            )[0]
+
         else:  # DO NUMCOMBINE
             # Create the combined array object using the numcombine task
             result = numcombine.num_combine(
@@ -420,6 +594,17 @@ def _median(imageObjectList, paramDict):
         # Write out the processed image sections to the final output array:
         medianImageArray[e1+u1:e1+u2, :] = result[u1:u2, :]
 
+    if pool_size > 1:
+        pool = ThreadPool(pool_size)
+        try:
+            pool.map(combine_section, range(nsec), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for k in range(nsec):
+            combine_section(k)
+
     # Write out the combined image
     # use the header from the first single drizzled image in the list
     pf = _writeImage(medianImageArray, inputHeader=single_hdr)
@@ -441,14 +626,158 @@ def _median(imageObjectList, paramDict):
     # Always close any files opened to produce median image; namely,
     # single drizzle images and singly-drizzled weight images
     #
-    for img in singleDrizList:
-        if not virtual:
-            img.close()
-
-    # Close all singly drizzled weight images used to create median image.
-    for img in singleWeightList:
-        if not virtual:
-            img.close()
+    for img in openedList:
+        img.close()
+
+
+def _open_stack_image(filename, extnum, handle=None):
+    """ Open the data of a single drizzle product for reading sections of
+    rows from it.  Uncompressed products on disk get memory-mapped, once,
+    and the array is returned along with the HDU list to close once done.
+    Products held in memory (``handle``) are used as they are.  Compressed
+    products can not be memory-mapped and get read through an
+    `~stsci.tools.iterfile.IterFitsFile` instead.
+    """
+    if handle is not None:
+        return handle[extnum].data, None
+
+    hdulist = fits.open(filename, mode='readonly', memmap=True)
+    hdu = hdulist[extnum]
+    header = hdu.header
+    scaled = header.get('BSCALE', 1) != 1 or header.get('BZERO', 0) != 0
+    if isinstance(hdu, fits.CompImageHDU) or scaled:
+        hdulist.close()
+        image = iterfile.IterFitsFile('{:s}[{:d}]'.format(filename, extnum))
+        return image, image
+
+    return hdu.data, hdulist
+
+
+def _weighted_rows(weight, crop):
+    """ Return a boolean array flagging the rows of the full output frame
+    where a single drizzle weight image has any non-zero pixel.
+    """
+    rows = np.any(weight != 0, axis=1)
+    if crop is None:
+        return rows
+
+    (x0, y0), (frame_rows, frame_cols), cutout_shape, fill = crop
+    frame = np.zeros(frame_rows, dtype=bool)
+    frame[y0:y0 + rows.size] = rows
+    return frame
+
+
+def _section_stack(weight_rows, wht_mean, e1, e2, min_depth):
+    """ Return the indices of the images to stack for rows ``e1:e2``.
+
+    Images with zero weight over all of these rows have all their pixels
+    masked, and get left out, unless their mask threshold is zero.  Left
+    out images are added back, in order, until the stack is at least
+    ``min_depth`` images deep, which the rejection of low and high pixels
+    requires.
+    """
+    keep = [wht_mean[i] <= 0 or rows[e1:e2].any()
+            for i, rows in enumerate(weight_rows)]
+    missing = min_depth - sum(keep)
+    for i in range(len(keep)):
+        if missing <= 0:
+            break
+        if not keep[i]:
+            keep[i] = True
+            missing -= 1
+    return [i for i, k in enumerate(keep) if k]
+
+
+def _memory_budget(maxmem, reserved):
+    """ Return the memory, in bytes, for combining sections: half of the
+    available memory, or at most ``maxmem`` MB, less ``reserved`` bytes.
+    Return `None` when neither is known.
+    """
+    available = util.get_available_memory()
+    budget = None if available is None else available // 2
+    if maxmem is not None:
+        cap = int(maxmem * BUFSIZE)
+        budget = cap if budget is None else min(budget, cap)
+    if budget is None:
+        return None
+    return max(budget - reserved, 0)
+
+
+def _section_pixel_size(comb_type, nimages, nweights, itemsize, newmasks,
+                        thresholds, nbins):
+    """ Estimate the peak memory, in bytes, used for each pixel of a section
+    combined with ``comb_type``: the buffers holding the stack, the masks
+    and the temporaries of the combination itself.
+    """
+    if comb_type in ['amedian', 'aminmed']:
+        return approx_state_size(nbins) + itemsize * (1 + (nweights > 0))
+
+    size = itemsize * (nimages + nweights)
+    if newmasks and nweights:
+        # boolean and uint8 masks
+        size += 2 * nimages
+
+    if 'minmed' in comb_type:
+        if cdriz is not None and not comb_type.startswith('i'):
+            # boolean masks, and the float64 sums and tests of min_med
+            size += nimages + 160
+        else:
+            # copy of the stack, float64 background and readnoise cubes
+            size += 13 * nimages + 160
+    elif all([cdriz is not None, comb_type in ['median', 'mean'],
+              not thresholds]):
+        size += 32
+    else:
+        # boolean masks within numcombine
+        size += 2 * nimages + 8
+
+    return size
+
+
+def _get_crop(header):
+    """ Return the position ``(x0, y0)`` of a footprint-cropped single
+    drizzle product within the full output frame, the shape of that frame,
+    the shape of the cutout and the value of the frame pixels outside the
+    cutout, based on its header.  Returns None for full-frame products.
+    """
+    if 'CROPX0' not in header:
+        return None
+    return ((header['CROPX0'], header['CROPY0']),
+            (header['CROPNY'], header['CROPNX']),
+            (header['NAXIS2'], header['NAXIS1']),
+            header['CROPFILL'])
+
+
+def _uncrop_header(header, crop):
+    """ Return a copy of the header of a single drizzle product describing
+    the full output frame, even if the product was footprint-cropped.
+    """
+    header = header.copy()
+    if crop is not None:
+        (x0, y0), frame_shape, cutout_shape, fill = crop
+        header['CRPIX1'] += x0
+        header['CRPIX2'] += y0
+        for kw in ['CROPX0', 'CROPY0', 'CROPNX', 'CROPNY', 'CROPFILL']:
+            del header[kw]
+    return header
+
+
+def _read_section(image, crop, e1, e2, out, fill=None):
+    """ Copy rows ``e1:e2`` of the full output frame from a (possibly
+    footprint-cropped) single drizzle product into ``out``.  Frame pixels
+    outside the cutout get set to ``fill``, or to the fill value recorded in
+    the header of the product if not specified.
+    """
+    if crop is None:
+        out[:, :] = image[e1:e2]
+        return
+
+    (x0, y0), frame_shape, (ny, nx), crop_fill = crop
+    out.fill(crop_fill if fill is None else fill)
+    r1 = max(e1, y0)
+    r2 = min(e2, y0 + ny)
+    if r1 < r2:
+        out[r1 - e1:r2 - e1, x0:x0 + nx] = image[r1 - y0:r2 - y0]
 
 
 def _writeImage(dataArray=None, inputHeader=None):
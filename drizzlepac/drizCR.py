@@ -9,25 +9,26 @@ image and the derivative of the model image.
 """
 import os
 import re
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-from scipy import signal
 from astropy.io import fits
-from stsci.tools import fileutil, logutil, mputil, teal
+from stsci.tools import fileutil, logutil, teal
 
 
 from . import quickDeriv
 from . import util
 from . import processInput
 from . version import __version__, __version_date__
-if util.can_parallel:
-    import multiprocessing
 
 
 __taskname__ = "drizzlepac.drizCR"  # looks in drizzlepac for sky.cfg
 _STEP_NUM = 6  # this relates directly to the syntax in the cfg file
 
 
+# Number of pixels of the input images tested against the noise model at once
+_CR_BLOCK_SIZE = 256 * 1024
+
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
 
@@ -68,45 +69,68 @@ def rundrizCR(imgObjList, configObj, procSteps=None):
     log.info("USER INPUT PARAMETERS for Driz_CR Step:")
     util.printParams(paramDict, log=log)
 
+    # The chips of all images get processed by a pool of threads, as the
+    # array operations on them release the GIL.  The images themselves
+    # never need to be copied, so their cosmic ray masks get saved with
+    # them directly, whether working in memory or not.
+    image_chips = [(image, _get_cr_chips(image)) for image in imgObjList]
+    tasks = [(image, chip) for image, chips in image_chips for chip in chips]
+
     # if we have the cpus and s/w, ok, but still allow user to set pool size
-    pool_size = util.get_pool_size(configObj.get('num_cores'), len(imgObjList))
-    if imgObjList[0].inmemory:
-        pool_size = 1  # reason why is output in drizzle step
+    pool_size = util.get_pool_size(configObj.get('num_cores'), len(tasks))
 
-    subprocs = []
-    if pool_size > 1:
-        log.info('Executing {:d} parallel workers'.format(pool_size))
-        for image in imgObjList:
-            manager = multiprocessing.Manager()
-            mgr = manager.dict({})
-
-            p = multiprocessing.Process(
-                target=_driz_cr,
-                name='drizCR._driz_cr()',  # for err msgs
-                args=(image, mgr, paramDict.dict())
-            )
-            subprocs.append(p)
-            image.virtualOutputs.update(mgr)
-        mputil.launch_and_wait(subprocs, pool_size)  # blocks till all done
+    def driz_cr_task(task):
+        return _driz_cr(task[0], task[1], paramDict)
 
+    if pool_size > 1:
+        log.info('Executing {:d} parallel threads'.format(pool_size))
+        pool = ThreadPool(pool_size)
+        results = pool.imap(driz_cr_task, tasks)
     else:
         log.info('Executing serially')
-        for image in imgObjList:
-            _driz_cr(image, image.virtualOutputs, paramDict)
+        pool = None
+        results = map(driz_cr_task, tasks)
+
+    try:
+        # Results come back in order, so that each image gets its cosmic
+        # ray corrected file as soon as all of its chips are done
+        for image, chips in image_chips:
+            crcorr_list = []
+            for chip in chips:
+                cr_mask_dict, crcorr = next(results)
+                image.saveVirtualOutputs(cr_mask_dict)
+                if crcorr is not None:
+                    crcorr_list.append(crcorr)
+
+            if paramDict['driz_cr_corr']:
+                createCorrFile(image.outputNames["crcorImage"], crcorr_list,
+                               image._filename)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     if procSteps is not None:
         procSteps.endStep('Driz_CR')
 
 
-def _driz_cr(sciImage, virtual_outputs, paramDict):
+def _get_cr_chips(sciImage):
+    """ Return the numbers of the chips of ``sciImage`` to look for cosmic
+    rays in.
+    """
+    return [chip for chip in range(1, sciImage._numchips + 1, 1)
+            if sciImage[sciImage.scienceExt + ',' + str(chip)].group_member]
+
+
+def _driz_cr(sciImage, chip, paramDict):
     """mask blemishes in dithered data by comparison of an image
     with a model image and the derivative of the model image.
 
     - ``sciImage`` is an imageObject which contains the science data
     - ``blotImage`` is inferred from the ``sciImage`` object here which knows
         the name of its blotted image
-    - ``chip`` should be the science chip that corresponds to the blotted
-        image that was sent
+    - ``chip`` should be the number of the science chip that corresponds to
+        the blotted image
     - ``paramDict`` contains the user parameters derived from the full
         ``configObj`` instance
     - ``dqMask`` is inferred from the ``sciImage`` object, the name of the mask
@@ -128,173 +152,208 @@ def _driz_cr(sciImage, virtual_outputs, paramDict):
     so for example in ACS, there will be 1 image file with 2 chips that is
     the original image and 2 blotted image files, each with 1 chip
 
-    So I'm imagining calling this function twice, once for each chip,
-    but both times with the same original science image file, output files
-    and some input (output from previous steps) are referenced in the
-    imageobject itself
+    This function gets called once for each chip, with the same original
+    science image, which references the output files and some input (output
+    from previous steps).  It may be called for several chips at once from
+    separate threads.
+
+    The cosmic ray mask gets written out, unless working in memory. Returns
+    the in-memory cosmic ray mask to be saved with ``sciImage`` (if any),
+    and the arrays to be written to its cosmic ray corrected file (if
+    requested, or `None`).
 
     """
     grow = paramDict["driz_cr_grow"]
     ctegrow = paramDict["driz_cr_ctegrow"]
-    crcorr_list = []
     cr_mask_dict = {}
+    crcorr = None
 
-    for chip in range(1, sciImage._numchips + 1, 1):
-        exten = sciImage.scienceExt + ',' + str(chip)
-        sci_chip = sciImage[exten]
+    exten = sciImage.scienceExt + ',' + str(chip)
+    sci_chip = sciImage[exten]
 
-        if not sci_chip.group_member:
-            continue
+    blot_image_name = sci_chip.outputNames['blotImage']
 
-        blot_image_name = sci_chip.outputNames['blotImage']
-
-        if sciImage.inmemory:
-            blot_data = sciImage.virtualOutputs[blot_image_name][0].data
-        else:
-            if not os.path.isfile(blot_image_name):
-                raise IOError("Blotted image not found: {:s}"
-                              .format(blot_image_name))
-
-            try:
-                blot_data = fits.getdata(blot_image_name, ext=0)
-            except IOError:
-                print("Problem opening blot images")
-                raise
-        # Scale blot image, as needed, to match original input data units.
-        blot_data *= sci_chip._conversionFactor
-
-        input_image = sciImage.getData(exten)
-
-        # Apply any unit conversions to input image here for comparison
-        # with blotted image in units of electrons
-        input_image *= sci_chip._conversionFactor
-
-        # make the derivative blot image
-        blot_deriv = quickDeriv.qderiv(blot_data)
-
-        # Boolean mask needs to take into account any crbits values
-        # specified by the user to be ignored when converting DQ array.
-        dq_mask = sciImage.buildMask(chip, paramDict['crbit'])
-
-        # parse out the SNR information
-        snr1, snr2 = map(
-            float, filter(None, re.split("[,;\s]+", paramDict["driz_cr_snr"]))
+    if sciImage.inmemory:
+        blot_data = sciImage.virtualOutputs[blot_image_name][0].data
+    else:
+        if not os.path.isfile(blot_image_name):
+            raise IOError("Blotted image not found: {:s}"
+                          .format(blot_image_name))
+
+        try:
+            blot_data = fits.getdata(blot_image_name, ext=0)
+        except IOError:
+            print("Problem opening blot images")
+            raise
+    # Scale blot image, as needed, to match original input data units.
+    blot_data *= sci_chip._conversionFactor
+
+    input_image = sciImage.getData(exten)
+
+    # Apply any unit conversions to input image here for comparison
+    # with blotted image in units of electrons
+    input_image *= sci_chip._conversionFactor
+
+    # make the derivative blot image
+    blot_deriv = quickDeriv.qderiv(blot_data)
+
+    # Boolean mask needs to take into account any crbits values
+    # specified by the user to be ignored when converting DQ array.
+    dq_mask = sciImage.buildMask(chip, paramDict['crbit'])
+
+    # parse out the SNR information
+    snr1, snr2 = map(
+        float, filter(None, re.split("[,;\s]+", paramDict["driz_cr_snr"]))
+    )
+
+    # parse out the scaling information
+    mult1, mult2 = map(
+        float, filter(
+            None, re.split("[,;\s]+", paramDict["driz_cr_scale"])
         )
+    )
 
-        # parse out the scaling information
-        mult1, mult2 = map(
-            float, filter(
-                None, re.split("[,;\s]+", paramDict["driz_cr_scale"])
-            )
-        )
+    gain = sci_chip._effGain
+    rn = sci_chip._rdnoise
+    backg = sci_chip.subtractedSky * sci_chip._conversionFactor
 
-        gain = sci_chip._effGain
-        rn = sci_chip._rdnoise
-        backg = sci_chip.subtractedSky * sci_chip._conversionFactor
+    # Set scaling factor (used by MultiDrizzle) to 1 since scaling has
+    # already been accounted for in blotted image
+    # expmult = 1.
 
-        # Set scaling factor (used by MultiDrizzle) to 1 since scaling has
-        # already been accounted for in blotted image
-        # expmult = 1.
+    cr_mask = _cr_mask(input_image, blot_data, blot_deriv, gain, rn,
+                       backg, (snr1, snr2), (mult1, mult2), grow,
+                       ctegrow, sci_chip.cte_dir)
 
-        # #################   COMPUTATION PART I    ###################
-        # Create a temporary array mask
-        t1 = np.absolute(input_image - blot_data)
-        # ta = np.sqrt(gain * np.abs((blot_data + backg) * expmult) + rn**2)
-        ta = np.sqrt(gain * np.abs(blot_data + backg) + rn**2)
-        t2 = (mult1 * blot_deriv + snr1 * ta / gain)  # / expmult
-        tmp1 = t1 <= t2
-
-        # Create a convolution kernel that is 3 x 3 of 1's
-        kernel = np.ones((3, 3), dtype=np.uint16)
-        # Convolve the mask with the kernel
-        tmp2 = signal.convolve2d(tmp1, kernel, boundary='symm', mode='same')
-
-        # #################   COMPUTATION PART II    ###################
-        # Create the CR Mask
-        t2 = (mult2 * blot_deriv + snr2 * ta / gain)  # / expmult
-        cr_mask = (t1 <= t2) | (tmp2 >= 9)
-
-        # #################   COMPUTATION PART III    ##################
-        # flag additional cte 'radial' and 'tail' pixels surrounding CR pixels
-        # as CRs
-
-        # In both the 'radial' and 'length' kernels below, 0->good and 1->bad,
-        # so that upon convolving the kernels with cr_mask, the convolution
-        # output will have low->bad and high->good from which 2 new arrays are
-        # created having 0->bad and 1->good. These 2 new arrays are then
-        # 'anded' to create a new cr_mask.
-
-        # make radial convolution kernel and convolve it with original cr_mask
-        cr_grow_kernel = np.ones((grow, grow), dtype=np.uint16)
-        cr_grow_kernel_conv = signal.convolve2d(
-            cr_mask, cr_grow_kernel, boundary='symm', mode='same'
-        )
+    # Apply CR mask to the DQ array in place
+    dq_mask &= cr_mask
 
-        # make tail convolution kernel and convolve it with original cr_mask
-        cr_ctegrow_kernel = np.zeros((2 * ctegrow + 1, 2 * ctegrow + 1))
-
-        # which pixels are masked by tail kernel depends on sign of
-        # sci_chip.cte_dir (i.e.,readout direction):
-        if sci_chip.cte_dir == 1:
-            # 'positive' direction:  HRC: amp C or D; WFC: chip = sci,1; WFPC2
-            cr_ctegrow_kernel[0:ctegrow, ctegrow] = 1
-        elif sci_chip.cte_dir == -1:
-            # 'negative' direction:  HRC: amp A or B; WFC: chip = sci,2
-            cr_ctegrow_kernel[ctegrow+1:2*ctegrow+1, ctegrow] = 1
-
-        # do the convolution
-        cr_ctegrow_kernel_conv = signal.convolve2d(
-            cr_mask, cr_ctegrow_kernel, boundary='symm', mode='same'
-        )
+    # Create the corr file
+    if paramDict['driz_cr_corr']:
+        corrFile = np.where(dq_mask, input_image, blot_data)
+        corrFile /= sci_chip._conversionFactor
+        corrDQMask = np.where(dq_mask, 0,
+                              paramDict['crbit']).astype(np.uint16)
+        crcorr = {
+            'sciext': fileutil.parseExtn(exten),
+            'corrFile': corrFile,
+            'dqext': fileutil.parseExtn(sci_chip.dq_extn),
+            'dqMask': corrDQMask
+        }
+
+    # Save the cosmic ray mask file to disk
+    cr_mask_image = sci_chip.outputNames["crmaskImage"]
+    if paramDict['inmemory']:
+        print('Creating in-memory(virtual) FITS file...')
+        _pf = util.createFile(cr_mask.astype(np.uint8),
+                              outfile=None, header=None)
+        cr_mask_dict[cr_mask_image] = _pf
 
-        # select high pixels from both convolution outputs;
-        # then 'and' them to create new cr_mask
-        cr_grow_mask = cr_grow_kernel_conv >= grow**2  # radial
-        cr_ctegrow_mask = cr_ctegrow_kernel_conv >= ctegrow  # length
-        cr_mask = cr_grow_mask & cr_ctegrow_mask
+    else:
+        # Always write out crmaskimage, as it is required input for
+        # the final drizzle step. The final drizzle step combines this
+        # image with the DQ information on-the-fly.
+        #
+        # Remove the existing mask file if it exists
+        if os.path.isfile(cr_mask_image):
+            os.remove(cr_mask_image)
+            print("Removed old cosmic ray mask file: '{:s}'"
+                  .format(cr_mask_image))
+        print("Creating output: {:s}".format(cr_mask_image))
+        util.createFile(cr_mask.astype(np.uint8),
+                        outfile=cr_mask_image, header=None)
+
+    return cr_mask_dict, crcorr
+
+
+def _cr_mask(input_image, blot_data, blot_deriv, gain, rn, backg, snr,
+             scale, grow, ctegrow, cte_dir):
+    """ Return the mask of the pixels of ``input_image`` which are not
+    affected by cosmic rays (`True`), from its comparison with the blotted
+    median ``blot_data`` and the derivative ``blot_deriv`` of the latter.
+    ``snr`` and ``scale`` give the two signal-to-noise ratios and scaling
+    factors of the derivative for the two tests, ``grow`` the size of the
+    box around cosmic rays also masked, and ``ctegrow`` and ``cte_dir`` the
+    length and direction of the CTE tails masked after them.
+    """
+    snr1, snr2 = snr
+    mult1, mult2 = scale
+    ny, nx = input_image.shape
+
+    # #################   COMPUTATION PART I & II   ###################
+    # The noise model tests get done block of rows after block of rows,
+    # so only blocks of the intermediate arrays ever get allocated.  The
+    # pixels passing the first test (tmp1) need all of their neighbours
+    # to pass it as well, the others need to pass the second one.
+    tmp1 = np.empty((ny, nx), dtype=bool)
+    cr_mask = np.empty((ny, nx), dtype=bool)
+    nrows = max(1, _CR_BLOCK_SIZE // max(nx, 1))
+    for y1 in range(0, ny, nrows):
+        y2 = min(y1 + nrows, ny)
+        blot = blot_data[y1:y2]
+        deriv = blot_deriv[y1:y2]
+
+        t1 = np.absolute(input_image[y1:y2] - blot)
+        # ta = np.sqrt(gain * np.abs((blot_data + backg) * expmult) + rn**2)
+        ta = np.sqrt(gain * np.abs(blot + backg) + rn**2)
+        np.less_equal(t1, mult1 * deriv + snr1 * ta / gain,
+                      out=tmp1[y1:y2])  # / expmult
+        np.less_equal(t1, mult2 * deriv + snr2 * ta / gain,
+                      out=cr_mask[y1:y2])  # / expmult
+
+    # The 3 x 3 box of pixels around each pixel has to pass the first test
+    cr_mask |= _box_all(_box_all(tmp1, -1, 1, 0), -1, 1, 1)
+    del tmp1
+
+    # #################   COMPUTATION PART III    ##################
+    # flag additional cte 'radial' and 'tail' pixels surrounding CR pixels
+    # as CRs: pixels are only kept when the grow x grow box around them,
+    # and the tail of ctegrow pixels before them along the readout
+    # direction, have no cosmic ray.
+    lo = -(grow // 2)
+    hi = lo + grow - 1
+    cr_grow_mask = _box_all(_box_all(cr_mask, lo, hi, 0), lo, hi, 1)
+
+    # which pixels make the tail depends on sign of sci_chip.cte_dir
+    # (i.e.,readout direction)
+    if ctegrow <= 0:
+        return cr_grow_mask
+    if cte_dir == 1:
+        # 'positive' direction:  HRC: amp C or D; WFC: chip = sci,1; WFPC2
+        cr_grow_mask &= _box_all(cr_mask, 1, ctegrow, 0)
+    elif cte_dir == -1:
+        # 'negative' direction:  HRC: amp A or B; WFC: chip = sci,2
+        cr_grow_mask &= _box_all(cr_mask, -ctegrow, -1, 0)
+    else:
+        # No tail at all, which leaves no pixel with a long enough one
+        cr_grow_mask[...] = False
 
-        # Apply CR mask to the DQ array in place
-        dq_mask &= cr_mask
+    return cr_grow_mask
 
-        # Create the corr file
-        corrFile = np.where(dq_mask, input_image, blot_data)
-        corrFile /= sci_chip._conversionFactor
-        corrDQMask = np.where(dq_mask, 0, paramDict['crbit']).astype(np.uint16)
-
-        if paramDict['driz_cr_corr']:
-            crcorr_list.append({
-                'sciext': fileutil.parseExtn(exten),
-                'corrFile': corrFile.copy(),
-                'dqext': fileutil.parseExtn(sci_chip.dq_extn),
-                'dqMask': corrDQMask
-            })
-
-        # Save the cosmic ray mask file to disk
-        cr_mask_image = sci_chip.outputNames["crmaskImage"]
-        if paramDict['inmemory']:
-            print('Creating in-memory(virtual) FITS file...')
-            _pf = util.createFile(cr_mask.astype(np.uint8),
-                                  outfile=None, header=None)
-            cr_mask_dict[cr_mask_image] = _pf
-            sciImage.saveVirtualOutputs(cr_mask_dict)
 
+def _box_all(mask, lo, hi, axis):
+    """ Return whether all of the pixels of ``mask`` from ``lo`` to ``hi``
+    pixels (both included) away from each pixel along ``axis`` are set,
+    with the mask mirrored beyond its edges.  This is what thresholding the
+    convolution of ``mask`` with a box of ones (``boundary='symm'``) at the
+    size of the box would give, without computing the sums.
+    """
+    n = mask.shape[axis]
+    pad = [(0, 0)] * mask.ndim
+    pad[axis] = (max(0, -lo), max(0, hi))
+    padded = np.pad(mask, pad, mode='symmetric')
+
+    index = [slice(None)] * mask.ndim
+    result = None
+    for k in range(lo, hi + 1):
+        start = pad[axis][0] + k
+        index[axis] = slice(start, start + n)
+        if result is None:
+            result = padded[tuple(index)].copy()
         else:
-            # Always write out crmaskimage, as it is required input for
-            # the final drizzle step. The final drizzle step combines this
-            # image with the DQ information on-the-fly.
-            #
-            # Remove the existing mask file if it exists
-            if os.path.isfile(cr_mask_image):
-                os.remove(cr_mask_image)
-                print("Removed old cosmic ray mask file: '{:s}'"
-                      .format(cr_mask_image))
-            print("Creating output: {:s}".format(cr_mask_image))
-            util.createFile(cr_mask.astype(np.uint8),
-                            outfile=cr_mask_image, header=None)
+            result &= padded[tuple(index)]
 
-    if paramDict['driz_cr_corr']:
-        createCorrFile(sciImage.outputNames["crcorImage"], crcorr_list,
-                       sciImage._filename)
+    return result
 
 
 def createCorrFile(outfile, arrlist, template):
@@ -6,7 +6,7 @@ A class which makes image objects for each input filename.
 :License: :doc:`LICENSE`
 
 """
-import copy, os, re, sys
+import copy, glob, os, re, sys
 
 import numpy as np
 from stwcs import distortion
@@ -145,11 +145,17 @@ class baseImageObject:
             for fname in clean_files:
                 if fname in chip.outputNames:
                     util.removeFileSafely(chip.outputNames[fname])
+            if chip.outputNames.get('pixmap'):
+                for fname in glob.glob(chip.outputNames['pixmap'] + '_*.npy'):
+                    util.removeFileSafely(fname)
 
-    def getData(self,exten=None):
+    def getData(self,exten=None,attach=True):
         """ Return just the data array from the specified extension
             fileutil is used instead of fits to account for non-
             FITS input images. openImage returns a fits object.
+            When attach is False, the data array gets read from the
+            file without being attached to the extension, so that it
+            can be released as soon as the caller is done with it.
         """
         if exten.lower().find('sci') > -1:
             # For SCI extensions, the current file will have the data
@@ -164,6 +170,15 @@ class baseImageObject:
             fname = sci_chip.dqfile
 
         extnum = self._interpretExten(exten)
+        if not attach:
+            if not os.path.exists(fname):
+                return None
+            _image=fileutil.openImage(fname, clobber=False, memmap=False)
+            try:
+                return fileutil.getExtn(_image, extn=exten).data
+            finally:
+                _image.close()
+
         if self._image[extnum].data is None:
             if os.path.exists(fname):
                 _image=fileutil.openImage(fname, clobber=False, memmap=False)
@@ -403,6 +418,8 @@ class baseImageObject:
         fnames['finalMask']=sci_chip.dqrootname+'_final_mask.fits' # used by final_drizzle
         fnames['singleDrizMask']=fnames['finalMask'].replace('final','single')
         fnames['staticMask']=None
+        # Rootname of the sidecar files holding the pixel maps of this chip
+        fnames['pixmap'] = rootname + '_pixmap'
 
         # Add the following entries for use in creating outputImage object
         fnames['data'] = sci_chip.sciname
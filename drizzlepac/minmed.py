@@ -30,6 +30,11 @@ from scipy import signal
 from stsci.image.numcombine import numCombine, num_combine
 from .version import *
 
+try:
+    from . import cdriz
+except ImportError:
+    cdriz = None
+
 class minmed:
     """ **DEPRECATED** Create a median array, rejecting the highest pixel and
     computing the lowest valid pixel after mask application
@@ -348,7 +353,8 @@ class minmed:
 
 def min_med(images, weight_images, readnoise_list, exptime_list,
             background_values, weight_masks=None, combine_grow=1,
-            combine_nsigma1=4, combine_nsigma2=3, fillval=False):
+            combine_nsigma1=4, combine_nsigma2=3, fillval=False,
+            nstack=None):
     """ Create a median array, rejecting the highest pixel and
     computing the lowest valid pixel after mask application.
 
@@ -389,6 +395,12 @@ def min_med(images, weight_images, readnoise_list, exptime_list,
     fillval : bool
         Turn on use of imedian/imean. (Default: `False`)
 
+    nstack : int, None
+        Number of images in the whole stack, when images with zero weight
+        everywhere (and thus masked by ``weight_masks``) have been left out
+        of ``images``.  Not supported with ``fillval``.
+        (Default: `None`, all images of the stack are given)
+
     Returns
     -------
     combined_array : numpy.ndarray
@@ -417,6 +429,8 @@ def min_med(images, weight_images, readnoise_list, exptime_list,
     # median-pixel image, and compare with the minimum.
 
     nimages = len(images)
+    if nstack is None:
+        nstack = nimages
     combtype_median = 'imedian' if fillval else 'median'
     images = np.asarray(images)
     weight_images = np.asarray(weight_images)
@@ -431,101 +445,141 @@ def min_med(images, weight_images, readnoise_list, exptime_list,
         mask_sum = np.sum(weight_masks, axis=0, dtype=np.int16)
         all_bad_idx, all_bad_idy = np.where(mask_sum == nimages)
 
-    # Create a different median image based upon the number of images in the
-    # input list.
-    if nimages == 2:
-        median_file = num_combine(
+    # Scale the weight images by the background values to get the total
+    # effective background (in DN) per pixel.
+    s = np.asarray([bv / et for bv, et in
+                    zip(background_values, exptime_list)])
+
+    if (cdriz is not None and not fillval and images.dtype == np.float32 and
+            weight_images.dtype == np.float32):
+        # Go through the stack only once: the compiled engine gathers the
+        # good pixels of each position and computes the median (or mean, for
+        # two images) rejecting the highest one, the minimum and the sums of
+        # the weights, following the rules of num_combine.  When a single
+        # pixel is left, it is its own median, as the code below arranges.
+        (median_file, minimum_file, _, weight_file, bkgd_file,
+         readnoise_file) = cdriz.combine_stack(
             images,
-            masks=weight_masks,
-            combination_type='imean' if fillval else 'mean',
-            nlow=0, nhigh=0, lower=None, upper=None
+            weight_images,
+            masks=(None if weight_masks is None else
+                   weight_masks.view(np.uint8)),
+            nlow=0,
+            nhigh=0 if nstack == 2 else 1,
+            average=nstack == 2,
+            bkgscale=s,
+            rdnoise2=(None if weight_masks is None else
+                      np.asarray(readnoise_list, dtype=np.float64)**2)
         )
+        if weight_masks is None:
+            rdn2 = sum((r**2 for r in readnoise_list))
+            readnoise_file = rdn2 * np.ones_like(images[0])
 
     else:
-        # The value of NHIGH=1 will cause problems when there is only 1 valid
-        # unmasked input image for that pixel due to a difference in behavior
-        # between 'num_combine' and 'iraf.imcombine'.
-        # This value may need to be adjusted on the fly based on the number of
-        # inputs and the number of masked values/pixel.
-        #
-        median_file = num_combine(
-            images,
-            masks=weight_masks,
-            combination_type=combtype_median,
-            nlow=0, nhigh=1, lower=None, upper=None
-        )
+        # Create a different median image based upon the number of images in
+        # the input list.
+        if nstack == 2:
+            median_file = num_combine(
+                images,
+                masks=weight_masks,
+                combination_type='imean' if fillval else 'mean',
+                nlow=0, nhigh=0, lower=None, upper=None
+            )
 
-        # The following section of code will address the problem caused by
-        # having a value of nhigh = 1.  This will behave in a way similar to
-        # the way the IRAF task IMCOMBINE behaves.  In order to accomplish
-        # this, the following procedure will be followed:
-        # 1) The input masks will be summed.
-        # 2) The science data will be summed.
-        # 3) In the locations of the summed mask where the sum is 1 less than
-        #    the total number of images, the value of that location in the
-        #    summed science image will be used to replace the existing value
-        #    in the existing median_file.
-        #
-        # This procedure is being used to prevent too much data from being
-        # thrown out of the image. Take for example the case of 3 input images.
-        # In two of the images the pixel locations have been masked out.
-        # Now, if nhigh is applied there will be no value to use for that
-        # position.  However, if this new procedure is used that value in
-        # the resulting images will be the value that was rejected by the
-        # nhigh rejection step.
-
-        # We need to make certain that "bad" pixels in the sci data are set to
-        # 0. That way, when the sci images are summed, the value of the sum
-        # will only come from the "good" pixels.
+        else:
+            # The value of NHIGH=1 will cause problems when there is only 1
+            # valid unmasked input image for that pixel due to a difference in
+            # behavior between 'num_combine' and 'iraf.imcombine'. This value
+            # may need to be adjusted on the fly based on the number of inputs
+            # and the number of masked values/pixel.
+            #
+            median_file = num_combine(
+                images,
+                masks=weight_masks,
+                combination_type=combtype_median,
+                nlow=0, nhigh=1, lower=None, upper=None
+            )
+
+            # The following section of code will address the problem caused by
+            # having a value of nhigh = 1.  This will behave in a way similar
+            # to the way the IRAF task IMCOMBINE behaves.  In order to
+            # accomplish this, the following procedure will be followed:
+            # 1) The input masks will be summed.
+            # 2) The science data will be summed.
+            # 3) In the locations of the summed mask where the sum is 1 less
+            #    than the total number of images, the value of that location in
+            #    the summed science image will be used to replace the existing
+            #    value in the existing median_file.
+            #
+            # This procedure is being used to prevent too much data from being
+            # thrown out of the image. Take for example the case of 3 input
+            # images. In two of the images the pixel locations have been masked
+            # out. Now, if nhigh is applied there will be no value to use for
+            # that position.  However, if this new procedure is used that value
+            # in the resulting images will be the value that was rejected by
+            # the nhigh rejection step.
+
+            # We need to make certain that "bad" pixels in the sci data are set
+            # to 0. That way, when the sci images are summed, the value of the
+            # sum will only come from the "good" pixels.
+            if weight_masks is None:
+                sci_sum = np.sum(images, axis=0)
+                if nimages == 1:
+                    median_file = sci_sum
+
+            else:
+                sci_sum = np.sum(images * np.logical_not(weight_masks), axis=0)
+                # Use the summed sci image values in locations where the
+                # mask_sum indicates that there is only 1 good pixel to use.
+                # The value will be used in the median_file image
+                idx = np.where(mask_sum == (nimages - 1))
+                median_file[idx] = sci_sum[idx]
+
+        # Create the minimum image from the stack of input images.
+        if weight_masks is not None:
+            # make a copy of images to avoid side-effect of modifying input
+            # argument:
+            images = images.copy()
+            images[weight_masks] = np.nan
+            images[:, all_bad_idx, all_bad_idy] = 0
+            minimum_file = np.nanmin(images, axis=0)
+        else:
+            minimum_file = np.amin(images, axis=0)
+
+        # Create an image of the total effective background (in DN) per pixel:
+        # (which is the sum of all the background-scaled weight files)
+        bkgd_file = np.sum(weight_images * s[:, None, None], axis=0)
+
+        # Scale the weight mask images by the square of the readnoise values.
+        # Create an image of the total readnoise**2 per pixel
+        # (which is the sum of all the input readnoise values).
         if weight_masks is None:
-            sci_sum = np.sum(images, axis=0)
-            if nimages == 1:
-                median_file = sci_sum
+            rdn2 = sum((r**2 for r in readnoise_list))
+            readnoise_file = rdn2 * np.ones_like(images[0])
 
         else:
-            sci_sum = np.sum(images * np.logical_not(weight_masks), axis=0)
-            # Use the summed sci image values in locations where the mask_sum
-            # indicates that there is only 1 good pixel to use. The value will
-            # be used in the median_file image
-            idx = np.where(mask_sum == (nimages - 1))
-            median_file[idx] = sci_sum[idx]
-
-    # Create the minimum image from the stack of input images.
-    if weight_masks is not None:
-        # make a copy of images to avoid side-effect of modifying input
-        # argument:
-        images = images.copy()
-        images[weight_masks] = np.nan
-        images[:, all_bad_idx, all_bad_idy] = 0
-        minimum_file = np.nanmin(images, axis=0)
-    else:
-        minimum_file = np.amin(images, axis=0)
+            readnoise_file = np.sum(
+                np.logical_not(weight_masks) *
+                (np.asarray(readnoise_list)**2)[:, None, None],
+                axis=0
+            )
 
-    # Scale the weight images by the background values and add them to the bk
-    # Create an image of the total effective background (in DN) per pixel:
-    # (which is the sum of all the background-scaled weight files)
-    s = np.asarray([bv / et for bv, et in
-                    zip(background_values, exptime_list)])
-    bkgd_file = np.sum(weight_images * s[:, None, None], axis=0)
+        # Create an image of the total effective exposure time per pixel:
+        # (which is simply the sum of all the drizzle output weight files)
+        weight_file = np.sum(weight_images, axis=0)
 
-    # Scale the weight mask images by the square of the readnoise values.
-    # Create an image of the total readnoise**2 per pixel
-    # (which is the sum of all the input readnoise values).
-    if weight_masks is None:
-        rdn2 = sum((r**2 for r in readnoise_list))
-        readnoise_file = rdn2 * np.ones_like(images[0])
+    return _min_or_median(median_file, minimum_file, weight_file, bkgd_file,
+                          readnoise_file, (all_bad_idx, all_bad_idy),
+                          combine_grow, combine_nsigma1, combine_nsigma2)
 
-    else:
-        readnoise_file = np.sum(
-            np.logical_not(weight_masks) *
-            (np.asarray(readnoise_list)**2)[:, None, None],
-            axis=0
-        )
 
-    # Create an image of the total effective exposure time per pixel:
-    # (which is simply the sum of all the drizzle output weight files)
-    weight_file = np.sum(weight_images, axis=0)
+def _min_or_median(median_file, minimum_file, weight_file, bkgd_file,
+                   readnoise_file, all_bad, combine_grow, combine_nsigma1,
+                   combine_nsigma2):
+    """ Choose between the minimum and the median of a stack, pixel by pixel,
+    from the sums computed by `min_med`. ``all_bad`` are the indices of the
+    pixels masked in all images, which get set to 0.
 
+    """
     # Scale up both the median and minimum arrays by the total effective
     # exposure time per pixel.
     minimum_file_weighted = minimum_file * weight_file
@@ -576,7 +630,7 @@ def min_med(images, weight_images, readnoise_list, exptime_list,
         # column in the MDRIZTAB should also be an integer type.
         boxsize = int(2 * combine_grow + 1)
         boxshape = (boxsize, boxsize)
-        minimum_grow_file = np.zeros_like(images[0])
+        minimum_grow_file = np.zeros_like(median_file)
 
         # If the boxcar convolution has failed it is potentially for
         # two reasons:
@@ -596,7 +650,7 @@ def min_med(images, weight_images, readnoise_list, exptime_list,
             errormsg1 += "############################################################\n"
             raise ValueError(errormsg1)
 
-        if boxsize > images.shape[1]:
+        if boxsize > median_file.shape[0]:
             errormsg2 = "############################################################\n"
             errormsg2 += "# The boxcar convolution in minmed has failed.  The 'grow' #\n"
             errormsg2 += "# parameter specified has resulted in a boxcar kernel that #\n"
@@ -604,7 +658,7 @@ def min_med(images, weight_images, readnoise_list, exptime_list,
             errormsg2 += "# specified an input value for the 'grow' parameter of:    #\n"
             errormsg2 += "        combine_grow: " + str(combine_grow) + '\n'
             errormsg2 += "############################################################\n"
-            print(images.shape[1:])
+            print(median_file.shape)
             raise ValueError(errormsg2)
 
         # Attempt the boxcar convolution using the boxshape based upon the user
@@ -628,6 +682,296 @@ def min_med(images, weight_images, readnoise_list, exptime_list,
         median_file
     )
     # Set fill regions to a pixel value of 0.
-    combined_array[all_bad_idx, all_bad_idy] = 0
+    combined_array[all_bad] = 0
 
     return combined_array
+
+
+def approx_state_size(nbins):
+    """ Approximate number of bytes used per pixel by `approx_median` and
+    `approx_min_med` with ``nbins`` histogram bins.
+
+    """
+    # 16-bit bin counts, a boolean temporary per bin and the running
+    # statistics of each pixel
+    return 3 * nbins + 256
+
+
+def approx_median(read_image, nimages, weight_thresholds=None, nlow=0,
+                  nhigh=0, lower=None, upper=None, nbins=100):
+    """ Approximate median of a stack of images, read one image at a time.
+
+    The stack is read three times, so that the memory needed does not depend
+    on the number of images.  The first pass gathers the number, mean,
+    standard deviation, minimum and maximum of the good pixels at each
+    position.  Together, these bound the range of values that can hold the
+    median (after rejecting the ``nlow`` lowest and ``nhigh`` highest good
+    pixels, with the same rules as ``num_combine``).  The second pass counts
+    the good pixels in ``nbins`` bins over that range, and the third one in
+    ``nbins`` bins over the bin holding the median.  The median is taken at
+    the center of the final bin.
+
+    The error is thus at most half a bin of the second pass.  For a median
+    without rejection, the first range is at most two standard deviations
+    of the good pixels wide, so that the error is within ``1 / nbins**2`` of
+    their standard deviation.  The median is exact where it is the lowest or
+    highest good pixel.
+
+    Parameters
+    ----------
+    read_image : callable
+        Function returning the image of the stack with the given index, and
+        its weight image (or `None`), as 2D arrays of the same shape.
+
+    nimages : int
+        Number of images in the stack.
+
+    weight_thresholds : list of float, None
+        Pixels with a weight lower than the threshold of their image are
+        masked. (Default: `None`, no pixel masked by weight)
+
+    nlow : int
+        Number of low pixels to reject. (Default: 0)
+
+    nhigh : int
+        Number of high pixels to reject. (Default: 0)
+
+    lower : float, None
+        Pixels with values below ``lower`` are masked. (Default: `None`)
+
+    upper : float, None
+        Pixels with values at or above ``upper`` are masked.
+        (Default: `None`)
+
+    nbins : int
+        Number of histogram bins. (Default: 100)
+
+    Returns
+    -------
+    median : numpy.ndarray
+        Approximate median, 0 where all pixels are masked.
+
+    """
+    return _stream_stack(read_image, nimages, weight_thresholds, nlow, nhigh,
+                         lower, upper, nbins)[0]
+
+
+def approx_min_med(read_image, nimages, readnoise_list, exptime_list,
+                   background_values, weight_thresholds=None, combine_grow=1,
+                   combine_nsigma1=4, combine_nsigma2=3, nbins=100,
+                   nstack=None):
+    """ Same as `min_med`, but with the median computed by `approx_median`
+    while reading the stack one image at a time.
+
+    Parameters
+    ----------
+    read_image : callable
+        Function returning the image of the stack with the given index and
+        its weight image, as 2D arrays of the same shape.
+
+    nimages : int
+        Number of images in the stack.
+
+    readnoise_list : list
+        List of readnoise values to use for the input images.
+
+    exptime_list : list
+        List of exposure times to use for the input images.
+
+    background_values : list
+        List of image background values to use for the input images.
+
+    weight_thresholds : list of float, None
+        Pixels with a weight lower than the threshold of their image are
+        masked. (Default: `None`, no pixel masked)
+
+    combine_grow : int
+        Radius (pixels) for neighbor rejection. (Default: 1)
+
+    combine_nsigma1 : float
+        Significance for accepting minimum instead of median. (Default: 4)
+
+    combine_nsigma2 : float
+        Significance for accepting minimum instead of median. (Default: 3)
+
+    nbins : int
+        Number of histogram bins used by `approx_median`. (Default: 100)
+
+    nstack : int, None
+        Number of images in the whole stack, as for `min_med`.
+        (Default: `None`, all images of the stack are given)
+
+    Returns
+    -------
+    combined_array : numpy.ndarray
+        Combined array.
+
+    """
+    if nstack is None:
+        nstack = nimages
+    s = np.asarray([bv / et for bv, et in
+                    zip(background_values, exptime_list)])
+    rdnoise2 = np.asarray(readnoise_list, dtype=np.float64)**2
+
+    # The mean of two images is computed exactly from the first pass
+    (median_file, minimum_file, ngood, weight_file, bkgd_file,
+     readnoise_file) = _stream_stack(
+        read_image, nimages, weight_thresholds, 0, 0 if nstack == 2 else 1,
+        None, None, nbins, average=nstack == 2, bkgd_scale=s,
+        rdnoise2=rdnoise2
+    )
+
+    if weight_thresholds is None:
+        readnoise_file = rdnoise2.sum() * np.ones_like(median_file)
+        all_bad = (np.array([], dtype=int), np.array([], dtype=int))
+    else:
+        all_bad = np.where(ngood == 0)
+
+    return _min_or_median(median_file, minimum_file, weight_file, bkgd_file,
+                          readnoise_file, all_bad, combine_grow,
+                          combine_nsigma1, combine_nsigma2)
+
+
+def _stream_stack(read_image, nimages, weight_thresholds, nlow, nhigh, lower,
+                  upper, nbins, average=False, bkgd_scale=None, rdnoise2=None):
+    """ Compute the approximate median (or the mean), the minimum, the number
+    of good pixels and the sums of the weights of a stack read one image at
+    a time.  See `approx_median`.
+
+    """
+    def good_pixels(i):
+        sci, wht = read_image(i)
+        good = np.ones(sci.shape, dtype=bool)
+        if weight_thresholds is not None:
+            good &= np.logical_not(np.less(wht, weight_thresholds[i]))
+        if lower is not None:
+            good &= np.logical_not(np.less(sci, lower))
+        if upper is not None:
+            good &= np.less(sci, upper)
+        return sci, wht, good
+
+    # First pass: running statistics of the good pixels
+    count = None
+    for i in range(nimages):
+        sci, wht, good = good_pixels(i)
+        if count is None:
+            shape = sci.shape
+            dtype = sci.dtype
+            count = np.zeros(shape, dtype=np.int32)
+            mean = np.zeros(shape, dtype=np.float64)
+            m2 = np.zeros(shape, dtype=np.float64)
+            minimum = np.full(shape, np.inf, dtype=np.float64)
+            maximum = np.full(shape, -np.inf, dtype=np.float64)
+            weight_file = None if wht is None else np.zeros(shape, wht.dtype)
+            bkgd_file = None if bkgd_scale is None else np.zeros(shape)
+            readnoise_file = None if rdnoise2 is None else np.zeros(shape)
+            delta = np.empty(shape, dtype=np.float64)
+
+        if weight_file is not None:
+            weight_file += wht
+            if bkgd_file is not None:
+                bkgd_file += wht.astype(np.float64) * bkgd_scale[i]
+        if readnoise_file is not None:
+            readnoise_file += good * rdnoise2[i]
+
+        # Welford's update of the mean and of the sum of squared deviations
+        count += good
+        np.subtract(sci, mean, out=delta)
+        np.add(mean, delta / np.maximum(count, 1), out=mean, where=good)
+        np.add(m2, delta * (sci - mean), out=m2, where=good)
+        np.fmin(minimum, sci, out=minimum, where=good)
+        np.fmax(maximum, sci, out=maximum, where=good)
+    del delta
+
+    empty = count == 0
+    minimum[empty] = 0
+    maximum[empty] = 0
+
+    if average:
+        median = mean
+    else:
+        # Numbers of rejected pixels, reduced as num_combine does when they
+        # would leave no pixel
+        nl = np.full(shape, nlow, dtype=np.int32)
+        nh = np.full(shape, nhigh, dtype=np.int32)
+        for _ in range(nlow + nhigh):
+            shrink = (nl + nh >= count) & ~empty
+            nh[shrink & (nh > 0)] -= 1
+            nl[shrink & (nl > 0)] -= 1
+        nmed = count - nl - nh
+        khi = nl + nmed // 2
+        klo = khi - 1 + nmed % 2
+        del nl, nh
+
+        # Range of values holding the ranks klo to khi, from Cantelli's
+        # inequality: x[k] lies within mean - std * sqrt((n - k - 1) / (k + 1))
+        # and mean + std * sqrt(k / (n - k)).
+        n = np.maximum(count, 1)
+        std = np.sqrt(m2 / n)
+        del m2
+        lo = np.fmax(minimum, mean - std * np.sqrt(np.maximum(n - klo - 1, 0) /
+                                                   (np.maximum(klo, 0) + 1)))
+        hi = np.fmin(maximum, mean + std * np.sqrt(np.maximum(khi, 0) /
+                                                   np.maximum(n - khi, 1)))
+        hi = np.fmax(hi, lo)
+        del std, n
+        # Count the good pixels below the range and within each of its bins,
+        # then narrow the range down to the bin holding khi and count again.
+        # Pixels of rank klo left below that bin are the highest ones there.
+        klo = klo.ravel()
+        khi = khi.ravel()
+        lo = lo.ravel()
+        hi = hi.ravel()
+        below = np.empty(lo.size, dtype=np.int32)
+        below_max = np.full(lo.size, -np.inf)
+        counts = np.empty((nbins, lo.size),
+                          dtype=np.uint16 if nimages < 2**16 else np.uint32)
+        for npass in range(2):
+            width = (hi - lo) / nbins
+            with np.errstate(divide='ignore'):
+                scale = np.where(width > 0, 1.0 / width, 0.0)
+
+            below.fill(0)
+            counts.fill(0)
+            for i in range(nimages):
+                sci, _, good = good_pixels(i)
+                sci = sci.ravel()
+                good = good.ravel()
+                is_below = good & (sci < lo)
+                below += is_below
+                if npass == 1:
+                    np.fmax(below_max, sci, out=below_max, where=is_below)
+                inside = np.flatnonzero(good & (sci >= lo) & (sci <= hi))
+                ibin = ((sci[inside] - lo[inside]) *
+                        scale[inside]).astype(np.intp)
+                np.minimum(ibin, nbins - 1, out=ibin)
+                counts[ibin, inside] += 1
+            np.cumsum(counts, axis=0, out=counts)
+
+            # Bins holding the pixels of ranks klo and khi
+            blo = np.minimum(np.sum(counts <= klo - below, axis=0), nbins - 1)
+            bhi = np.minimum(np.sum(counts <= khi - below, axis=0), nbins - 1)
+            if npass == 0:
+                hi = np.fmin(hi, lo + (bhi + 1) * width)
+                lo = lo + bhi * width
+
+        def order_statistic(k, ibin):
+            # Center of the bin holding the pixel of rank k, or the minimum
+            # or maximum themselves
+            value = np.clip(lo + (ibin + 0.5) * width, lo, hi).reshape(shape)
+            value = np.where(k == 0, minimum, value)
+            return np.where(k == count - 1, maximum, value)
+
+        klo = klo.reshape(shape)
+        khi = khi.reshape(shape)
+        median = order_statistic(khi, bhi)
+        even = nmed % 2 == 0
+        if even.any():
+            lower_median = np.where((klo.ravel() < below).reshape(shape),
+                                    below_max.reshape(shape),
+                                    order_statistic(klo, blo))
+            median = np.where(even, (median + lower_median) / 2, median)
+        median[nmed <= 0] = 0
+
+    return (median.astype(dtype), minimum.astype(dtype), count, weight_file,
+            bkgd_file, readnoise_file)
@@ -12,6 +12,7 @@ from stsci.tools import fileutil, readgeis, logutil
 from . import wcs_functions
 from . import version
 from . import updatehdr
+from . import sparsecontext
 
 from fitsblender import blendheaders
 
@@ -103,6 +104,7 @@ class OutputImage:
         self.bunit = None
         self.units = 'cps'
         self.blot = blot
+        self.crop = None
 
         if PYFITS_COMPRESSION and 'compress' in input_pars:
             self.compress = input_pars['compress'] # Control creation of compressed FITS files
@@ -171,14 +173,27 @@ class OutputImage:
         """
         self.units = units
 
+    def set_crop(self, x0, y0, shape, fill):
+        """
+        Method used to record that the output arrays are a cutout starting at
+        the (0-based) pixel (x0,y0) of an output frame of the given shape,
+        with all pixels of that frame outside the cutout set to 'fill'.
+        """
+        self.crop = (x0, y0, shape, fill)
+
     def writeFITS(self, template, sciarr, whtarr, ctxarr=None,
-                versions=None, overwrite=yes, blend=True, virtual=False):
+                versions=None, overwrite=yes, blend=True, virtual=False,
+                ctxruns=None):
         """
         Generate PyFITS objects for each output extension
         using the file given by 'template' for populating
         headers.
 
         The arrays will have the size specified by 'shape'.
+
+        When ``ctxruns`` is given, the context gets written out as the
+        compact table of runs described in :py:mod:`drizzlepac.sparsecontext`
+        instead of from ``ctxarr``.
         """
         if not isinstance(template, list):
             template = [template]
@@ -297,6 +312,9 @@ class OutputImage:
         if not self.blot:
             self.addDrizKeywords(prihdu.header,versions)
 
+        if self.crop is not None:
+            self.addCropKeywords(prihdu.header)
+
         if scihdr:
             try:
                 del scihdr['OBJECT']
@@ -380,15 +398,21 @@ class OutputImage:
             else:
                 _ctxarr = None
 
-            if self.single and self.compress:
+            sparse_ctx = self.outcontext and ctxruns is not None
+            if sparse_ctx:
+                # Compact context, as a table of runs without any WCS
+                hdu = sparsecontext.build_table_hdu(ctxruns, sciarr.shape)
+                hdu.header.set('EXTVER', value=1, after='EXTNAME')
+            elif self.single and self.compress:
                 hdu = fits.CompImageHDU(data=_ctxarr, header=dqhdr, name=EXTLIST[2])
             else:
                 hdu = fits.ImageHDU(data=_ctxarr, header=dqhdr, name=EXTLIST[2])
-            last_kw = self.find_kwupdate_location(dqhdr,'EXTNAME')
-            hdu.header.set('EXTNAME', value='CTX', after=last_kw)
-            hdu.header.set('EXTVER', value=1, after='EXTNAME')
+            if not sparse_ctx:
+                last_kw = self.find_kwupdate_location(dqhdr,'EXTNAME')
+                hdu.header.set('EXTNAME', value='CTX', after=last_kw)
+                hdu.header.set('EXTVER', value=1, after='EXTNAME')
 
-            if self.wcs:
+            if self.wcs and not sparse_ctx:
                 pre_wcs_kw = self.find_kwupdate_location(hdu.header,'CD1_1')
                 # Update WCS Keywords based on PyDrizzle product's value
                 # since 'drizzle' itself doesn't update that keyword.
@@ -508,7 +532,25 @@ class OutputImage:
 
             # If a context image was specified, build a PyFITS object
             # for it as well...
-            if self.outcontext and ctxarr is not None:
+            if self.outcontext and ctxruns is not None:
+                # Compact context: a table of runs following a dataless
+                # primary header
+                fctx = fits.HDUList()
+                hdu = fits.PrimaryHDU(header=prihdu.header.copy())
+                hdu.header['filename'] = self.outcontext
+                fctx.append(hdu)
+                fctx.append(sparsecontext.build_table_hdu(ctxruns,
+                                                          sciarr.shape))
+                if not virtual:
+                    print('Writing out image to disk:',self.outcontext)
+                    fctx.writeto(self.outcontext)
+                    del fctx,hdu
+                    fctx = None
+                # End 'if not virtual'
+
+                outputFITS[self.outcontext]= fctx
+
+            elif self.outcontext and ctxarr is not None:
                 fctx = fits.HDUList()
 
                 # If there is only 1 plane, write it out as a 2-D extension
@@ -585,6 +627,17 @@ class OutputImage:
         return last_kw
 
 
+    def addCropKeywords(self, hdr):
+        """ Add keywords describing where a footprint-cropped product
+        fits within the full output frame.
+        """
+        x0, y0, shape, fill = self.crop
+        hdr['CROPX0'] = (x0, 'X offset of cutout in full output frame')
+        hdr['CROPY0'] = (y0, 'Y offset of cutout in full output frame')
+        hdr['CROPNX'] = (shape[1], 'X size of full output frame')
+        hdr['CROPNY'] = (shape[0], 'Y size of full output frame')
+        hdr['CROPFILL'] = (fill, 'Value of full frame pixels outside cutout')
+
     def addDrizKeywords(self,hdr,versions):
         """ Add drizzle parameter keywords to header. """
 
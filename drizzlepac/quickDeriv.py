@@ -11,63 +11,102 @@ IS RETURNED BY :py:func:`quickderiv`.
 #
 # VERSION:
 #   Version 0.1.0: created -- CJH
+#   Version 0.2.0: computed in place, block of rows after block of rows
 #
 import numpy as np
 from .version import *
 
-def qderiv(array): # TAKE THE ABSOLUTE DERIVATIVE OF A NUMARRY OBJECT
-    """Take the absolute derivate of an image in memory."""
-
-    #Create 2 empty arrays in memory of the same dimensions as 'array'
-    tmpArray = np.zeros(array.shape,dtype=np.float64)
-    outArray = np.zeros(array.shape, dtype=np.float64)
-
-    # Get the length of an array side
-    (naxis1,naxis2) = array.shape
-    #print "The input image size is (",naxis1,",",naxis2,")."
-
-#Main derivate loop:
-    #Shift images +/- 1 in Y.
-    for y in range(-1,2,2):
-        if y == -1:
-            #shift input image 1 pixel right
-            tmpArray[0:(naxis1-1),1:(naxis2-1)] = array[0:(naxis1-1),0:(naxis2-2)]
-            #print "Y shift = 1"
-        else:
-            #shift input image 1 pixel left
-            tmpArray[0:(naxis1-1),0:(naxis2-2)] = array[0:(naxis1-1),1:(naxis2-1)]
-            #print "Y shift = -1"
-        #print "call _absoluteSubtract()"
-        (tmpArray,outArray) = _absoluteSubtract(array,tmpArray,outArray)
-
-    #Shift images +/- 1 in X.
-    for x in range(-1,2,2):
-        if x == -1:
-            #shift input image 1 pixel right
-            tmpArray[1:(naxis1-1),0:(naxis2-1)] = array[0:(naxis1-2),0:(naxis2-1)]
-            #print "X shift = 1"
-        else:
-            #shift input image 1 pixel left
-            tmpArray[0:(naxis1-2),0:(naxis2-1)] = array[1:(naxis1-1),0:(naxis2-1)]
-            #print "X shift = -1"
-        #print "call _absoluteSubtract()"
-        (tmpArray,outArray) = _absoluteSubtract(array,tmpArray,outArray)
-
-
-
-    return outArray.astype(np.float32)
-
-
-def _absoluteSubtract(array,tmpArray,outArray):
-    #subtract shifted image from imput image
-    tmpArray = array - tmpArray
-    #take the absolute value of tmpArray
-    tmpArray = np.fabs(tmpArray)
-    #save maximum value of outArray or tmpArray and save in outArray
-    outArray = np.maximum(tmpArray,outArray)
-    #zero out tmpArray before reuse
-    tmpArray = tmpArray * 0.
-
-    return (tmpArray,outArray)
+# Number of pixels of the blocks of rows processed at once.
+_BLOCK_SIZE = 256 * 1024
+
+
+def qderiv(array, out=None, dtype=None):
+    """ Take the absolute derivate of an image in memory.
+
+    Each pixel gets the largest absolute difference with its four
+    neighbours, computed in ``dtype`` (or the type of ``out``) block of
+    rows after block of rows, so that no full size temporary gets
+    allocated.  The last row and column of the image, as well as the
+    neighbours falling off the rest of it, get compared with zero.
+
+    Parameters
+    ----------
+    array : 2D array
+        Input image.
+
+    out : 2D array, optional
+        Array of the same shape as ``array`` in which to store the result.
+        A new one gets allocated when not provided.
+
+    dtype : data-type, optional
+        Type of the computation and of the array returned when ``out`` is
+        not provided: that of ``array``, but at least single precision,
+        by default.
+
+    Returns
+    -------
+    out : 2D array
+        Absolute derivative of ``array``.
+
+    """
+    array = np.asarray(array)
+    if out is None:
+        if dtype is None:
+            dtype = np.result_type(array, np.float32)
+        out = np.empty(array.shape, dtype=dtype)
+    elif out.shape != array.shape:
+        raise ValueError("Output array must have the same shape as the input "
+                         "array.")
+    dtype = out.dtype
+
+    # The last row and column only get compared with zero.
+    np.abs(array, out=out, dtype=dtype)
+    ny = array.shape[0] - 1
+    nx = array.shape[1] - 1
+    if ny < 1 or nx < 1:
+        return out
+    data = array[:ny, :nx]
+    deriv = out[:ny, :nx]
+
+    nrows = max(1, _BLOCK_SIZE // nx)
+    tmp = np.empty((min(nrows + 1, ny), nx), dtype=dtype)
+    for y1 in range(0, ny, nrows):
+        y2 = min(y1 + nrows, ny)
+        block = data[y1:y2]
+        dblock = deriv[y1:y2]
+
+        # Differences with the neighbours along the rows.  The first and
+        # last columns keep their absolute value for the missing ones.
+        diff = tmp[:y2 - y1, :nx - 1]
+        np.subtract(block[:, 1:], block[:, :-1], out=diff, dtype=dtype)
+        np.abs(diff, out=diff)
+        if nx > 1:
+            dblock[:, 1:-1] = diff[:, 1:]
+            np.maximum(dblock[:, 1:-1], diff[:, :-1], out=dblock[:, 1:-1])
+            np.maximum(dblock[:, 0], diff[:, 0], out=dblock[:, 0])
+            np.maximum(dblock[:, -1], diff[:, -1], out=dblock[:, -1])
+
+        # Differences with the neighbours along the columns, between the
+        # rows y0 to y3 spanning the block and the rows just around it.
+        y0 = max(y1 - 1, 0)
+        y3 = min(y2, ny - 1)
+        diff = tmp[:y3 - y0]
+        np.subtract(data[y0 + 1:y3 + 1], data[y0:y3], out=diff, dtype=dtype)
+        np.abs(diff, out=diff)
+        # with the next row...
+        np.maximum(dblock[:y3 - y1], diff[y1 - y0:], out=dblock[:y3 - y1])
+        # ...and with the previous one.
+        y4 = min(y3, y2 - 1)
+        np.maximum(deriv[y0 + 1:y4 + 1], diff[:y4 - y0],
+                   out=deriv[y0 + 1:y4 + 1])
+
+    # The first and last rows keep their absolute value for the missing
+    # neighbours.
+    for y in {0, ny - 1}:
+        row = tmp[0]
+        np.abs(data[y], out=row, dtype=dtype)
+        np.maximum(deriv[y], row, out=deriv[y])
+
+    return out
 
 # END MODULE
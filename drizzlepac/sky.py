@@ -10,6 +10,7 @@ input image while recording the subtracted value in the image header.
 
 """
 import os, sys
+import hashlib
 
 from .imageObject import imageObject
 from stsci.tools import fileutil, teal, logutil
@@ -27,6 +28,7 @@ from stsci.skypac.parseat import FileExtMaskInfo, parse_at_file
 from . import processInput
 import stsci.imagestats as imagestats
 import numpy as np
+from astropy.io import fits
 
 from . import util
 from .version import *
@@ -63,26 +65,29 @@ def sky(input=None,outExt=None,configObj=None, group=None, editpars=False, **inp
 
     Parameters that should be in configobj:
 
-    ==========  ===================================================================
-    Name        Definition
-    ==========  ===================================================================
-    skymethod   'Sky computation method'
-    skysub		'Perform sky subtraction?'
-    skywidth	'Bin width of histogram for sampling sky statistics (in sigma)'
-    skystat	 	'Sky correction statistics parameter'
-    skylower	'Lower limit of usable data for sky (always in electrons)'
-    skyupper	'Upper limit of usable data for sky (always in electrons)'
-    skyclip		'Number of clipping iterations'
-    skylsigma	'Lower side clipping factor (in sigma)'
-    skyusigma	'Upper side clipping factor (in sigma)'
-    skymask_cat 'Catalog file listing image masks'
-    use_static  'Use static mask for skymatch computations?'
-    sky_bits    'Integer mask bit values considered good pixels in DQ array'
-    skyfile     'Name of file with user-computed sky values'
-    skyuser     'KEYWORD indicating a sky subtraction value if done by user'
-    in_memory   'Optimize for speed or for memory use'
-
-    ==========  ===================================================================
+    =================  ===================================================================
+    Name               Definition
+    =================  ===================================================================
+    skymethod          'Sky computation method'
+    skysub             'Perform sky subtraction?'
+    skywidth           'Bin width of histogram for sampling sky statistics (in sigma)'
+    skystat            'Sky correction statistics parameter'
+    skylower           'Lower limit of usable data for sky (always in electrons)'
+    skyupper           'Upper limit of usable data for sky (always in electrons)'
+    skyclip            'Number of clipping iterations'
+    skylsigma          'Lower side clipping factor (in sigma)'
+    skyusigma          'Upper side clipping factor (in sigma)'
+    skymask_cat        'Catalog file listing image masks'
+    use_static         'Use static mask for skymatch computations?'
+    sky_bits           'Integer mask bit values considered good pixels in DQ array'
+    skymask_cache      'Directory for caching combined sky masks'
+    skymask_cachesize  'Largest size (in Mb) of the sky mask cache'
+    skysample          'Number of pixels sampled for sky statistics'
+    skyfile            'Name of file with user-computed sky values'
+    skyuser            'KEYWORD indicating a sky subtraction value if done by user'
+    in_memory          'Optimize for speed or for memory use'
+
+    =================  ===================================================================
 
     The output from sky subtraction is a copy of the original input file
     where all the science data extensions have been sky subtracted.
@@ -260,6 +265,11 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
     # masks provided by astrodrizzle.
     new_fi = []
     sky_bits = interpret_bit_flags(paramDict['sky_bits'])
+    cache_dir = paramDict.get('skymask_cache')
+    if cache_dir:
+        cache_dir = os.path.abspath(os.path.expanduser(cache_dir.strip()))
+    cache_size = paramDict.get('skymask_cachesize')
+    sky_sample = paramDict.get('skysample')
     for i in range(nimg):
         # extract extension information:
         extname = imageList[i].scienceExt
@@ -307,7 +317,12 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
                 umask = fi.mask_images[k].hdu[fi.maskext[k]].data
             (mask, mext) = _buildStaticDQUserMask(imageList[i], extlist[k],
                                sky_bits, paramDict['use_static'],
-                               fi.mask_images[k], fi.maskext[k], in_memory)
+                               fi.mask_images[k], fi.maskext[k], in_memory,
+                               cache_dir=cache_dir, cache_size=cache_size,
+                               sky_sample=sky_sample)
+            if sky_sample and mask is not None:
+                _logSkySampleError(imageList[i], extlist[k],
+                                   mask.hdu[mext].data, paramDict)
 
             masklist.append(mask)
             mextlist.append(mext)
@@ -373,21 +388,20 @@ def _skymatch(imageList, paramDict, in_memory, clean, logfile):
         fi.release_all_images()
 
 def _buildStaticDQUserMask(img, ext, sky_bits, use_static, umask,
-                           umaskext, in_memory):
+                           umaskext, in_memory, cache_dir=None,
+                           cache_size=None, sky_sample=None):
     # creates a temporary mask by combining 'static' mask,
-    # DQ image, and user-supplied mask.
+    # DQ image, and user-supplied mask. When 'cache_dir' is set, the
+    # combined mask gets looked up in, or else saved to, the cache of sky
+    # masks in that directory instead of a temporary file. When
+    # 'sky_sample' is set, the mask only keeps a sample of about as many
+    # pixels, so that the sky statistics only get computed from them.
 
     def merge_masks(m1, m2):
         if m1 is None: return m2
         if m2 is None: return m1
         return np.logical_and(m1, m2).astype(np.uint8)
 
-    mask = None
-
-    # build DQ mask
-    if sky_bits is not None:
-        mask = img.buildMask(img[ext]._chip,bits=sky_bits)
-
     # get correct static mask mask filenames/objects
     staticMaskName = img[ext].outputNames['staticMask']
     smask = None
@@ -415,25 +429,63 @@ def _buildStaticDQUserMask(img, ext, sky_bits, use_static, umask,
             else:
                 log.warning("Static mask for file \'{}\', ext={} NOT FOUND." \
                             .format(img._filename, ext))
-        # combine DQ and static masks:
+
+    if umask is not None and not umask.closed:
+        dtm = umask.hdu[umaskext].data
+    else:
+        dtm = None
+
+    # look for the combined mask in the cache, keyed by the content of the
+    # masks it gets combined from:
+    cache_key = None
+    if cache_dir and (sky_bits is not None or smask is not None):
+        if sky_bits is None:
+            dqarr = None
+        else:
+            dqarr = img.getData(exten=img.maskExt + ',' + str(img[ext]._chip),
+                                attach=False)
+        cache_key = _skyMaskCacheKey(img, ext, sky_bits, (dqarr, smask, dtm),
+                                     sky_sample=sky_sample)
+        del dqarr
+        cached = _getCachedSkyMask(cache_dir, cache_key)
+        if cached is not None:
+            log.info("Using cached sky mask '{}' for file '{}', ext={}"
+                     .format(cached, img._filename, ext))
+            return _openSkyMask(cached, img, ext, in_memory)
+
+    mask = None
+
+    # build DQ mask
+    if sky_bits is not None:
+        mask = img.buildMask(img[ext]._chip,bits=sky_bits)
+
+    # combine DQ and static masks:
+    if use_static:
         mask = merge_masks(mask, smask)
 
     # combine user mask with the previously computed mask:
-    if umask is not None and not umask.closed:
-        if mask is None:
+    if dtm is not None:
+        if mask is None and not sky_sample:
             # return user-supplied mask:
             umask.hold()
             return (umask, umaskext)
         else:
             # combine user mask with the previously computed mask:
-            dtm  = umask.hdu[umaskext].data
             mask = merge_masks(mask, dtm)
 
+    # keep only a sample of the pixels for the sky statistics:
+    if sky_sample:
+        mask = merge_masks(mask, _skySampleMask(img[ext].image_shape,
+                                                sky_sample))
+
     if mask is None:
         return (None, None)
-    elif mask.sum() == 0:
-        log.warning("All pixels masked out when applying DQ, " \
-                    "static, and user masks!")
+    _checkSkyMask(mask)
+
+    if cache_key is not None:
+        cached = _cacheSkyMask(cache_dir, cache_key, mask, cache_size)
+        if cached is not None and not in_memory:
+            return _openSkyMask(cached, img, ext, in_memory, check=False)
 
     # save mask to a temporary file:
     (root,suffix,fext) = file_name_components(img._filename)
@@ -450,6 +502,210 @@ def _buildStaticDQUserMask(img, ext, sky_bits, use_static, umask,
 
     return (tmpmask, 0)
 
+
+def _skyMaskCacheKey(img, ext, sky_bits, arrays, sky_sample=None):
+    """ Return the key of the combined sky mask of the extension ext of img
+        in the cache of sky masks: a hash of the content of the DQ, static
+        and user mask arrays it gets built from, of sky_bits and sky_sample,
+        and of the type and signature of the chip.
+    """
+    key = hashlib.sha1()
+    key.update(repr((type(img).__name__, img[ext].signature,
+                     sky_bits, sky_sample)).encode())
+    for arr in arrays:
+        if arr is None:
+            key.update(b'None')
+        else:
+            arr = np.ascontiguousarray(arr)
+            key.update(repr((arr.dtype.str, arr.shape)).encode())
+            key.update(arr.data)
+    return key.hexdigest()
+
+
+def _skySampleMask(shape, nsample, seed=0):
+    """ Return a mask keeping about nsample pixels of an array of the given
+        shape, one picked at random in each of the consecutive runs of pixels
+        of the flattened array, with a fixed seed so that the same pixels
+        always get picked.  Returns None when nsample is not smaller than the
+        size of the array.
+    """
+    size = int(np.prod(shape))
+    if nsample >= size:
+        return None
+
+    step = size // int(nsample)
+    count = size // step
+    rng = np.random.default_rng(seed)
+    indices = np.arange(0, count * step, step)
+    indices += rng.integers(0, step, count)
+
+    mask = np.zeros(size, dtype=np.uint8)
+    mask[indices] = 1
+    return mask.reshape(shape)
+
+
+def _skySampleError(data, mask, skypars):
+    """ Return the sky statistics of the pixels of data kept by mask, as
+        skymatch computes them, and their standard error from the sampling
+        of 'skysample' pixels of the chip relative to the statistics of all
+        its pixels.  For the mean and the median, the error follows from the
+        standard deviation and number of the pixels kept by the clipping.
+        The error of the histogram mode only decreases about as the fourth
+        root of the number of pixels, and gets estimated from the spread of
+        the modes of 16 interleaved sub-samples instead.
+    """
+    skystat = skypars['skystat'].lower()
+    step = data.size // int(skypars['skysample'])
+    sample = data[mask.astype(bool)]
+
+    def stats(pixels):
+        return imagestats.ImageStats(
+            pixels,
+            fields='npix,stddev,' + skystat,
+            lower=skypars['skylower'],
+            upper=skypars['skyupper'],
+            nclip=skypars['skyclip'],
+            lsig=skypars['skylsigma'],
+            usig=skypars['skyusigma'],
+            binwidth=skypars['skywidth']
+        )
+
+    imstat = stats(sample)
+    skyval = _extractSkyValue(imstat, skystat)
+    if step < 2 or imstat.npix < 2:
+        return skyval, 0.0
+    if skystat == 'mode':
+        modes = [stats(sample[k::16]).mode for k in range(16)]
+        error = np.std(modes, ddof=1) / 2.0
+    else:
+        error = imstat.stddev / np.sqrt(imstat.npix)
+        if skystat != 'mean':
+            error *= np.sqrt(np.pi / 2.0)
+    return skyval, error * np.sqrt(1.0 - 1.0 / step)
+
+
+def _logSkySampleError(img, ext, mask, skypars):
+    """ Log the sky statistics of the pixels of the chip ext of img kept by
+        the sampled sky mask, with their error from the sampling.
+    """
+    exten = '{:s},{:d}'.format(*ext)
+    data = img.getData(exten=exten, attach=False)
+    if data is None:
+        data = img.getData(exten=exten)
+    if data is None or data.shape != mask.shape:
+        return
+    skyval, error = _skySampleError(data, mask, skypars)
+    log.info("Sky statistics ('{:s}') of the {:d} sampled pixels of file "
+             "'{}', ext={}: {} +/- {}"
+             .format(skypars['skystat'], int(np.count_nonzero(mask)),
+                     img._filename, ext, skyval, error))
+
+
+def _skyMaskCacheName(cache_dir, key):
+    return os.path.join(cache_dir, key + '_skymatch_mask.fits')
+
+
+def _checkSkyMask(mask):
+    """ Warn when the combined sky mask leaves no pixel. """
+    if not np.any(mask):
+        log.warning("All pixels masked out when applying DQ, " \
+                    "static, and user masks!")
+
+
+def _getCachedSkyMask(cache_dir, key):
+    """ Return the name of the file of the sky mask with the given key in
+        the cache, or None when not cached.  The file gets touched, as the
+        least recently used masks get evicted first.
+    """
+    fname = _skyMaskCacheName(cache_dir, key)
+    if not os.path.isfile(fname):
+        return None
+    try:
+        os.utime(fname)
+    except OSError:
+        # a read-only cache can still be used
+        pass
+    return fname
+
+
+def _cacheSkyMask(cache_dir, key, mask, cache_size):
+    """ Save mask in the cache of sky masks with the given key, then evict
+        the least recently used masks from the cache until its size is
+        within cache_size (in MB).  Returns the name of the cached file, or
+        None when it could not be written to the cache.
+    """
+    fname = _skyMaskCacheName(cache_dir, key)
+    if mask.dtype == bool:
+        mask = mask.astype(np.uint8)
+    # write under a temporary name first, so that concurrent runs never see
+    # an incomplete mask:
+    tmpname = '{}.{:d}.tmp'.format(fname, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fits.PrimaryHDU(data=mask).writeto(tmpname, overwrite=True)
+        os.replace(tmpname, fname)
+    except OSError as e:
+        log.warning("Could not cache sky mask in '{}': {}"
+                    .format(cache_dir, e))
+        if os.path.isfile(tmpname):
+            util.removeFileSafely(tmpname)
+        return None
+
+    if cache_size is None:
+        return fname
+    cached = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith('_skymatch_mask.fits'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        cached.append((st.st_mtime, st.st_size, path))
+    cached.sort()
+    total = sum(c[1] for c in cached)
+    for mtime, size, path in cached:
+        if total <= cache_size * 1024 * 1024:
+            break
+        if path == fname:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+    return fname
+
+
+def _openSkyMask(fname, img, ext, in_memory, check=True):
+    """ Return the sky mask cached in fname as _buildStaticDQUserMask does,
+        checking that it leaves some pixels when check is set.
+    """
+    if in_memory or check:
+        mask = fits.getdata(fname, memmap=False)
+        if check:
+            _checkSkyMask(mask)
+    if in_memory:
+        tmpmask = in_memory_mask(mask)
+        tmpmask.original_fname = fname
+        return (tmpmask, 0)
+
+    sm, dq = openImageEx(
+        fname,
+        mode='readonly',
+        memmap=False,
+        saveAsMEF=False,
+        clobber=False,
+        imageOnly=True,
+        openImageHDU=True,
+        openDQHDU=False,
+        preferMEF=False,
+        verbose=False
+    )
+    return (sm, 0)
+
 # this function applies user supplied sky values from an input file
 def _skyUserFromFile(imageObjList, skyFile, apply_sky=None):
     """
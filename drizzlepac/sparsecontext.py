@@ -0,0 +1,148 @@
+"""
+Compact (run-length encoded) representation of drizzle context images.
+
+The standard context image is a cube of 32-bit planes, with one bit per
+input image, and so its size grows with the total number of inputs even
+though most output pixels only receive flux from a handful of them.  The
+compact representation instead records, for each input image, the runs of
+contiguous output pixels along each row of the output frame which received
+flux from that input.  Its size therefore scales with the actual overlap
+between the inputs.
+
+Each run is described by the ID of the input image (the ``uniqid`` used
+for the standard context image, starting at 1), the row and the first and
+last columns of the run.  In memory, runs are kept as ``(N, 4)`` int32
+arrays using 0-based pixel indices.  In FITS files, they are written out as
+a binary table extension named ``CTX`` with the columns ``ID``, ``Y``,
+``X1`` and ``X2`` holding 1-based pixel indices, and with the size of the
+output frame given by the ``CTX_NX`` and ``CTX_NY`` header keywords.
+
+:License: :doc:`LICENSE`
+
+"""
+import numpy as np
+from astropy.io import fits
+
+__all__ = ['find_runs', 'sort_runs', 'build_table_hdu', 'read_context',
+           'get_context_ids', 'context_to_planes']
+
+
+def find_runs(mask, uniqid, yoffset=0, xoffset=0):
+    """ Return the runs of `True` pixels along each row of the 2-D boolean
+    array ``mask`` as an ``(N, 4)`` array of ``(uniqid, y, x1, x2)`` rows,
+    with ``x1`` and ``x2`` the first and last (inclusive) columns of each
+    run.  ``yoffset`` and ``xoffset`` give the position of ``mask`` within
+    the output frame.
+    """
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    # Both lists come out in row-major order, so starts and ends pair up
+    ys, xstart = np.nonzero(edges == 1)
+    xend = np.nonzero(edges == -1)[1]
+
+    runs = np.empty((ys.size, 4), dtype=np.int32)
+    runs[:, 0] = uniqid
+    runs[:, 1] = ys + yoffset
+    runs[:, 2] = xstart + xoffset
+    runs[:, 3] = xend - 1 + xoffset
+    return runs
+
+
+def sort_runs(runs):
+    """ Merge a list of run arrays into a single array sorted by input ID,
+    row and then column.
+    """
+    runs = [r for r in runs if r is not None and len(r) > 0]
+    if not runs:
+        return np.zeros((0, 4), dtype=np.int32)
+    runs = np.concatenate(runs)
+    order = np.lexsort((runs[:, 2], runs[:, 1], runs[:, 0]))
+    return runs[order]
+
+
+def build_table_hdu(runs, shape):
+    """ Build the ``CTX`` binary table extension holding the compact context
+    image with the given runs for an output frame of the given shape.
+    """
+    runs = np.asarray(runs, dtype=np.int32).reshape((-1, 4))
+    cols = [
+        fits.Column(name='ID', format='J', array=runs[:, 0]),
+        fits.Column(name='Y', format='J', array=runs[:, 1] + 1),
+        fits.Column(name='X1', format='J', array=runs[:, 2] + 1),
+        fits.Column(name='X2', format='J', array=runs[:, 3] + 1)
+    ]
+    hdu = fits.BinTableHDU.from_columns(cols, name='CTX')
+    hdu.header['CTX_NX'] = (shape[1], 'X size of output frame')
+    hdu.header['CTX_NY'] = (shape[0], 'Y size of output frame')
+    hdu.header['CTXTYPE'] = ('RUNS', 'Context stored as runs of pixels')
+    return hdu
+
+
+def read_context(ctx):
+    """ Read a compact context image.
+
+    Parameters
+    ----------
+    ctx : str, `~astropy.io.fits.HDUList` or `~astropy.io.fits.BinTableHDU`
+        Name of a FITS file (with the compact context as its ``CTX``
+        extension), an already opened FITS file or the ``CTX`` table itself.
+
+    Returns
+    -------
+    runs : numpy.ndarray
+        ``(N, 4)`` array of ``(id, y, x1, x2)`` runs, using 0-based indices.
+
+    shape : tuple
+        Shape of the output frame.
+
+    """
+    if isinstance(ctx, str):
+        with fits.open(ctx, memmap=False) as hdulist:
+            return read_context(hdulist)
+    if isinstance(ctx, fits.HDUList):
+        return read_context(ctx['CTX'])
+
+    data = ctx.data
+    runs = np.empty((len(data), 4), dtype=np.int32)
+    runs[:, 0] = data['ID']
+    runs[:, 1] = data['Y'] - 1
+    runs[:, 2] = data['X1'] - 1
+    runs[:, 3] = data['X2'] - 1
+    shape = (ctx.header['CTX_NY'], ctx.header['CTX_NX'])
+    return runs, shape
+
+
+def get_context_ids(ctx, x, y):
+    """ Return the sorted list of IDs of the input images which contributed
+    to the output pixel ``(x, y)`` (0-based) of a compact context image,
+    given either as in :py:func:`read_context` or as the ``(runs, shape)``
+    it returns.
+    """
+    if isinstance(ctx, tuple):
+        runs = ctx[0]
+    else:
+        runs = read_context(ctx)[0]
+    hits = (runs[:, 1] == y) & (runs[:, 2] <= x) & (runs[:, 3] >= x)
+    return sorted(set(runs[hits, 0].tolist()))
+
+
+def context_to_planes(ctx, nplanes=None):
+    """ Convert a compact context image, given either as in
+    :py:func:`read_context` or as the ``(runs, shape)`` it returns, into
+    the equivalent standard context image: an int32 cube of bit planes,
+    with bit ``(id - 1) % 32`` of plane ``(id - 1) // 32`` set for the
+    pixels which received flux from input ``id``.
+    """
+    if isinstance(ctx, tuple):
+        runs, shape = ctx
+    else:
+        runs, shape = read_context(ctx)
+
+    if nplanes is None:
+        nplanes = (int(runs[:, 0].max()) - 1) // 32 + 1 if len(runs) else 1
+    planes = np.zeros((nplanes,) + tuple(shape), dtype=np.uint32)
+    for uniqid, y, x1, x2 in runs:
+        planes[(uniqid - 1) // 32, y, x1:x2 + 1] |= \
+            np.uint32(1 << ((uniqid - 1) % 32))
+    return planes.view(np.int32)
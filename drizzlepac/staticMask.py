@@ -11,7 +11,9 @@ For `staticMask`, the user interface function is :py:func:`createMask`.
 """
 import os
 import sys
+import threading
 from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from stsci.tools import fileutil, teal, logutil
@@ -24,6 +26,10 @@ from . import processInput
 __taskname__ = "drizzlepac.staticMask"
 _step_num_ = 1
 
+# Number of pixels of the blocks of rows over which chip statistics get
+# accumulated.
+_BLOCK_SIZE = 256 * 1024
+
 
 log = logutil.create_logger(__name__, level=logutil.logging.NOTSET)
 
@@ -87,9 +93,7 @@ def createStaticMask(imageObjectList=[],configObj=None,procSteps=None):
     #create a static mask object
     myMask = staticMask(configObj)
 
-    for image in imageObjectList:
-        myMask.addMember(image) # create tmp filename here...
-
+    myMask.addMembers(imageObjectList) # create tmp filenames here...
 
     #save the masks to disk for later access
     myMask.saveToFile(imageObjectList)
@@ -121,7 +125,8 @@ class staticMask:
     masks pixels that are unwanted in the SCI array.
     A static mask  object gets created for each global
     mask needed, one for each chip from each instrument/detector.
-    Each static mask array has type Int16, and resides in memory.
+    Each static mask array has type bool, and resides in memory; it gets
+    saved as an Int16 image.
 
     :Notes:
         Class that manages the creation of a global static
@@ -135,11 +140,14 @@ class staticMask:
 
         self.masklist={}
         self.masknames = {}
+        self._masklocks = {}
         self.step_name=util.getSectionName(configObj,_step_num_)
         if configObj is not None:
             self.static_sig = configObj[self.step_name]['static_sig']
+            self.num_cores = configObj.get('num_cores')
         else:
             self.static_sig = 4. # define a reasonable number
+            self.num_cores = None
             log.warning('Using default of 4. for static mask sigma.')
 
     def addMember(self, imagePtr=None):
@@ -161,52 +169,101 @@ class staticMask:
         The signature is defined in the image object for each chip
 
         """
-        numchips=imagePtr._numchips
+        self.addMembers([imagePtr])
+
+    def addMembers(self, imageObjectList):
+        """
+        Combines all the input images with the static masks that have the
+        same signatures as their chips, as `addMember` does for one image.
+        The chips of all images get processed concurrently, in as many
+        threads as ``num_cores`` allows, each of them only read for the time
+        it takes to compute its statistics and update its static mask.
+        Those statistics get computed by ImageStats when processing chips one
+        at a time, and by `_chipStats` otherwise, as ImageStats holds the GIL.
+
+        Parameters
+        ----------
+        imageObjectList : list
+            A list of imageObject references
+
+        """
         log.info("Computing static mask:\n")
 
-        chips = imagePtr.group
-        if chips is None:
-            chips = imagePtr.getExtensions()
-
-        #for chip in range(1,numchips+1,1):
-        for chip in chips:
-            chipid=imagePtr.scienceExt + ','+ str(chip)
-            chipimage=imagePtr.getData(chipid)
-            signature=imagePtr[chipid].signature
-
-            # If this is a new signature, create a new Static Mask file which is empty
-            # only create a new mask if one doesn't already exist
-            if ((signature not in self.masklist) or (len(self.masklist) == 0)):
-                self.masklist[signature] = self._buildMaskArray(signature)
-                maskname =  constructFilename(signature)
-                self.masknames[signature] = maskname
-            else:
-                chip_sig = buildSignatureKey(signature)
-                for s in self.masknames:
-                    if chip_sig in self.masknames[s]:
-                        maskname  = self.masknames[s]
-                        break
-            imagePtr[chipid].outputNames['staticMask'] = maskname
-
-            stats = ImageStats(chipimage,nclip=3,fields='mode')
+        tasks = []
+        for imagePtr in imageObjectList:
+            chips = imagePtr.group
+            if chips is None:
+                chips = imagePtr.getExtensions()
+
+            for chip in chips:
+                chipid=imagePtr.scienceExt + ','+ str(chip)
+                signature=imagePtr[chipid].signature
+
+                # If this is a new signature, create a new Static Mask file which is empty
+                # only create a new mask if one doesn't already exist
+                if ((signature not in self.masklist) or (len(self.masklist) == 0)):
+                    self.masklist[signature] = self._buildMaskArray(signature)
+                    self._masklocks[signature] = threading.Lock()
+                    maskname =  constructFilename(signature)
+                    self.masknames[signature] = maskname
+                else:
+                    chip_sig = buildSignatureKey(signature)
+                    for s in self.masknames:
+                        if chip_sig in self.masknames[s]:
+                            maskname  = self.masknames[s]
+                            break
+                imagePtr[chipid].outputNames['staticMask'] = maskname
+                tasks.append((imagePtr, chipid, signature))
+
+        pool_size = util.get_pool_size(self.num_cores, len(tasks))
+        tasks = [task + (pool_size > 1,) for task in tasks]
+        if pool_size > 1:
+            log.info('Executing {:d} parallel threads'.format(pool_size))
+            pool = ThreadPool(pool_size)
+            results = pool.imap(self._addChip, tasks)
+        else:
+            pool = None
+            results = map(self._addChip, tasks)
+
+        try:
+            for mode, rms in results:
+                log.info('  mode = %9f;   rms = %7f;   static_sig = %0.2f' %
+                         (mode, rms, self.static_sig))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _addChip(self, task):
+        """ Combines one chip with the static mask of its signature, and
+            returns the mode and rms of the chip.
+        """
+        imagePtr, chipid, signature, threaded = task
+        chipimage = imagePtr.getData(chipid, attach=False)
+
+        if threaded:
+            mode, rms, nbins = _chipStats(chipimage, nclip=3)
+        else:
+            stats = ImageStats(chipimage, nclip=3, fields='mode')
             mode = stats.mode
-            rms  = stats.stddev
+            rms = stats.stddev
             nbins = len(stats.histogram)
             del stats
 
-            log.info('  mode = %9f;   rms = %7f;   static_sig = %0.2f' %
-                     (mode, rms, self.static_sig))
+        if nbins >= 2: # only combine data from new image if enough data to mask
+            sky_rms_diff = mode - (self.static_sig*rms)
+            goodpix = np.less(chipimage, sky_rms_diff)
+            np.logical_not(goodpix, out=goodpix)
+            with self._masklocks[signature]:
+                np.logical_and(self.masklist[signature], goodpix,
+                               out=self.masklist[signature])
+        del chipimage
 
-            if nbins >= 2: # only combine data from new image if enough data to mask
-                sky_rms_diff = mode - (self.static_sig*rms)
-                np.bitwise_and(self.masklist[signature],
-                               np.logical_not(np.less(chipimage, sky_rms_diff)),
-                               self.masklist[signature])
-            del chipimage
+        return mode, rms
 
     def _buildMaskArray(self,signature):
         """ Creates empty  numpy array for static mask array signature. """
-        return np.ones(signature[1],dtype=np.int16)
+        return np.ones(signature[1],dtype=bool)
 
     def getMaskArray(self, signature):
         """ Returns the appropriate StaticMask array for the image. """
@@ -265,7 +322,7 @@ class staticMask:
             #create a new fits image with the mask array and a standard header
             #open a new header and data unit
             newHDU = fits.PrimaryHDU()
-            newHDU.data = self.masklist[key]
+            newHDU.data = self.masklist[key].astype(np.int16)
 
             if virtual:
                 for img in imageObjectList:
@@ -282,6 +339,138 @@ class staticMask:
                     raise IOError
 
 
+def _inRange(data, lower, upper):
+    """ Return the boolean mask of the values of data within the inclusive
+        single precision bounds lower and upper.
+    """
+    good = np.greater_equal(data, np.float32(lower))
+    good &= np.less_equal(data, np.float32(upper))
+    return good
+
+
+def _chipStats(data, nclip=3, lsig=3.0, usig=3.0, binwidth=0.1):
+    """
+    Return the mode, standard deviation and number of histogram bins of
+    data, as ``ImageStats(data, nclip=nclip, lsig=lsig, usig=usig,
+    binwidth=binwidth, fields='mode')`` computes them, but with numpy.
+
+    The data get converted to native single precision, as ImageStats does,
+    and the sums get accumulated block of rows after block of rows, with the
+    same precision as ImageStats, so that the GIL gets released for all but
+    a few operations on each block, letting the chips of several images get
+    processed in parallel threads.
+
+    """
+    nrows = max(1, _BLOCK_SIZE // max(data.shape[-1], 1))
+    blocks = [np.asarray(data[y:y + nrows], dtype=np.float32)
+              for y in range(0, data.shape[0], nrows)]
+
+    # Compute global minimum and maximum
+    lower = min(float(np.min(block)) for block in blocks)
+    upper = max(float(np.max(block)) for block in blocks)
+    first = data.flat[0]
+
+    # Compute the clipped mean iterating the given number of iterations
+    clipmin = lower
+    clipmax = upper
+    for it in range(nclip + 1):
+        npix = 0
+        total = 0.0
+        # ImageStats starts from the first pixel, whether clipped or not,
+        # and limits the minimum and maximum to the clipping range.
+        vmin = vmax = float(first)
+        selected = []
+        for block in blocks:
+            values = block[_inRange(block, clipmin, clipmax)]
+            if values.size == 0:
+                continue
+            selected.append(values)
+            npix += values.size
+            total += np.add.reduce(values, dtype=np.float64)
+            vmin = min(vmin, float(values.min()))
+            vmax = max(vmax, float(values.max()))
+        if npix <= 0:
+            raise ValueError("Not enough data points to compute statistics.")
+        vmin = max(vmin, float(np.float32(clipmin)))
+        vmax = min(vmax, float(np.float32(clipmax)))
+        mean = np.float32(total / npix)
+
+        # The deviations from the mean get squared in single precision,
+        # and summed in double precision.
+        total = 0.0
+        for values in selected:
+            values = np.subtract(values, mean, dtype=np.float32)
+            np.multiply(values, values, out=values)
+            total += np.add.reduce(values, dtype=np.float64)
+        del selected
+        if npix > 1:
+            stddev = float(np.float32(np.sqrt(total / (npix - 1))))
+        else:
+            stddev = 0.0
+        mean = float(mean)
+
+        if it < nclip:
+            # Re-compute limits for iterations
+            clipmin = max(lower, mean - lsig * stddev)
+            clipmax = min(upper, mean + usig * stddev)
+
+    # Populate the histogram
+    hwidth = binwidth * stddev
+    drange = vmax - vmin
+    minfloatval = 10.0 * np.finfo(dtype=np.float32).eps
+    if hwidth < minfloatval or abs(drange) < minfloatval or hwidth > drange:
+        nbins = 1
+        dz = drange
+    else:
+        nbins = int((vmax - vmin) / hwidth) + 1
+        dz = float(vmax - vmin) / float(nbins - 1)
+
+    hmin = np.float32(vmin)
+    hdz = np.float32(dz)
+    hmax = hmin + hdz * np.float32(nbins)
+    bins = np.zeros(nbins, dtype=np.int64)
+    if nbins > 1:
+        # A single bin does not need populating to compute the mode
+        hscale = np.float32(1.0) / hdz
+        for block in blocks:
+            good = np.greater_equal(block, hmin)
+            good &= np.less(block, hmax)
+            index = block[good].astype(np.float32)
+            index -= hmin
+            index *= hscale
+            index = index.astype(np.int64)
+            index = index[index < nbins]
+            bins += np.bincount(index, minlength=nbins)
+
+    # Compute the mode, taking into account special cases
+    if nbins == 1:
+        mode = vmin + 0.5 * hwidth
+    elif nbins == 2:
+        if bins[0] > bins[1]:
+            mode = vmin + 0.5 * hwidth
+        elif bins[0] < bins[1]:
+            mode = vmin + 1.5 * hwidth
+        else:
+            mode = vmin + hwidth
+    else:
+        peakindex = int(np.argmax(bins))
+        if peakindex == 0:
+            mode = vmin + 0.5 * hwidth
+        elif peakindex == (nbins - 1):
+            mode = vmin + (nbins - 0.5) * hwidth
+        else:
+            dh1 = int(bins[peakindex] - bins[peakindex - 1])
+            dh2 = int(bins[peakindex] - bins[peakindex + 1])
+            denom = dh1 + dh2
+            if denom == 0:
+                mode = vmin + (peakindex + 0.5) * hwidth
+            else:
+                mode = peakindex + 1 + (0.5 * (dh1 - dh2) / denom)
+                mode = vmin + ((mode - 0.5) * hwidth)
+
+    return mode, stddev, nbins
+
+
 def help(file=None):
     """
     Print out syntax help for running astrodrizzle
@@ -75,6 +75,131 @@ def get_pool_size(usr_config_value, num_tasks):
         return min(_cpu_count, num_tasks)
 
 
+def get_available_memory():
+    """ Return the amount of memory, in bytes, that can be used without
+    swapping, or `None` if it cannot be determined on this system. """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    # Free memory alone, where there is no /proc/meminfo
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# imageObject instances inherited by the workers of a WorkerPool
+_pool_images = None
+
+
+class WorkerPool:
+    """ Pool of worker processes kept alive across the processing steps of
+    a run on a list of images.
+
+    The workers get forked only once, when the pool gets created, and so
+    inherit the list of ``imageObject`` instances being processed.  Tasks
+    refer to those images by their position in that list and only carry
+    the few attributes updated by the processing steps run since the pool
+    got created, so that an ``imageObject`` never gets pickled, and only
+    ``size`` worker processes get started however many images and steps
+    there are.
+
+    Products kept in memory by processing steps, and buffers allocated
+    after the pool got created, are not visible to the workers, so the pool
+    should only be used when working on disk.
+    """
+    # Attributes of the images and of their chips set by processing steps
+    # after the creation of the imageObject instances
+    image_attrs = ['outputNames']
+    chip_attrs = ['computedSky', 'subtractedSky', 'outputNames']
+
+    def __init__(self, imgObjList, size):
+        global _pool_images
+        self.images = imgObjList
+        self.size = size
+        _pool_images = imgObjList
+        self._pool = multiprocessing.get_context('fork').Pool(size)
+
+    @staticmethod
+    def available():
+        """ Return whether worker processes inheriting the state of this
+        process can be started on this platform.
+        """
+        return (can_parallel and
+                'fork' in multiprocessing.get_all_start_methods())
+
+    def _get_state(self, img):
+        img_state = {a: getattr(img, a) for a in self.image_attrs}
+        chip_states = []
+        for chip in img.returnAllChips(extname=img.scienceExt):
+            chip_states.append({a: getattr(chip, a, None)
+                                for a in self.chip_attrs})
+        return img_state, chip_states
+
+    def map(self, func, tasks):
+        """ Run ``func(img, *args)`` in the workers for each ``(img, args)``
+        pair in ``tasks``, where ``img`` is one of the images given to the
+        pool, and return the list of results once all tasks are done.
+        With ``img`` set to `None`, ``func`` gets the list of all the
+        images instead.
+        """
+        jobs = []
+        for img, args in tasks:
+            if img is None:
+                index = None
+                state = [self._get_state(im) for im in self.images]
+            else:
+                index = [i for i, im in enumerate(self.images)
+                         if im is img][0]
+                state = [self._get_state(img)]
+            jobs.append((func, index, state, tuple(args)))
+        return self._pool.starmap(_run_pool_task, jobs)
+
+    def close(self):
+        """ Shut down the worker processes. """
+        self._pool.close()
+        self._pool.join()
+
+
+def _run_pool_task(func, index, state, args):
+    """ Bring the images inherited by this worker up-to-date with the state
+    sent along with the task and run the task on them.
+    """
+    if index is None:
+        images = _pool_images
+    else:
+        images = [_pool_images[index]]
+    for img, (img_state, chip_states) in zip(images, state):
+        for attr, value in img_state.items():
+            setattr(img, attr, value)
+        chips = img.returnAllChips(extname=img.scienceExt)
+        for chip, chip_state in zip(chips, chip_states):
+            for attr, value in chip_state.items():
+                setattr(chip, attr, value)
+    if index is None:
+        return func(images, *args)
+    return func(images[0], *args)
+
+
+def get_worker_pool(imgObjList, num_cores, num_tasks=None):
+    """ Create a pool of worker processes for running processing steps on
+    the images of ``imgObjList`` in parallel, or return None when they
+    should be run without one.  The pool gets as many workers as
+    ``num_cores`` allows, but no more than ``num_tasks`` if given.
+    """
+    if not WorkerPool.available() or imgObjList[0].inmemory:
+        return None
+    pool_size = get_pool_size(num_cores, num_tasks)
+    if pool_size < 2:
+        return None
+    return WorkerPool(imgObjList, pool_size)
+
+
 DEFAULT_LOGNAME = 'astrodrizzle.log'
 blank_list = [None, '', ' ', 'None', 'INDEF']
 
@@ -7,6 +7,11 @@
 """
 from astropy.io import fits as pyfits
 import copy
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
 from numpy import linalg
 
@@ -18,6 +23,11 @@ from stwcs import wcsutil
 from stwcs.distortion import coeff_converter, utils
 from stwcs.wcsutil import altwcs
 
+try:
+    from . import cdriz
+except ImportError:
+    cdriz = None
+
 DEFAULT_WCS_PARS = {'ra': None, 'dec': None, 'scale': None, 'rot': None,
                     'outnx': None, 'outny': None,
                     'crpix1': None, 'crpix2': None}
@@ -119,6 +129,170 @@ class LinearMap:
     def forward(self, pixx, pixy):
         return np.dot(self.transform, [pixx, pixy]) + self.offset
 
+##
+#
+# ### Cache of pixel maps used by the default C-based mapping
+#
+##
+# Interpolation tables of cdriz.DefaultWCSMapping computed so far (or the
+# adaptive mappings themselves), with their sizes in bytes, indexed by
+# pixel_map_key(), from the least to the most recently used
+_pixel_maps = OrderedDict()
+_pixel_maps_lock = threading.Lock()
+
+# Largest size, in bytes, of the pixel maps kept in memory; the least
+# recently used ones get dropped first
+_PIXEL_MAP_CACHE_SIZE = 256 * 1024 * 1024
+
+
+def pixel_map_key(input_wcs, output_wcs, nx, ny, stepsize):
+    """ Return a hash identifying the pixel map from the pixels of an image
+    of ``nx`` x ``ny`` pixels described by ``input_wcs`` onto the pixels of
+    ``output_wcs``, as computed every ``stepsize`` pixels.  It accounts for
+    all parts of the WCSs used by the mapping, including the SIP
+    coefficients and the NPOL and D2IM lookup tables.
+    """
+    h = hashlib.sha1()
+    h.update(np.array([nx, ny, stepsize], dtype=np.float64).tobytes())
+    for w in [input_wcs, output_wcs]:
+        h.update(w.wcs.to_header(True).encode('ascii'))
+        for arr in [w.wcs.crpix, w.wcs.crval, w.pixel_scale_matrix]:
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        if w.sip is None:
+            h.update(b'nosip')
+        else:
+            for arr in [w.sip.a, w.sip.b, w.sip.crpix]:
+                h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        for tab in [w.cpdis1, w.cpdis2, w.det2im1, w.det2im2]:
+            if tab is None:
+                h.update(b'notab')
+            else:
+                h.update(np.ascontiguousarray(tab.data, dtype=np.float64).tobytes())
+                h.update(np.array([tab.crpix, tab.crval, tab.cdelt],
+                                  dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def get_pixel_map(input_wcs, output_wcs, stepsize=10, sidecar=None,
+                  max_error=None):
+    """ Return the ``cdriz.DefaultWCSMapping`` from the pixels of
+    ``input_wcs`` onto those of ``output_wcs``.
+
+    Evaluating the full distortion model for the mapping only needs to be
+    done once for each pair of WCSs: the pixel maps get kept in memory and
+    re-used by every later call (drizzle, blot, ...) for the same pair.
+    When ``sidecar`` is given, pixel maps also get saved to, and restored
+    from, ``<sidecar>_<key>.npy`` files so they can be shared between
+    processes.  With a ``stepsize`` of 0 the WCSs get evaluated directly
+    for every pixel and no pixel map is kept.
+
+    With ``max_error`` set, the pixel map computed every ``stepsize``
+    pixels gets refined, down to about one pixel, wherever interpolating
+    it would be off by more than ``max_error`` output pixels.  Such
+    adaptive pixel maps are only kept in memory.  A ``max_error`` of 0,
+    like a ``stepsize`` of 0, evaluates the WCSs directly for every pixel.
+    """
+    nx, ny = input_wcs.pixel_shape
+    if stepsize <= 0 or max_error == 0:
+        return cdriz.DefaultWCSMapping(input_wcs, output_wcs, nx, ny, 0)
+
+    key = pixel_map_key(input_wcs, output_wcs, nx, ny, stepsize)
+    if max_error:
+        return _get_adaptive_pixel_map(input_wcs, output_wcs, stepsize,
+                                       max_error, key)
+    fname = None
+    if sidecar is not None:
+        fname = '{:s}_{:s}.npy'.format(sidecar, key[:16])
+
+    table = _get_cached_pixel_map(key)
+    if table is None and fname is not None and os.path.exists(fname):
+        try:
+            table = np.load(fname)
+        except (OSError, ValueError):
+            log.warning('Could not read pixel map from %s' % fname)
+
+    if table is not None:
+        try:
+            mapping = cdriz.DefaultWCSMapping(input_wcs, output_wcs,
+                                              nx, ny, stepsize, table)
+            _cache_pixel_map(key, table, table.nbytes)
+            log.debug('Re-using pixel map %s' % key[:16])
+            return mapping
+        except ValueError:
+            log.warning('Ignoring invalid pixel map %s' % key[:16])
+
+    mapping = cdriz.DefaultWCSMapping(input_wcs, output_wcs, nx, ny, stepsize)
+    table = mapping.table
+    _cache_pixel_map(key, table, table.nbytes)
+
+    if fname is not None:
+        # Write to a temporary file first, so that other processes never
+        # pick up a partially written pixel map
+        tmpname = '{:s}.{:d}.tmp'.format(fname, os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.save(f, table)
+        os.replace(tmpname, fname)
+
+    return mapping
+
+
+def _get_adaptive_pixel_map(input_wcs, output_wcs, stepsize, max_error, key):
+    """ Return the adaptive pixel map for :py:func:`get_pixel_map`, after
+    reporting the accuracy it achieved and the cost of building it.
+    """
+    key = '{:s}_{:g}'.format(key, max_error)
+    # Adaptive pixel maps cannot be rebuilt from their coarse table, so the
+    # mapping itself gets kept
+    mapping = _get_cached_pixel_map(key)
+    if mapping is not None:
+        log.debug('Re-using adaptive pixel map %s' % key[:16])
+        return mapping
+
+    nx, ny = input_wcs.pixel_shape
+    t0 = time.time()
+    mapping = cdriz.DefaultWCSMapping(input_wcs, output_wcs, nx, ny, stepsize,
+                                      max_error=max_error)
+    ncells = (int(nx / stepsize) + 1) * (int(ny / stepsize) + 1)
+    log.info('Adaptive pixel map: largest error of {:.2g} pixels (for a '
+             'maximum of {:g}), {:d} of {:d} cells refined, {:d} WCS '
+             'evaluations in {:.3f} s'.format(mapping.achieved_error,
+             max_error, mapping.nrefined, ncells, mapping.nevals,
+             time.time() - t0))
+    # the coarse table, along with the nodes of the refined cells
+    nbytes = 16 * (ncells + mapping.nrefined * (stepsize + 1)**2)
+    _cache_pixel_map(key, mapping, nbytes)
+    return mapping
+
+
+def _get_cached_pixel_map(key):
+    """ Return the pixel map kept in memory for key, or None. """
+    with _pixel_maps_lock:
+        if key not in _pixel_maps:
+            return None
+        _pixel_maps.move_to_end(key)
+        return _pixel_maps[key][0]
+
+
+def _cache_pixel_map(key, pixmap, nbytes):
+    """ Keep pixmap in memory for key, dropping the least recently used
+    pixel maps until all of them fit within ``_PIXEL_MAP_CACHE_SIZE``
+    bytes, except for this one.
+    """
+    with _pixel_maps_lock:
+        _pixel_maps[key] = (pixmap, nbytes)
+        _pixel_maps.move_to_end(key)
+        total = sum(size for _, size in _pixel_maps.values())
+        while total > _PIXEL_MAP_CACHE_SIZE and len(_pixel_maps) > 1:
+            _, (_, size) = _pixel_maps.popitem(last=False)
+            total -= size
+
+
+def clear_pixel_maps():
+    """ Forget all pixel maps kept in memory by :py:func:`get_pixel_map`.
+    """
+    with _pixel_maps_lock:
+        _pixel_maps.clear()
+
 
 # Stand-alone functions for WCS handling
 def get_hstwcs(filename, hdulist, extnum):
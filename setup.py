@@ -52,6 +52,11 @@ if sys.platform == 'win32':
         ('__STDC__', 1)
     ]
 
+# The drizzle kernel runs in native threads
+libraries = []
+if sys.platform != 'win32':
+    libraries.append('pthread')
+
 TESTS_REQUIRE = [
     'ci_watson',
     'crds',
@@ -144,7 +149,8 @@ setup(
         Extension('drizzlepac.cdriz',
                   glob('src/*.c'),
                   include_dirs=include_dirs,
-                  define_macros=define_macros),
+                  define_macros=define_macros,
+                  libraries=libraries),
     ],
     project_urls={
         'Bug Reports': 'https://github.com/spacetelescope/drizzlepac/issues/',
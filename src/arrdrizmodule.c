@@ -15,6 +15,7 @@
 
 #include "cdrizzleblot.h"
 #include "cdrizzlebox.h"
+#include "cdrizzlecombine.h"
 #include "cdrizzlemap.h"
 #include "cdrizzleutil.h"
 #include "cdrizzlewcs.h"
@@ -116,6 +117,266 @@ py_mapping_callback(void* state,
   return result;
 }
 
+/*
+ Python mappings evaluated over blocks of rows.
+
+ Calling back into Python for every line of the image costs a lot more
+ than the transformation itself.  Instead, the first request for a line
+ evaluates the Python mapping over a block of rows spanning the whole
+ width of the image, on the grid of positions with the same fractional
+ offset, in a single vectorized call.  Later requests that fall on that
+ grid are served from the block.  The drizzle and blot loops only ask for
+ pixel centres or pixel corners along lines with a step of one pixel, so
+ a couple of blocks serve nearly all of them.
+
+ This relies on the Python mapping transforming each position
+ independently of the others passed in the same call.  Requests that do
+ not fall on a unit grid are passed on to py_mapping_callback.
+*/
+#define PY_MAPPING_BLOCK_POINTS (1 << 20)
+#define PY_MAPPING_NBLOCKS 3
+
+struct py_mapping_block_t {
+  /* Position of the first point; columns and rows are one pixel apart */
+  double x0;
+  double y0;
+  integer_t nx;
+  integer_t ny;
+  PyArrayObject* xout; /* [ny*nx] */
+  PyArrayObject* yout; /* [ny*nx] */
+};
+
+struct py_mapping_batch_t {
+  PyObject* callback;
+  /* Extent of the positions that will be requested */
+  double xlim;
+  double ylim;
+  integer_t next;
+  struct py_mapping_block_t block[PY_MAPPING_NBLOCKS];
+};
+
+static void
+py_mapping_batch_init(struct py_mapping_batch_t* batch, PyObject* callback,
+                      const double xlim, const double ylim) {
+  memset(batch, 0, sizeof(struct py_mapping_batch_t));
+  batch->callback = callback;
+  batch->xlim = xlim;
+  batch->ylim = ylim;
+}
+
+static void
+py_mapping_batch_free(struct py_mapping_batch_t* batch) {
+  integer_t i;
+
+  for (i = 0; i < PY_MAPPING_NBLOCKS; ++i) {
+    Py_XDECREF(batch->block[i].xout);
+    Py_XDECREF(batch->block[i].yout);
+    batch->block[i].xout = NULL;
+    batch->block[i].yout = NULL;
+    batch->block[i].nx = batch->block[i].ny = 0;
+  }
+}
+
+/* Index of (x, y) within the block, or -1 if it is not one of its points */
+static inline npy_intp
+py_mapping_block_index(const struct py_mapping_block_t* b,
+                       const double x, const double y) {
+  double i, j;
+
+  if (b->xout == NULL) {
+    return -1;
+  }
+
+  i = x - b->x0;
+  j = y - b->y0;
+  if (i < 0.0 || j < 0.0 || i >= (double)b->nx || j >= (double)b->ny ||
+      i != floor(i) || j != floor(j)) {
+    return -1;
+  }
+
+  return (npy_intp)j * (npy_intp)b->nx + (npy_intp)i;
+}
+
+/*
+ Evaluate the Python mapping on the block of rows starting at line y,
+ with the columns offset from x by whole pixels.
+*/
+static int
+py_mapping_block_fill(struct py_mapping_batch_t* batch,
+                      struct py_mapping_block_t* b,
+                      const double x, const double y, const integer_t n) {
+  PyArrayObject* py_xin = NULL;
+  PyArrayObject* py_yin = NULL;
+  PyObject* callback_result = NULL;
+  PyObject* callback_tuple = NULL;
+  PyObject* py_xout_obj = NULL;
+  PyObject* py_yout_obj = NULL;
+  double *xin, *yin;
+  double x0;
+  npy_intp npts, k;
+  integer_t nx, ny, i, j;
+  int result = TRUE;
+
+  Py_XDECREF(b->xout);
+  Py_XDECREF(b->yout);
+  b->xout = b->yout = NULL;
+  b->nx = b->ny = 0;
+
+  /* Span the whole width, starting within half a pixel of zero */
+  x0 = MIN(x, x - floor(x + 0.5));
+  nx = (integer_t)floor(batch->xlim - x0) + 1;
+  nx = MAX(nx, (integer_t)(x - x0) + n);
+  ny = (integer_t)floor(batch->ylim - y) + 1;
+  ny = MAX(1, MIN(ny, PY_MAPPING_BLOCK_POINTS / nx));
+
+  npts = (npy_intp)nx * (npy_intp)ny;
+  py_xin = (PyArrayObject*)PyArray_SimpleNew(1, &npts, NPY_FLOAT64);
+  if (py_xin == NULL)
+    goto _py_mapping_block_fill_exit;
+
+  py_yin = (PyArrayObject*)PyArray_SimpleNew(1, &npts, NPY_FLOAT64);
+  if (py_yin == NULL)
+    goto _py_mapping_block_fill_exit;
+
+  xin = (double*)PyArray_DATA(py_xin);
+  yin = (double*)PyArray_DATA(py_yin);
+  for (j = 0, k = 0; j < ny; ++j) {
+    for (i = 0; i < nx; ++i, ++k) {
+      xin[k] = x0 + (double)i;
+      yin[k] = y + (double)j;
+    }
+  }
+
+  callback_result = PyObject_CallFunctionObjArgs(batch->callback, py_xin, py_yin, NULL);
+  if (callback_result == NULL)
+    goto _py_mapping_block_fill_exit;
+
+  callback_tuple = PySequence_Tuple(callback_result);
+  if (callback_tuple == NULL)
+    goto _py_mapping_block_fill_exit;
+
+  if (!PyArg_UnpackTuple(callback_tuple, "result", 2, 2, &py_xout_obj, &py_yout_obj))
+    goto _py_mapping_block_fill_exit;
+
+  b->xout = (PyArrayObject*)PyArray_ContiguousFromAny(py_xout_obj, NPY_FLOAT64, 1, 1);
+  if (b->xout == NULL)
+    goto _py_mapping_block_fill_exit;
+
+  b->yout = (PyArrayObject*)PyArray_ContiguousFromAny(py_yout_obj, NPY_FLOAT64, 1, 1);
+  if (b->yout == NULL)
+    goto _py_mapping_block_fill_exit;
+
+  if (PyArray_DIM(b->xout, 0) != npts || PyArray_DIM(b->yout, 0) != npts) {
+    PyErr_Format(PyExc_ValueError,
+                 "Returned arrays must be same dimension as passed-in arrays.  Expected '%ld', got '%ld'",
+                 (long)npts, (long)PyArray_DIM(b->xout, 0));
+    goto _py_mapping_block_fill_exit;
+  }
+
+  b->x0 = x0;
+  b->y0 = y;
+  b->nx = nx;
+  b->ny = ny;
+
+  result = FALSE;
+
+ _py_mapping_block_fill_exit:
+  Py_XDECREF(py_xin);
+  Py_XDECREF(py_yin);
+  Py_XDECREF(callback_result);
+  Py_XDECREF(callback_tuple);
+
+  if (result) {
+    Py_XDECREF(b->xout);
+    Py_XDECREF(b->yout);
+    b->xout = b->yout = NULL;
+  }
+
+  return result;
+}
+
+/*
+ Pick the block to refill for a position: the one on the same grid,
+ whose rows have all been used by now, or else the next one in turn.
+*/
+static struct py_mapping_block_t*
+py_mapping_block_evict(struct py_mapping_batch_t* batch,
+                       const double x, const double y) {
+  struct py_mapping_block_t* b;
+  double dx, dy;
+  integer_t i;
+
+  for (i = 0; i < PY_MAPPING_NBLOCKS; ++i) {
+    b = &batch->block[i];
+    if (b->xout == NULL) {
+      return b;
+    }
+    dx = x - b->x0;
+    dy = y - b->y0;
+    if (dx == floor(dx) && dy == floor(dy)) {
+      return b;
+    }
+  }
+
+  b = &batch->block[batch->next];
+  batch->next = (batch->next + 1) % PY_MAPPING_NBLOCKS;
+  return b;
+}
+
+/*
+ Mapping callback serving positions from row blocks of a Python mapping.
+*/
+static int
+py_mapping_batch_callback(void* state,
+                          const double xd, const double yd,
+                          const integer_t n,
+                          double* xin /*[n]*/, double* yin /*[n]*/,
+                          /* Output parameters */
+                          double* xout, double* yout,
+                          struct driz_error_t* error) {
+  struct py_mapping_batch_t* batch = (struct py_mapping_batch_t*)state;
+  struct py_mapping_block_t* b = NULL;
+  npy_intp k;
+  integer_t i, ib;
+  bool_t refilled = FALSE;
+
+  if (n < 1) {
+    return 0;
+  }
+
+  for (i = 0; i < n; ++i) {
+    /* Try the block that served the previous position first */
+    k = (b == NULL) ? -1 : py_mapping_block_index(b, xin[i], yin[i]);
+    for (ib = 0; k < 0 && ib < PY_MAPPING_NBLOCKS; ++ib) {
+      b = &batch->block[ib];
+      k = py_mapping_block_index(b, xin[i], yin[i]);
+    }
+
+    if (k < 0 && !refilled) {
+      /* Only a single row along a unit grid is worth a new block */
+      if (yin[n-1] == yin[0] && xin[n-1] - xin[0] == floor(xin[n-1] - xin[0])) {
+        b = py_mapping_block_evict(batch, xin[i], yin[i]);
+        if (py_mapping_block_fill(batch, b, xin[i], yin[i], n - i)) {
+          driz_error_set_message(error, "<PYTHON>");
+          return 1;
+        }
+        k = py_mapping_block_index(b, xin[i], yin[i]);
+      }
+      refilled = TRUE;
+    }
+
+    if (k < 0) {
+      return py_mapping_callback(batch->callback, xd, yd, n,
+                                 xin, yin, xout, yout, error);
+    }
+
+    xout[i] = ((double*)PyArray_DATA(b->xout))[k];
+    yout[i] = ((double*)PyArray_DATA(b->yout))[k];
+  }
+
+  return 0;
+}
+
 /**
 
 Code to implement the WCS-based C interface for the mapping.
@@ -165,9 +426,15 @@ PyWCSMap_init(PyWCSMap *self, PyObject *args, PyObject *kwds)
   /* Arguments in the order they appear */
   PyObject *input_obj = NULL;
   PyObject *output_obj = NULL;
+  PyObject *table_obj = Py_None;
+  PyArrayObject *table = NULL;
   int nx, ny;
   double factor;
+  double max_error = 0.0;
+  npy_intp table_size;
   int status = -1;
+  static char *kwlist[] = {"input", "output", "nx", "ny", "factor",
+                           "table", "max_error", NULL};
 
   /* Other miscellaneous local variables */
   struct driz_error_t error;
@@ -175,18 +442,54 @@ PyWCSMap_init(PyWCSMap *self, PyObject *args, PyObject *kwds)
 
   driz_error_init(&error);
 
-  /* TODO: Make factor a kwarg */
-  if (! PyArg_ParseTuple(args, "OOiid:DefaultWCSMapping.__init__",
-                         &input_obj, &output_obj, &nx, &ny, &factor)){
+  if (! PyArg_ParseTupleAndKeywords(args, kwds,
+                                    "OOiid|Od:DefaultWCSMapping.__init__",
+                                    kwlist, &input_obj, &output_obj, &nx,
+                                    &ny, &factor, &table_obj, &max_error)){
+    goto exit;
+  }
+
+  if (max_error > 0.0 && (factor <= 0.0 || table_obj != Py_None)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "An adaptive mapping requires a positive step size and no table");
     goto exit;
   }
 
-  /* Create the C struct from all of these mapping parameters */
-  istat = default_wcsmap_init(
-      &self->m,
-      &((Wcs*)input_obj)->x, &((Wcs*)output_obj)->x,
-      nx, ny, factor,
-      &error);
+  if (table_obj != Py_None) {
+    /* Re-use a table computed earlier for the same pair of WCSs */
+    table = (PyArrayObject *)PyArray_ContiguousFromAny(table_obj, NPY_FLOAT64, 1, 3);
+    if (table == NULL) {
+      goto exit;
+    }
+
+    table_size = (factor > 0) ?
+      (npy_intp)((int)((double)nx / factor) + 2) *
+      (npy_intp)((int)((double)ny / factor) + 2) * 2 : 0;
+    if (PyArray_SIZE(table) != table_size) {
+      PyErr_Format(PyExc_ValueError,
+                   "Mapping table does not match the image size and step size.  Expected %d values, got %d",
+                   (int)table_size, (int)PyArray_SIZE(table));
+      goto exit;
+    }
+
+    istat = default_wcsmap_init_table(
+        &self->m,
+        &((Wcs*)input_obj)->x, &((Wcs*)output_obj)->x,
+        nx, ny, factor, (double *)PyArray_DATA(table),
+        &error);
+  } else {
+    /* Create the C struct from all of these mapping parameters */
+    istat = default_wcsmap_init(
+        &self->m,
+        &((Wcs*)input_obj)->x, &((Wcs*)output_obj)->x,
+        nx, ny, factor,
+        &error);
+
+    /* Refine the table where the coarse table is not accurate enough */
+    if (!istat && !driz_error_is_set(&error) && max_error > 0.0) {
+      istat = default_wcsmap_refine(&self->m, max_error, &error);
+    }
+  }
 
   if (istat || driz_error_is_set(&error)) {
     if (strcmp(driz_error_get_message(&error), "<PYTHON>") != 0)
@@ -202,10 +505,78 @@ PyWCSMap_init(PyWCSMap *self, PyObject *args, PyObject *kwds)
   status = 0;
 
  exit:
+  Py_XDECREF(table);
 
   return status;
 }
 
+static PyObject*
+PyWCSMap_get_table(PyWCSMap* self, void* closure)
+{
+  npy_intp dims[3];
+  PyArrayObject* table;
+
+  if (self->m.table == NULL) {
+    Py_RETURN_NONE;
+  }
+
+  dims[0] = self->m.sny;
+  dims[1] = self->m.snx;
+  dims[2] = 2;
+
+  table = (PyArrayObject*)PyArray_SimpleNew(3, dims, NPY_FLOAT64);
+  if (table == NULL) {
+    return NULL;
+  }
+  memcpy(PyArray_DATA(table), self->m.table,
+         (size_t)PyArray_NBYTES(table));
+
+  return (PyObject*)table;
+}
+
+static PyObject*
+PyWCSMap_get_max_error(PyWCSMap* self, void* closure)
+{
+  return PyFloat_FromDouble(self->m.max_error);
+}
+
+static PyObject*
+PyWCSMap_get_achieved_error(PyWCSMap* self, void* closure)
+{
+  return PyFloat_FromDouble(self->m.achieved_error);
+}
+
+static PyObject*
+PyWCSMap_get_nevals(PyWCSMap* self, void* closure)
+{
+  return PyLong_FromLong(self->m.nevals);
+}
+
+static PyObject*
+PyWCSMap_get_nrefined(PyWCSMap* self, void* closure)
+{
+  return PyLong_FromLong(self->m.nrefined);
+}
+
+static PyGetSetDef PyWCSMap_getset[] = {
+  {(char *) "table", (getter) PyWCSMap_get_table, NULL,
+   (char *) "Copy of the interpolation table of output pixel positions (None when the WCSs are evaluated directly); this does not include the refinements of an adaptive mapping",
+   NULL},
+  {(char *) "max_error", (getter) PyWCSMap_get_max_error, NULL,
+   (char *) "Largest interpolation error (in output pixels) requested for an adaptive mapping, or 0",
+   NULL},
+  {(char *) "achieved_error", (getter) PyWCSMap_get_achieved_error, NULL,
+   (char *) "Largest interpolation error (in output pixels) found while refining an adaptive mapping",
+   NULL},
+  {(char *) "nevals", (getter) PyWCSMap_get_nevals, NULL,
+   (char *) "Number of positions where the WCSs were evaluated to refine an adaptive mapping",
+   NULL},
+  {(char *) "nrefined", (getter) PyWCSMap_get_nrefined, NULL,
+   (char *) "Number of cells of the interpolation table refined by an adaptive mapping",
+   NULL},
+  {NULL}  /* Sentinel */
+};
+
 static PyObject*
 PyWCSMap_call(PyWCSMap* self, PyObject* args, PyObject* kwargs)
 {
@@ -302,7 +673,7 @@ static PyTypeObject WCSMapType = {
   0,                                               /*tp_setattro*/
   0,                                               /*tp_as_buffer*/
   (long) Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
-  (char *) "DefaultWCSMapping(input,output)",      /* tp_doc */
+  (char *) "DefaultWCSMapping(input,output,nx,ny,factor[,table])", /* tp_doc */
   0,                                               /* tp_traverse */
   0,                                               /* tp_clear */
   0,                                               /* tp_richcompare */
@@ -311,7 +682,7 @@ static PyTypeObject WCSMapType = {
   0,                                               /* tp_iternext */
   0,                                               /* tp_methods */
   0,                                               /* tp_members */
-  0,                                               /* tp_getset */
+  PyWCSMap_getset,                                 /* tp_getset */
   0,                                               /* tp_base */
   0,                                               /* tp_dict */
   0,                                               /* tp_descr_get */
@@ -336,6 +707,9 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   char *fillstr;
   integer_t nmiss, nskip, vflag;
   PyObject *callback_obj;
+  integer_t nthreads = 1;
+  integer_t exact_kernel = 0;
+  integer_t frame_nx = 0, frame_ny = 0;
 
   /* Derived values */
   PyArrayObject *img = NULL, *wei = NULL, *out = NULL, *wht = NULL, *con = NULL;
@@ -348,6 +722,7 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   float fill_value;
   mapping_callback_t callback = NULL;
   void* callback_state = NULL;
+  struct py_mapping_batch_t batch;
   int istat = 0;
   struct driz_error_t error;
   struct driz_param_t p;
@@ -357,13 +732,15 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   /* double delta_time; */
 
   driz_error_init(&error);
+  py_mapping_batch_init(&batch, NULL, 0.0, 0.0);
 
-  if (!PyArg_ParseTuple(args,"OOOOOllllldddsdssffsiiiO:tdriz",
+  if (!PyArg_ParseTuple(args,"OOOOOllllldddsdssffsiiiO|iiii:tdriz",
                         &oimg, &owei, &oout, &owht, &ocon, &uniqid, &ystart,
                         &xmin, &ymin, &dny, &scale, &xscale, &yscale,
                         &align_str, &pfract, &kernel_str, &inun_str,
                         &expin, &wtscl, &fillstr, &nmiss,&nskip, &vflag,
-                        &callback_obj)) {
+                        &callback_obj, &nthreads, &exact_kernel,
+                        &frame_nx, &frame_ny)) {
     return PyErr_Format(gl_Error, "cdriz.tdriz: Invalid Parameters.");
   }
 
@@ -390,8 +767,19 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
     callback_state = (void *)&(((PyWCSMap *)callback_obj)->m);
     /*scale = ((PyWCSMap *)callback_obj)->m.scale; */
   } else {
-    callback = py_mapping_callback;
-    callback_state = (void *)callback_obj;
+    callback = py_mapping_batch_callback;
+    callback_state = (void *)&batch;
+  }
+
+  /* Only the interpolated default mapping is safe to call without the
+     GIL and from several threads at once; anything else has to call
+     back into Python (or wcslib) and is done serially */
+  if (callback != default_wcsmap ||
+      ((struct wcsmap_param_t *)callback_state)->factor <= 0) {
+    nthreads = 1;
+  }
+  if (nthreads < 1) {
+    nthreads = 1;
   }
 
   /* Get raw C-array data */
@@ -463,6 +851,11 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   onx = PyArray_DIMS(out)[1];
   ony = PyArray_DIMS(out)[0];
 
+  if (callback == py_mapping_batch_callback) {
+    py_mapping_batch_init(&batch, callback_obj,
+                          (double)nx + 1.0, (double)(ystart + dny) + 1.0);
+  }
+
   nmiss = 0;
   nskip = 0;
 
@@ -479,8 +872,15 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   p.dnx = nx;
   p.dny = ny;
   p.ny = dny;
-  p.onx = p.xmax = onx;
-  p.ony = p.ymax = ony;
+  /* The output arrays may be a section of a larger output frame,
+     starting at (xmin, ymin) */
+  p.onx = onx;
+  p.ony = ony;
+  p.xmax = xmin + onx - 1;
+  p.ymax = ymin + ony - 1;
+  /* The frame extends at least as far as the output arrays */
+  p.frame_nx = MAX(frame_nx, p.xmax);
+  p.frame_ny = MAX(frame_ny, p.ymax);
   p.scale = scale;
   p.x_scale = xscale;
   p.y_scale = yscale;
@@ -492,6 +892,8 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   p.weight_scale = wtscl;
   p.mapping_callback = callback;
   p.mapping_callback_state = callback_state;
+  p.nthreads = nthreads;
+  p.exact_kernel = exact_kernel ? TRUE : FALSE;
 
   /* Setup reasonable defaults for drizzling */
   p.no_over = FALSE;
@@ -500,7 +902,15 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   start_t = clock();
   */
   /* Do the drizzling */
-  if (dobox(&p, ystart, &nmiss, &nskip, &error)) {
+  if (callback == default_wcsmap &&
+      ((struct wcsmap_param_t *)callback_state)->factor > 0) {
+    Py_BEGIN_ALLOW_THREADS
+    istat = dobox(&p, ystart, &nmiss, &nskip, &error);
+    Py_END_ALLOW_THREADS
+  } else {
+    istat = dobox(&p, ystart, &nmiss, &nskip, &error);
+  }
+  if (istat) {
     goto _exit;
   }
   /*
@@ -527,6 +937,7 @@ tdriz(PyObject *obj UNUSED_PARAM, PyObject *args)
   Py_XDECREF(wei);
   Py_XDECREF(out);
   Py_XDECREF(wht);
+  py_mapping_batch_free(&batch);
 
   if (istat || driz_error_is_set(&error)) {
     if (strcmp(driz_error_get_message(&error), "<PYTHON>") != 0)
@@ -641,12 +1052,14 @@ tblot(PyObject *obj, PyObject *args)
   enum e_interp_t interp;
   mapping_callback_t callback = NULL;
   void *callback_state = NULL;
+  struct py_mapping_batch_t batch;
   long nx,ny,onx,ony;
   int istat = 0;
   struct driz_error_t error;
   struct driz_param_t p;
 
   driz_error_init(&error);
+  py_mapping_batch_init(&batch, NULL, 0.0, 0.0);
 
   if (!PyArg_ParseTuple(args,"OOlllldfddssffflO:tblot", &oimg, &oout, &xmin,
                         &xmax, &ymin, &ymax, &scale, &kscale, &xscale,
@@ -666,8 +1079,15 @@ tblot(PyObject *obj, PyObject *args)
     goto _exit;
   }
 
-  callback = py_mapping_callback;
-  callback_state = (void *)callback_obj;
+  if (PyObject_TypeCheck(callback_obj, &WCSMapType)) {
+    /* If we're using the default mapping, we can set things up to avoid
+       the Python/C bridge */
+    callback = default_wcsmap;
+    callback_state = (void *)&(((PyWCSMap *)callback_obj)->m);
+  } else {
+    callback = py_mapping_batch_callback;
+    callback_state = (void *)&batch;
+  }
 
   img = (PyArrayObject *)PyArray_ContiguousFromAny(oimg, NPY_FLOAT32, 2, 2);
   if (!img) {
@@ -690,6 +1110,11 @@ tblot(PyObject *obj, PyObject *args)
   onx = PyArray_DIMS(out)[1];
   ony = PyArray_DIMS(out)[0];
 
+  if (callback == py_mapping_batch_callback) {
+    py_mapping_batch_init(&batch, callback_obj,
+                          (double)onx + 1.0, (double)ony + 1.0);
+  }
+
   driz_param_init(&p);
 
   p.data = PyArray_DATA(img);
@@ -715,11 +1140,21 @@ tblot(PyObject *obj, PyObject *args)
   p.mapping_callback = callback;
   p.mapping_callback_state = callback_state;
 
-  istat = doblot(&p, &error);
+  /* Only the interpolated default mapping can be used without the GIL,
+     so that several images can be blotted at once by as many threads */
+  if (callback == default_wcsmap &&
+      ((struct wcsmap_param_t *)callback_state)->factor > 0) {
+    Py_BEGIN_ALLOW_THREADS
+    istat = doblot(&p, &error);
+    Py_END_ALLOW_THREADS
+  } else {
+    istat = doblot(&p, &error);
+  }
 
  _exit:
-  Py_DECREF(img);
-  Py_DECREF(out);
+  Py_XDECREF(img);
+  Py_XDECREF(out);
+  py_mapping_batch_free(&batch);
 
   if (istat || driz_error_is_set(&error)) {
     if (strcmp(driz_error_get_message(&error), "<PYTHON>") != 0)
@@ -735,18 +1170,14 @@ tblot(PyObject *obj, PyObject *args)
 void cdriz_log_func(const char *format, ...) {
   static PyObject *logging = NULL;
   va_list args;
-  PyObject *logger;
-  PyObject *string;
+  PyObject *logger = NULL;
+  PyObject *string = NULL;
+  PyGILState_STATE gstate;
   char msg[256];
   int n;
 
   va_start(args, format);
 
-  if (logging == NULL) {
-    logging = PyImport_ImportModuleNoBlock("logging");
-    if (logging == NULL) return;
-  }
-
   n = PyOS_vsnprintf(msg, sizeof(msg), format, args);
 
   va_end(args);
@@ -756,21 +1187,28 @@ void cdriz_log_func(const char *format, ...) {
     return;
   }
 
+  /* We may be called while drizzling with the GIL released */
+  gstate = PyGILState_Ensure();
+
+  if (logging == NULL) {
+    logging = PyImport_ImportModuleNoBlock("logging");
+    if (logging == NULL) goto _exit;
+  }
+
   /* XXX: Provide a way to specify the log level to use */
   string = Py_BuildValue("s", msg);
-  if (string == NULL) return;
+  if (string == NULL) goto _exit;
 
   logger = PyObject_CallMethod(logging, "getLogger", "s",
                                "drizzlepac.cdriz");
-  if (logger == NULL) {
-      Py_XDECREF(string);
-      return;
-  }
+  if (logger == NULL) goto _exit;
 
   PyObject_CallMethod(logger, "info", "O", string);
 
+ _exit:
   Py_XDECREF(logger);
   Py_XDECREF(string);
+  PyGILState_Release(gstate);
   return;
 }
 
@@ -1163,14 +1601,162 @@ arrxyzero(PyObject *obj, PyObject *args)
   return PyArray_Return(ozpmat);
 }
 
+static PyObject *
+combine_stack_optional(PyObject *obj, const int typenum, const int ndim)
+{
+  if (obj == NULL || obj == Py_None) {
+    return NULL;
+  }
+  return PyArray_ContiguousFromAny(obj, typenum, ndim, ndim);
+}
+
+static PyObject *
+combine_stack_result(PyArrayObject *arr)
+{
+  return arr ? (PyObject *)arr : Py_None;
+}
+
+static PyObject *
+combine_stack(PyObject *obj, PyObject *args, PyObject *kwds)
+{
+  static char *kwlist[] = {"data", "weights", "thresholds", "masks", "nlow",
+                           "nhigh", "average", "bkgscale", "rdnoise2", NULL};
+
+  /* Arguments in the order they appear */
+  PyObject *odata, *oweights = NULL, *othresh = NULL, *omasks = NULL;
+  PyObject *obkgscale = NULL, *ordnoise2 = NULL;
+  long nlow = 0, nhigh = 0;
+  int average = 0;
+
+  /* Derived values */
+  PyArrayObject *data = NULL, *weights = NULL, *thresh = NULL, *masks = NULL;
+  PyArrayObject *bkgscale = NULL, *rdnoise2 = NULL;
+  PyArrayObject *median = NULL, *minimum = NULL, *ngood = NULL;
+  PyArrayObject *weight_sum = NULL, *bkgd = NULL, *readnoise = NULL;
+  PyObject *result = NULL;
+  npy_intp dims[2];
+  struct combine_param_t p;
+  struct driz_error_t error;
+  int istat = 0;
+
+  driz_error_init(&error);
+  memset(&p, 0, sizeof(p));
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OOOllpOO:combine_stack",
+                                   kwlist, &odata, &oweights, &othresh,
+                                   &omasks, &nlow, &nhigh, &average,
+                                   &obkgscale, &ordnoise2)) {
+    return NULL;
+  }
+
+  data = (PyArrayObject *)PyArray_ContiguousFromAny(odata, NPY_FLOAT32, 3, 3);
+  if (!data) {
+    goto _exit;
+  }
+  weights = (PyArrayObject *)combine_stack_optional(oweights, NPY_FLOAT32, 3);
+  thresh = (PyArrayObject *)combine_stack_optional(othresh, NPY_FLOAT64, 1);
+  masks = (PyArrayObject *)combine_stack_optional(omasks, NPY_UINT8, 3);
+  bkgscale = (PyArrayObject *)combine_stack_optional(obkgscale, NPY_FLOAT64, 1);
+  rdnoise2 = (PyArrayObject *)combine_stack_optional(ordnoise2, NPY_FLOAT64, 1);
+  if (PyErr_Occurred()) {
+    goto _exit;
+  }
+
+  if ((weights && !PyArray_SAMESHAPE(weights, data)) ||
+      (masks && !PyArray_SAMESHAPE(masks, data))) {
+    driz_error_set_message(&error, "Weights and masks must have the shape of the data");
+    goto _exit;
+  }
+  if ((thresh && PyArray_DIMS(thresh)[0] != PyArray_DIMS(data)[0]) ||
+      (bkgscale && PyArray_DIMS(bkgscale)[0] != PyArray_DIMS(data)[0]) ||
+      (rdnoise2 && PyArray_DIMS(rdnoise2)[0] != PyArray_DIMS(data)[0])) {
+    driz_error_set_message(&error, "Need one threshold, background and readnoise per image");
+    goto _exit;
+  }
+  if (nlow < 0 || nhigh < 0) {
+    driz_error_set_message(&error, "nlow and nhigh must not be negative");
+    goto _exit;
+  }
+
+  dims[0] = PyArray_DIMS(data)[1];
+  dims[1] = PyArray_DIMS(data)[2];
+  median = (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_FLOAT32);
+  minimum = (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_FLOAT32);
+  ngood = (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_INT32);
+  if (weights) {
+    weight_sum = (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_FLOAT32);
+    if (bkgscale) {
+      bkgd = (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_FLOAT64);
+    }
+  }
+  if (rdnoise2) {
+    readnoise = (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_FLOAT64);
+  }
+  if (PyErr_Occurred()) {
+    goto _exit;
+  }
+
+  p.nimages = (integer_t)PyArray_DIMS(data)[0];
+  p.npix = (size_t)(dims[0] * dims[1]);
+  p.data = (float *)PyArray_DATA(data);
+  p.weights = weights ? (float *)PyArray_DATA(weights) : NULL;
+  p.masks = masks ? (unsigned char *)PyArray_DATA(masks) : NULL;
+  p.thresholds = thresh ? (double *)PyArray_DATA(thresh) : NULL;
+  p.nlow = (integer_t)nlow;
+  p.nhigh = (integer_t)nhigh;
+  p.average = average ? TRUE : FALSE;
+  p.bkgd_scale = bkgscale ? (double *)PyArray_DATA(bkgscale) : NULL;
+  p.rdnoise2 = rdnoise2 ? (double *)PyArray_DATA(rdnoise2) : NULL;
+  p.median = (float *)PyArray_DATA(median);
+  p.minimum = (float *)PyArray_DATA(minimum);
+  p.ngood = (integer_t *)PyArray_DATA(ngood);
+  p.weight_sum = weight_sum ? (float *)PyArray_DATA(weight_sum) : NULL;
+  p.bkgd = bkgd ? (double *)PyArray_DATA(bkgd) : NULL;
+  p.readnoise = readnoise ? (double *)PyArray_DATA(readnoise) : NULL;
+
+  /* The stack is only read and the outputs are ours, so several sections
+     can be combined at once from different threads */
+  Py_BEGIN_ALLOW_THREADS
+  istat = docombine(&p, &error);
+  Py_END_ALLOW_THREADS
+
+  if (istat == 0) {
+    result = Py_BuildValue("OOOOOO", median, minimum, ngood,
+                           combine_stack_result(weight_sum),
+                           combine_stack_result(bkgd),
+                           combine_stack_result(readnoise));
+  }
+
+ _exit:
+  Py_XDECREF(data);
+  Py_XDECREF(weights);
+  Py_XDECREF(thresh);
+  Py_XDECREF(masks);
+  Py_XDECREF(bkgscale);
+  Py_XDECREF(rdnoise2);
+  Py_XDECREF(median);
+  Py_XDECREF(minimum);
+  Py_XDECREF(ngood);
+  Py_XDECREF(weight_sum);
+  Py_XDECREF(bkgd);
+  Py_XDECREF(readnoise);
+
+  if (result == NULL && !PyErr_Occurred()) {
+    PyErr_SetString(PyExc_Exception, driz_error_is_set(&error) ?
+                    driz_error_get_message(&error) : "cdriz.combine_stack failed");
+  }
+  return result;
+}
+
 static PyMethodDef cdriz_methods[] =
   {
-    {"tdriz",  tdriz, METH_VARARGS, "tdriz(image, weight, output, outweight, context, uniqid, ystart, xmin, ymin, dny, scale, xscale, yscale, align, pfrace, kernel, inun, expin, wtscl, fill, nmiss, nskip, vflag, callback)"},
+    {"tdriz",  tdriz, METH_VARARGS, "tdriz(image, weight, output, outweight, context, uniqid, ystart, xmin, ymin, dny, scale, xscale, yscale, align, pfrace, kernel, inun, expin, wtscl, fill, nmiss, nskip, vflag, callback, num_threads=1, exact_kernel=0, frame_nx=0, frame_ny=0)"},
     /*{"twdriz",  tdriz, METH_VARARGS, "triz(image, weight, output, outweight, ystart, xmin, ymin, dny, wcsin, wcsout,pxg,pyg,pfract, kernel, coeffs, fillstr,nmiss,nskip,vflag)"},*/
     {"tblot",  tblot, METH_VARARGS, "tblot(image, output, xmin, xmax, ymin, ymax, scale, kscale, xscale, yscale, align, interp, ef, misval, sinscl, vflag, callback)"},
     {"arrmoments", arrmoments, METH_VARARGS, "arrmoments(image, p, q)"},
     {"arrxyround", arrxyround, METH_VARARGS, "arrxyround(data,x0,y0,skymode,ker2d,xsigsq,ysigsq,datamin,datamax)"},
     {"arrxyzero", arrxyzero, METH_VARARGS, "arrxyzero(imgxy,refxy,searchrad,zpmat)"},
+    {"combine_stack", (PyCFunction)combine_stack, METH_VARARGS | METH_KEYWORDS, "combine_stack(data, weights=None, thresholds=None, masks=None, nlow=0, nhigh=0, average=False, bkgscale=None, rdnoise2=None) -> (median, minimum, ngood, weight_sum, bkgd, readnoise)"},
     {0, 0, 0, 0}                             /* sentinel */
   };
 
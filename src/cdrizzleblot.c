@@ -984,7 +984,7 @@ doblot(struct driz_param_t* p,
   double *ytmp = NULL;
   double *yout = NULL;
   integer_t nmiss;
-  double dx, dy;
+  float dx, dy;
   double yv;
   float xo, yo, v;
   /*float nx, ny;*/
@@ -1086,9 +1086,12 @@ doblot(struct driz_param_t* p,
   ny = (float)(p->ymax - p->ymin + 1);
   */
 
-  /* Offsets */
-  dx = (double)(p->xmin);
-  dy = (double)(p->ymin);
+  /* Offsets of the input (sub-)image, which get applied after rounding
+     the positions in the full image to float, so that blotting from a
+     sub-image gives the same positions, and values, as from the full
+     image */
+  dx = (float)(p->xmin - 1);
+  dy = (float)(p->ymin - 1);
 
   /* Recalculate the area scaling factor */
   assert(p->scale != 0.0);
@@ -1115,8 +1118,8 @@ doblot(struct driz_param_t* p,
 
     /* Loop through the output positions and do the interpolation */
     for (i = 0; i < p->onx; ++i) {
-      xo = (float)(xout[i] - dx);
-      yo = (float)(yout[i] - dy);
+      xo = (float)(xout[i] - 1.0) - dx;
+      yo = (float)(yout[i] - 1.0) - dy;
 
       /* Check it is on the input image */
       if (xo >= 0.0 && xo <= p->dnx &&
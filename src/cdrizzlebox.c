@@ -8,6 +8,8 @@
 #include "cdrizzleutil.h"
 
 #include <assert.h>
+#include <limits.h>
+#include <string.h>
 #define _USE_MATH_DEFINES       /* needed for MS Windows to define M_PI */
 #include <math.h>
 #include <stdio.h>
@@ -30,6 +32,58 @@ mapping_ptr(struct driz_param_t* p, double* arr, integer_t i0) {
   return (arr + i0);
 }
 
+/**
+Find the points of a line, transformed onto the output, which lie on a
+segment of the line overlapping the box [xlo, xhi) x [ylo, yhi), and
+return how many there are, along with the first and last of them widened
+by one more point on either side.
+*/
+#define CHECK_OVER_NPOINT 21
+
+static integer_t
+overlap_points(const integer_t np, const double* xout, const double* yout,
+               const double xlo, const double xhi,
+               const double ylo, const double yhi,
+               /* Output parameters */
+               integer_t* first, integer_t* last) {
+  integer_t logo[CHECK_OVER_NPOINT];
+  integer_t i, nhit;
+
+  for (i = 0; i < np; ++i) {
+    logo[i] = 0;
+  }
+
+  for (i = 0; i < np - 1; ++i) {
+    if (MAX(xout[i], xout[i+1]) >= xlo &&
+        MIN(xout[i], xout[i+1]) < xhi &&
+        MAX(yout[i], yout[i+1]) >= ylo &&
+        MIN(yout[i], yout[i+1]) < yhi) {
+      logo[i] = 1;
+      logo[i+1] = 1;
+    }
+  }
+
+  nhit = 0;
+  *first = 0;
+  *last = 0;
+  for (i = 0; i < np; ++i) {
+    if (logo[i]) {
+      if (nhit == 0) {
+        *first = i;
+      }
+      *last = i;
+      ++nhit;
+    }
+  }
+
+  if (nhit > 0) {
+    *first = MAX(*first - 1, 0);
+    *last = MIN(*last + 1, np - 1);
+  }
+
+  return nhit;
+}
+
 /**
 Check how much of a line will overlap an output image, if any,
 after applying the standard drizzle transformation.
@@ -37,10 +91,14 @@ after applying the standard drizzle transformation.
 This is intended to allow the number of points which are needlessly
 drizzled outside the output image to be minimized.
 
+Lines are kept where they land within margin pixels of the output frame.
+When only a section of the frame gets drizzled, they are also cut down to
+where they land close enough for the kernel to reach into that section,
+so that the section receives the same flux as it would from drizzling
+the whole frame.
+
 was: CHOVER
 */
-#define CHECK_OVER_NPOINT 21
-
 static int
 check_over(struct driz_param_t* p, const integer_t y, const integer_t margin,
            /* Output parameters */
@@ -50,9 +108,8 @@ check_over(struct driz_param_t* p, const integer_t y, const integer_t margin,
   double xval[CHECK_OVER_NPOINT], yval[CHECK_OVER_NPOINT];
   double xtmp[CHECK_OVER_NPOINT], ytmp[CHECK_OVER_NPOINT];
   double xout[CHECK_OVER_NPOINT], yout[CHECK_OVER_NPOINT];
-  integer_t logo[CHECK_OVER_NPOINT];
-  integer_t step, first, last;
-  integer_t nhit, nmiss;
+  integer_t step, first, last, sfirst, slast;
+  integer_t nhit, reach;
   integer_t i, np;
 
   assert(p);
@@ -84,30 +141,31 @@ check_over(struct driz_param_t* p, const integer_t y, const integer_t margin,
   if (map_value(p, FALSE, np, xval, yval, xtmp, ytmp, xout, yout, error))
     return 1;
 
-  /* Check where the overlap starts and ends */
-  for (i = 0; i < np; ++i) {
-    logo[i] = 0;
-  }
-
-  for (i = 0; i < np - 1; ++i) {
-    if (MAX(xout[i], xout[i+1]) >= 1.0 - (double)margin &&
-        MIN(xout[i], xout[i+1]) < (double)(p->onx + margin) &&
-        MAX(yout[i], yout[i+1]) >= 1.0 - (double)margin &&
-        MIN(yout[i], yout[i+1]) < (double)(p->ony + margin)) {
-      logo[i] = 1;
-      logo[i+1] = 1;
-    }
-  }
-
-  nhit = 0;
-  for (i = 0; i < np; ++i) {
-    if (logo[i]) {
-      ++nhit;
+  /* Check where the overlap with the output frame starts and ends */
+  nhit = overlap_points(np, xout, yout,
+                        1.0 - (double)margin, (double)(p->frame_nx + margin),
+                        1.0 - (double)margin, (double)(p->frame_ny + margin),
+                        &first, &last);
+
+  /* and with the section of it being drizzled, padded by the size of the
+     kernel.  This does not change anything when drizzling the whole frame,
+     since the padding is at least margin pixels. */
+  if (nhit > 0) {
+    reach = MAX(margin, (integer_t)ceil(p->pfo) + 1);
+    if (overlap_points(np, xout, yout,
+                       (double)(p->xmin - reach), (double)(p->xmax + reach),
+                       (double)(p->ymin - reach), (double)(p->ymax + reach),
+                       &sfirst, &slast) == 0) {
+      nhit = 0;
+    } else {
+      first = MAX(first, sfirst);
+      last = MIN(last, slast);
+      if (first > last) {
+        nhit = 0;
+      }
     }
   }
 
-  nmiss = np - nhit;
-
   if (nhit == 0) {
     *ofrac = 0.0;
     *x1 = 0;
@@ -115,30 +173,9 @@ check_over(struct driz_param_t* p, const integer_t y, const integer_t margin,
     return 0;
   }
 
-  first = 0;
-  last = 0;
-
-  for (i = 0; i < np; ++i) {
-    if (logo[i]) {
-      first = i;
-      break;
-    }
-  }
-
-  for (i = np - 1; i >= 0; --i) {
-    if (logo[i]) {
-      last = i;
-      break;
-    }
-  }
-
-  if (nhit == 0 && nmiss == 0) {
-    *ofrac = 0.0;
-  } else {
-    *ofrac = (double)nhit / (double)(nhit + nmiss);
-  }
-  *x1 = (first > 0) ? (integer_t)xval[first - 1] : (integer_t)xval[0];
-  *x2 = (last < np - 1) ? (integer_t)xval[last + 1] : (integer_t)xval[np - 1];
+  *ofrac = (double)nhit / (double)np;
+  *x1 = (integer_t)xval[first];
+  *x2 = (integer_t)xval[last];
 
   assert(*x1 > 0 && *x1 <= p->dnx);
   assert(*x2 > 0 && *x2 <= p->dnx);
@@ -337,6 +374,28 @@ update_data(struct driz_param_t* p, const integer_t ii, const integer_t jj,
   *output_counts_ptr(p, ii, jj) = vc_plus_dow;
 }
 
+/**
+Account for whether the input pixel (xarr, yarr) landed on the output.
+
+When drizzling in a single thread a pixel with no hits is counted as a
+miss straight away.  When the output is split into bands a pixel may
+legitimately miss the band of one thread while hitting another, so
+only the hits are recorded here and the misses are tallied once all of
+the threads are done.
+*/
+static inline_macro void
+record_hits(struct driz_param_t* p, const integer_t xarr, const integer_t yarr,
+            const integer_t nhit, integer_t* nmiss) {
+  size_t k;
+
+  if (p->hit_mask == NULL) {
+    if (nhit == 0) ++(*nmiss);
+  } else if (nhit > 0) {
+    k = (size_t)yarr * (size_t)p->dnx + (size_t)xarr;
+    p->hit_mask[k >> 3] |= (unsigned char)(1 << (k & 7));
+  }
+}
+
 /**
 To calculate area under a line segment within unit square at origin.
 This is used by BOXER.
@@ -539,7 +598,7 @@ do_kernel_point(struct driz_param_t* p, const integer_t j,
 
     /* Check it is on the output image */
     if (ii >= 0 && ii < p->nsx &&
-        jj >= 0 && jj < p->nsy) {
+        jj >= p->band_ymin && jj <= p->band_ymax) {
       vc = *output_counts_ptr(p, ii, jj);
     /* Convert i,j 1-based pixel positions into 0-based
        indices for accessing data array. */
@@ -564,9 +623,9 @@ do_kernel_point(struct driz_param_t* p, const integer_t j,
       }
 
       update_data(p, ii, jj, d, vc, dow);
+      record_hits(p, xarr, yarr, 1, nmiss);
     } else {
-
-      ++(*nmiss);
+      record_hits(p, i-1, j-1, 0, nmiss);
     }
   }
 
@@ -600,8 +659,8 @@ do_kernel_tophat(struct driz_param_t* p, const integer_t j,
 
     nxi = MAX(fortran_round(xxi), 0);
     nxa = MIN(fortran_round(xxa), p->nsx - 1);
-    nyi = MAX(fortran_round(yyi), 0);
-    nya = MIN(fortran_round(yya), p->nsy - 1);
+    nyi = MAX(fortran_round(yyi), p->band_ymin);
+    nya = MIN(fortran_round(yya), p->band_ymax);
 
     nhit = 0;
     /* Convert i,j 1-based pixel positions into 0-based
@@ -650,7 +709,132 @@ do_kernel_tophat(struct driz_param_t* p, const integer_t j,
     }
 
     /* Count cases where the pixel is off the output image */
-    if (nhit == 0) ++(*nmiss);
+    record_hits(p, xarr, yarr, nhit, nmiss);
+  }
+
+  return 0;
+}
+
+/**
+Evaluate the lanczos kernel of the given order at the (non-negative)
+scaled distance x.
+*/
+static inline_macro double
+lanczos_exact(const int order, const double x) {
+  double px;
+
+  if (x == 0.0) {
+    return 1.0;
+  } else if (x >= (double)order) {
+    return 0.0;
+  }
+  px = M_PI * x;
+  return sin(px) / px * sin(px / (double)order) / (px / (double)order);
+}
+
+/**
+Linearly interpolate the kernel look-up table at the (non-negative)
+tabulated argument t, in units of table samples.  Returns FALSE when t
+falls beyond the end of the table.
+*/
+static inline_macro bool_t
+interpolate_kernel_lut(const struct driz_param_t* p, const double t,
+                       double* value) {
+  size_t k;
+
+  if (t >= (double)(p->kernel_lut.nlut - 1)) {
+    return FALSE;
+  }
+  k = (size_t)t;
+  *value = p->kernel_lut.lut[k] +
+    (t - (double)k) * (p->kernel_lut.lut[k+1] - p->kernel_lut.lut[k]);
+  return TRUE;
+}
+
+/**
+The gaussian kernel at squared distance r2 from the center of the
+input pixel.
+*/
+static inline_macro double
+gaussian_value(const struct driz_param_t* p, const double r2) {
+  double value;
+
+  if (p->exact_kernel ||
+      !interpolate_kernel_lut(p, r2 * p->kernel_lut.sdp, &value)) {
+    value = p->gaussian.es * exp(-r2 * p->gaussian.efac);
+  }
+  return value;
+}
+
+/**
+The lanczos kernel at distance d (along one axis) from the center of
+the input pixel.
+*/
+static inline_macro double
+lanczos_value(const struct driz_param_t* p, const double d) {
+  const double x = fabs(d) * p->lanczos.sdp;
+  double value;
+
+  if (p->exact_kernel) {
+    return lanczos_exact(p->kernel_lut.order, x);
+  }
+  if (!interpolate_kernel_lut(p, x * p->kernel_lut.sdp, &value)) {
+    /* The table extends to the edge of the kernel */
+    value = 0.0;
+  }
+  return value;
+}
+
+/**
+Fill in the look-up table of the gaussian or lanczos kernel used by
+drizzle.  The tables are sampled finely enough for linear interpolation
+to stay within 1e-6 of the analytic kernel, relative to its peak value
+(the bounds from the second derivatives of the kernels are 5e-7 for the
+gaussian and 1.3e-7 for each axis of the lanczos kernels).
+*/
+static int
+create_kernel_lut(struct driz_param_t* p, struct driz_error_t* error) {
+  /* Sampling of the exponent of the gaussian, and its largest value
+     beyond which the kernel gets evaluated directly */
+  const double gaussian_du = 0.002;
+  const double gaussian_umax = 40.0;
+  /* Samples per unit of scaled distance for the lanczos kernels */
+  const double lanczos_nper = 2048.0;
+  double r2max, umax;
+  size_t k;
+
+  assert(p->kernel_lut.lut == NULL);
+
+  if (p->kernel == kernel_gaussian) {
+    /* Output pixels are at most pfo + 0.5 away along each axis */
+    r2max = 2.0 * (p->pfo + 0.5) * (p->pfo + 0.5);
+    umax = MIN(r2max * p->gaussian.efac, gaussian_umax);
+    p->kernel_lut.nlut = (size_t)ceil(umax / gaussian_du) + 2;
+    p->kernel_lut.sdp = p->gaussian.efac / gaussian_du;
+  } else {
+    p->kernel_lut.order = (p->kernel == kernel_lanczos2) ? 2 : 3;
+    p->kernel_lut.nlut = (size_t)(p->kernel_lut.order * lanczos_nper) + 1;
+    p->kernel_lut.sdp = lanczos_nper;
+  }
+
+  if (p->exact_kernel) {
+    return 0;
+  }
+
+  p->kernel_lut.lut = malloc(p->kernel_lut.nlut * sizeof(float));
+  if (p->kernel_lut.lut == NULL) {
+    driz_error_set_message(error, "Out of memory");
+    return 1;
+  }
+
+  for (k = 0; k < p->kernel_lut.nlut; ++k) {
+    if (p->kernel == kernel_gaussian) {
+      p->kernel_lut.lut[k] =
+        p->gaussian.es * exp(-(double)k * gaussian_du);
+    } else {
+      p->kernel_lut.lut[k] =
+        lanczos_exact(p->kernel_lut.order, (double)k / lanczos_nper);
+    }
   }
 
   return 0;
@@ -682,8 +866,8 @@ do_kernel_gaussian(struct driz_param_t* p, const integer_t j,
 
     nxi = MAX(fortran_round(xxi), 0);
     nxa = MIN(fortran_round(xxa), p->nsx - 1);
-    nyi = MAX(fortran_round(yyi), 0);
-    nya = MIN(fortran_round(yya), p->nsy - 1);
+    nyi = MAX(fortran_round(yyi), p->band_ymin);
+    nya = MIN(fortran_round(yya), p->band_ymax);
 
     nhit = 0;
     /* Convert i,j 1-based pixel positions into 0-based
@@ -713,7 +897,7 @@ do_kernel_gaussian(struct driz_param_t* p, const integer_t j,
 
         /* Weight is a scaled Gaussian function of radial
            distance */
-        dover = p->gaussian.es * exp(-r2 * p->gaussian.efac);
+        dover = gaussian_value(p, r2);
 
         /* Count the hits */
         ++nhit;
@@ -732,7 +916,7 @@ do_kernel_gaussian(struct driz_param_t* p, const integer_t j,
     }
 
     /* Count cases where the pixel is off the output image */
-    if (nhit == 0) ++(*nmiss);
+    record_hits(p, xarr, yarr, nhit, nmiss);
   }
 
   return 0;
@@ -745,9 +929,9 @@ do_kernel_lanczos(struct driz_param_t* p, const integer_t j,
                   /* Input/output parameters */
                   integer_t* oldcon, integer_t* newcon, integer_t* nmiss,
                   struct driz_error_t* error) {
-  integer_t i, ii, jj, nxi, nxa, nyi, nya, nhit, ix, iy;
+  integer_t i, ii, jj, nxi, nxa, nyi, nya, nhit;
   float vc, d, dow;
-  double xx, yy, xxi, xxa, yyi, yya, w, dx, dy, dover;
+  double xx, yy, xxi, xxa, yyi, yya, w, dx, dy, dover, doy;
   integer_t xarr,yarr;
 
   dx = (double)(p->xmin);
@@ -764,8 +948,8 @@ do_kernel_lanczos(struct driz_param_t* p, const integer_t j,
 
     nxi = MAX(fortran_round(xxi), 0);
     nxa = MIN(fortran_round(xxa), p->nsx - 1);
-    nyi = MAX(fortran_round(yyi), 0);
-    nya = MIN(fortran_round(yya), p->nsy - 1);
+    nyi = MAX(fortran_round(yyi), p->band_ymin);
+    nya = MIN(fortran_round(yya), p->band_ymax);
 
     nhit = 0;
     /* Convert i,j 1-based pixel positions into 0-based
@@ -787,13 +971,10 @@ do_kernel_lanczos(struct driz_param_t* p, const integer_t j,
 
     /* Loop over output pixels which could be affected */
     for (jj = nyi; jj <= nya; ++jj) {
+      doy = lanczos_value(p, yy - (double)jj);
       for (ii = nxi; ii <= nxa; ++ii) {
-        /* X and Y offsets */
-        ix = fortran_round(fabs(xx - (double)ii) * p->lanczos.sdp) + 1;
-        iy = fortran_round(fabs(yy - (double)jj) * p->lanczos.sdp) + 1;
-
         /* Weight is product of Lanczos function values in X and Y */
-        dover = p->lanczos.lut[ix] * p->lanczos.lut[iy];
+        dover = lanczos_value(p, xx - (double)ii) * doy;
 
         /* Count the hits */
         ++nhit;
@@ -814,7 +995,7 @@ do_kernel_lanczos(struct driz_param_t* p, const integer_t j,
     }
 
     /* Count cases where the pixel is off the output image */
-    if (nhit == 0) ++(*nmiss);
+    record_hits(p, xarr, yarr, nhit, nmiss);
   }
 
   return 0;
@@ -852,8 +1033,8 @@ do_kernel_turbo(struct driz_param_t* p, const integer_t j,
     nya = fortran_round(yya);
     iis = MAX(nxi, 0);  /* Needed to be set to 0 to avoid edge effects */
     iie = MIN(nxa, p->nsx - 1);
-    jjs = MAX(nyi, 0);  /* Needed to be set to 0 to avoid edge effects */
-    jje = MIN(nya, p->nsy - 1);
+    jjs = MAX(nyi, p->band_ymin);  /* Needed to be set to 0 to avoid edge effects */
+    jje = MIN(nya, p->band_ymax);
 
     nhit = 0;
 
@@ -903,32 +1084,28 @@ do_kernel_turbo(struct driz_param_t* p, const integer_t j,
     }
 
     /* Count cases where the pixel is off the output image */
-    if (nhit == 0) ++(*nmiss);
+    record_hits(p, xarr, yarr, nhit, nmiss);
   }
 
   return 0;
 }
 
+/**
+Transform the four corners of the shrunken input pixels x1..x2 of
+line y onto the output grid, for use by do_kernel_square.
+*/
 static int
-do_kernel_square(struct driz_param_t* p,
-                 const integer_t j, double y,
-                 const integer_t x1, const integer_t x2,
-                 const integer_t last_x1, const integer_t last_x2,
-                 /* Input/output parameters */
-                 double* xi, double* yi,
-                 double* xtmp, double* ytmp,
-                 double* xo, double* yo,
-                 integer_t* oldcon, integer_t* newcon, integer_t* nmiss,
-                 struct driz_error_t* error) {
-  integer_t i, nhit, ii, jj, min_ii, max_ii, min_jj, max_jj, n;
-  float vc, d, dow;
-  double dh, jaco, tem, dover, dx, dy, w;
-  double xout[4], yout[4];
+map_square_corners(struct driz_param_t* p, double y,
+                   const integer_t x1, const integer_t x2,
+                   /* Input/output parameters */
+                   double* xi, double* yi,
+                   double* xtmp, double* ytmp,
+                   double* xo, double* yo,
+                   struct driz_error_t* error) {
+  integer_t i, n;
+  double dh;
 
-  /* TODO: These are constant across calls -- perhaps cache??? */
   dh = 0.5 * p->pixel_fraction;
-  dx = (double)(p->xmin) - 1;
-  dy = (double)(p->ymin) - 1;
   n = x2 - x1 + 1;
 
   /* Next the "classic" drizzle square kernel...  this is different
@@ -962,6 +1139,24 @@ do_kernel_square(struct driz_param_t* p,
     }
   }
 
+  return 0;
+}
+
+static int
+do_kernel_square(struct driz_param_t* p, const integer_t j,
+                 const integer_t x1, const integer_t x2,
+                 double* xo, double* yo,
+                 /* Input/output parameters */
+                 integer_t* oldcon, integer_t* newcon, integer_t* nmiss,
+                 struct driz_error_t* error) {
+  integer_t i, nhit, ii, jj, min_ii, max_ii, min_jj, max_jj;
+  float vc, d, dow;
+  double jaco, tem, dover, dx, dy, w;
+  double xout[4], yout[4];
+
+  dx = (double)(p->xmin) - 1;
+  dy = (double)(p->ymin) - 1;
+
   for (i = x1; i <= x2; ++i) {
     /* Offset within the subset */
     for (ii = 0; ii < 4; ++ii) {
@@ -997,8 +1192,8 @@ do_kernel_square(struct driz_param_t* p,
     }
 
     /* Loop over output pixels which could be affected */
-    min_jj = MAX(fortran_round(min_doubles(yout, 4)), 0);
-    max_jj = MIN(fortran_round(max_doubles(yout, 4)), p->nsy - 1);
+    min_jj = MAX(fortran_round(min_doubles(yout, 4)), p->band_ymin);
+    max_jj = MIN(fortran_round(max_doubles(yout, 4)), p->band_ymax);
     min_ii = MAX(fortran_round(min_doubles(xout, 4)), 0);
     max_ii = MIN(fortran_round(max_doubles(xout, 4)), p->nsx - 1);
 
@@ -1028,7 +1223,7 @@ do_kernel_square(struct driz_param_t* p,
       }
     }
     /* Count cases where the pixel is off the output image */
-    if (nhit == 0) ++(*nmiss);
+    record_hits(p, i-1, j, nhit, nmiss);
   }
 
   return 0;
@@ -1045,6 +1240,504 @@ kernel_handler_map[] = {
   do_kernel_lanczos
 };
 
+/***************************************************************************
+ LINE PROCESSING
+*/
+
+/* Work buffers holding the coordinates of one input line */
+struct line_buffers_t {
+  double* xi;
+  double* yi;
+  double* xtmp;
+  double* ytmp;
+  double* xo;
+  double* yo;
+};
+
+static void
+line_buffers_init(struct line_buffers_t* b) {
+  b->xi = NULL;
+  b->yi = NULL;
+  b->xtmp = NULL;
+  b->ytmp = NULL;
+  b->xo = NULL;
+  b->yo = NULL;
+}
+
+static void
+line_buffers_free(struct line_buffers_t* b) {
+  free(b->xi);
+  free(b->yi);
+  free(b->xtmp);
+  free(b->ytmp);
+  free(b->xo);
+  free(b->yo);
+  line_buffers_init(b);
+}
+
+static int
+line_buffers_alloc(struct driz_param_t* p, struct line_buffers_t* b,
+                   struct driz_error_t* error) {
+  size_t new_buffer_size;
+  double dh;
+
+  /* Before we start we can fill the X arrays as they don't change
+     with Y */
+  new_buffer_size = (size_t)((p->kernel == kernel_square) ? p->dnx*4 : p->dnx);
+
+  b->xi = malloc(new_buffer_size * sizeof(double));
+  b->yi = malloc(new_buffer_size * sizeof(double));
+  b->xtmp = malloc(new_buffer_size * sizeof(double));
+  b->ytmp = malloc(new_buffer_size * sizeof(double));
+  b->xo = malloc((new_buffer_size + 1) * sizeof(double));
+  b->yo = malloc((new_buffer_size + 1) * sizeof(double));
+
+  if (b->xi == NULL || b->yi == NULL || b->xtmp == NULL ||
+      b->ytmp == NULL || b->xo == NULL || b->yo == NULL) {
+    line_buffers_free(b);
+    driz_error_set_message(error, "Out of memory");
+    return 1;
+  }
+
+  if (p->kernel == kernel_square) {
+    dh = 0.5 * p->pixel_fraction;
+    *mapping_4_ptr(p, b->xi, 1, 0) = 1.0 - dh;
+    *mapping_4_ptr(p, b->xi, 1, 1) = 1.0 + dh;
+    *mapping_4_ptr(p, b->xi, 1, 2) = 1.0 + dh;
+    *mapping_4_ptr(p, b->xi, 1, 3) = 1.0 - dh;
+  } else {
+    *mapping_ptr(p, b->xi, 0) = 1.0;
+  }
+
+  return 0;
+}
+
+/**
+Transform the input pixels x1..x2 of line y onto the output grid.
+The square kernel needs all four corners of each pixel, every other
+kernel just the pixel centre.
+*/
+static int
+map_line(struct driz_param_t* p, const double y,
+         const integer_t x1, const integer_t x2,
+         struct line_buffers_t* b, struct driz_error_t* error) {
+  if (p->kernel == kernel_square) {
+    return map_square_corners(p, y, x1, x2, b->xi, b->yi,
+                              b->xtmp, b->ytmp, b->xo, b->yo, error);
+  }
+
+  *mapping_ptr(p, b->xi, x1) = (double)x1;
+
+  *mapping_ptr(p, b->yi, x1) = y;
+  *mapping_ptr(p, b->yi, x1+1) = 0.0;
+
+  return map_value(p, TRUE, x2 - x1 + 1,
+                   mapping_ptr(p, b->xi, x1), mapping_ptr(p, b->yi, x1),
+                   b->xtmp, b->ytmp,
+                   mapping_ptr(p, b->xo, x1), mapping_ptr(p, b->yo, x1),
+                   error);
+}
+
+/**
+Map and drizzle the input pixels x1..x2 of line number j (counted from
+0), which sits at y in the input image.
+*/
+static int
+drizzle_line(struct driz_param_t* p, kernel_handler_t kernel_handler,
+             const integer_t j, const double y,
+             const integer_t x1, const integer_t x2,
+             struct line_buffers_t* b,
+             /* Input/output parameters */
+             integer_t* oldcon, integer_t* newcon, integer_t* nmiss,
+             struct driz_error_t* error) {
+  if (map_line(p, y, x1, x2, b, error)) {
+    return 1;
+  }
+
+  if (p->kernel == kernel_square) {
+    return do_kernel_square(p, j, x1, x2, b->xo, b->yo,
+                            oldcon, newcon, nmiss, error);
+  }
+
+  return kernel_handler(p, (integer_t)y, x1, x2, b->xo, b->yo,
+                        oldcon, newcon, nmiss, error);
+}
+
+/**
+Find the range of output rows a kernel handler will visit (before any
+clipping) for the input pixels x1..x2 of a line already transformed
+by map_line.  The bounds are computed exactly as the kernel handlers
+compute them, so that a line whose range misses an output band is
+guaranteed not to write anything into that band.
+*/
+static void
+line_output_range(struct driz_param_t* p,
+                  const integer_t x1, const integer_t x2, double* yo,
+                  /* Output parameters */
+                  integer_t* jlo, integer_t* jhi) {
+  integer_t i, k, lo, hi;
+  double dy, yy, yout[4];
+
+  *jlo = INT_MAX;
+  *jhi = INT_MIN;
+
+  for (i = x1; i <= x2; ++i) {
+    switch (p->kernel) {
+    case kernel_square:
+      dy = (double)(p->ymin) - 1;
+      for (k = 0; k < 4; ++k) {
+        yout[k] = *mapping_4_ptr(p, yo, i, k) - dy - 1;
+      }
+      lo = fortran_round(min_doubles(yout, 4));
+      hi = fortran_round(max_doubles(yout, 4));
+      break;
+    case kernel_point:
+      dy = (double)(p->ymin);
+      lo = hi = fortran_round(*mapping_ptr(p, yo, i) - dy);
+      break;
+    default:
+      dy = (double)(p->ymin);
+      yy = *mapping_ptr(p, yo, i) - dy;
+      lo = fortran_round(yy - p->pfo);
+      hi = fortran_round(yy + p->pfo);
+      break;
+    }
+
+    *jlo = MIN(*jlo, lo);
+    *jhi = MAX(*jhi, hi);
+  }
+}
+
+/***************************************************************************
+ MULTI-THREADED DRIZZLING
+
+ Threads must never update the same output pixel, and every output
+ pixel has to receive its contributions in exactly the same order as
+ in the serial code for the result to be bit-for-bit identical.  The
+ work is therefore done in two passes:
+
+ 1. The input lines are split between the threads, which find the
+    extent of every line on the output (the serial code's overlap
+    check plus the range of output rows the kernel will touch).
+
+ 2. The output rows are split into one band per thread, balanced on
+    the number of input pixels expected to land in each band.  Each
+    thread walks all of the input lines in order, skips those which
+    miss its band, and drizzles the rest, writing only to its band.
+*/
+
+struct line_info_t {
+  bool_t skip;
+  integer_t x1;
+  integer_t x2;
+  integer_t jlo;
+  integer_t jhi;
+};
+
+struct dobox_thread_t {
+  struct driz_param_t* p; /* private copy of the drizzle parameters */
+  kernel_handler_t kernel_handler;
+  integer_t ystart;
+  integer_t line_begin;
+  integer_t line_end;
+  struct line_info_t* lines; /* [ny], shared */
+  integer_t nmiss;
+  integer_t nskip;
+  struct driz_error_t error;
+};
+
+static void
+survey_lines(void* arg) {
+  struct dobox_thread_t* t = (struct dobox_thread_t*)arg;
+  struct driz_param_t* p = t->p;
+  struct line_info_t* l;
+  struct line_buffers_t b;
+  integer_t j, x1, x2;
+  double y, ofrac;
+
+  line_buffers_init(&b);
+  if (line_buffers_alloc(p, &b, &t->error)) {
+    return;
+  }
+
+  for (j = t->line_begin; j < t->line_end; ++j) {
+    y = (double)(t->ystart + j + 1);
+    l = &t->lines[j];
+
+    /* Check the overlap with the output */
+    if (check_over(p, (integer_t)y, 5, &ofrac, &x1, &x2, &t->error)) {
+      break;
+    }
+
+    if (ofrac == 0.0) {
+      /* If we are skipping a line, count it */
+      l->skip = TRUE;
+      ++(t->nskip);
+      t->nmiss += p->dnx;
+      continue;
+    }
+
+    /* We know there may be some misses */
+    t->nmiss += p->dnx - (x2 - x1 + 1);
+
+    if (map_line(p, y, x1, x2, &b, &t->error)) {
+      break;
+    }
+
+    l->skip = FALSE;
+    l->x1 = x1;
+    l->x2 = x2;
+    line_output_range(p, x1, x2, b.yo, &l->jlo, &l->jhi);
+  }
+
+  line_buffers_free(&b);
+}
+
+static void
+drizzle_band(void* arg) {
+  struct dobox_thread_t* t = (struct dobox_thread_t*)arg;
+  struct driz_param_t* p = t->p;
+  struct line_info_t* l;
+  struct line_buffers_t b;
+  integer_t j, oldcon, newcon;
+
+  oldcon = -1;
+  newcon = 0;
+
+  line_buffers_init(&b);
+  if (line_buffers_alloc(p, &b, &t->error)) {
+    return;
+  }
+
+  for (j = 0; j < p->ny; ++j) {
+    l = &t->lines[j];
+    if (l->skip || l->jhi < p->band_ymin || l->jlo > p->band_ymax) {
+      continue;
+    }
+
+    if (drizzle_line(p, t->kernel_handler, j, (double)(t->ystart + j + 1),
+                     l->x1, l->x2, &b, &oldcon, &newcon, &t->nmiss,
+                     &t->error)) {
+      break;
+    }
+  }
+
+  line_buffers_free(&b);
+}
+
+/**
+Run func on every thread description in parallel, using the calling
+thread for the first one.
+*/
+static void
+run_threads(driz_thread_func_t func, struct dobox_thread_t* threads,
+            const integer_t nthreads) {
+  driz_thread_t* handles;
+  bool_t* started;
+  integer_t i;
+
+  handles = calloc((size_t)nthreads, sizeof(driz_thread_t));
+  started = calloc((size_t)nthreads, sizeof(bool_t));
+
+  for (i = 1; i < nthreads; ++i) {
+    if (handles != NULL && started != NULL &&
+        driz_thread_create(&handles[i], func, &threads[i]) == 0) {
+      started[i] = TRUE;
+    }
+  }
+
+  /* Work that could not be handed to a thread is done right here */
+  func(&threads[0]);
+  for (i = 1; i < nthreads; ++i) {
+    if (started == NULL || !started[i]) {
+      func(&threads[i]);
+    }
+  }
+
+  for (i = 1; i < nthreads; ++i) {
+    if (started != NULL && started[i]) {
+      driz_thread_join(handles[i]);
+    }
+  }
+
+  free(handles);
+  free(started);
+}
+
+/**
+Split the output rows into nbands bands holding roughly the same
+number of input pixels.  Bands which end up with no work are empty
+(band_ymin > band_ymax).
+*/
+static int
+split_bands(struct driz_param_t* p, const struct line_info_t* lines,
+            const integer_t nbands,
+            /* Output parameters */
+            integer_t* band_ymin, integer_t* band_ymax,
+            struct driz_error_t* error) {
+  double* work;
+  double total, row, acc, w;
+  integer_t j, jj, lo, hi, b;
+
+  /* Difference array of the number of input pixels per output row */
+  work = calloc((size_t)p->nsy + 1, sizeof(double));
+  if (work == NULL) {
+    driz_error_set_message(error, "Out of memory");
+    return 1;
+  }
+
+  total = 0.0;
+  for (j = 0; j < p->ny; ++j) {
+    if (lines[j].skip) continue;
+    lo = MAX(lines[j].jlo, 0);
+    hi = MIN(lines[j].jhi, p->nsy - 1);
+    if (lo > hi) continue;
+    w = (double)(lines[j].x2 - lines[j].x1 + 1) / (double)(hi - lo + 1);
+    work[lo] += w;
+    work[hi + 1] -= w;
+    total += w * (double)(hi - lo + 1);
+  }
+
+  b = 0;
+  band_ymin[0] = 0;
+  row = 0.0;
+  acc = 0.0;
+  for (jj = 0; jj < p->nsy; ++jj) {
+    row += work[jj];
+    acc += row;
+    if (b < nbands - 1 && acc >= total * (double)(b + 1) / (double)nbands) {
+      band_ymax[b] = jj;
+      ++b;
+      band_ymin[b] = jj + 1;
+    }
+  }
+  band_ymax[b] = p->nsy - 1;
+
+  for (++b; b < nbands; ++b) {
+    band_ymin[b] = p->nsy;
+    band_ymax[b] = p->nsy - 1;
+  }
+
+  free(work);
+  return 0;
+}
+
+static int
+dobox_threaded(struct driz_param_t* p, const integer_t ystart,
+               kernel_handler_t kernel_handler,
+               /* Output parameters */
+               integer_t* nmiss, integer_t* nskip,
+               struct driz_error_t* error) {
+  struct dobox_thread_t* threads = NULL;
+  struct line_info_t* lines = NULL;
+  integer_t* band_ymin = NULL;
+  integer_t* band_ymax = NULL;
+  unsigned char* hit_mask = NULL;
+  integer_t nthreads, i, j, t, row;
+  size_t k, mask_size;
+
+  nthreads = MIN(p->nthreads, p->ny);
+  mask_size = ((size_t)MAX(p->dny, ystart + p->ny) * (size_t)p->dnx + 7) / 8;
+
+  threads = calloc((size_t)nthreads, sizeof(struct dobox_thread_t));
+  lines = calloc((size_t)p->ny, sizeof(struct line_info_t));
+  band_ymin = calloc((size_t)nthreads, sizeof(integer_t));
+  band_ymax = calloc((size_t)nthreads, sizeof(integer_t));
+  if (threads == NULL || lines == NULL ||
+      band_ymin == NULL || band_ymax == NULL) {
+    driz_error_set_message(error, "Out of memory");
+    goto dobox_threaded_exit_;
+  }
+
+  for (t = 0; t < nthreads; ++t) {
+    threads[t].p = malloc(sizeof(struct driz_param_t));
+    if (threads[t].p == NULL) {
+      driz_error_set_message(error, "Out of memory");
+      goto dobox_threaded_exit_;
+    }
+    memcpy(threads[t].p, p, sizeof(struct driz_param_t));
+    threads[t].kernel_handler = kernel_handler;
+    threads[t].ystart = ystart;
+    threads[t].line_begin = (integer_t)(((size_t)p->ny * t) / nthreads);
+    threads[t].line_end = (integer_t)(((size_t)p->ny * (t + 1)) / nthreads);
+    threads[t].lines = lines;
+    driz_error_init(&threads[t].error);
+  }
+
+  /* Pass 1: where does each input line land on the output? */
+  run_threads(survey_lines, threads, nthreads);
+
+  for (t = 0; t < nthreads; ++t) {
+    if (driz_error_is_set(&threads[t].error)) {
+      driz_error_set_message(error, driz_error_get_message(&threads[t].error));
+      goto dobox_threaded_exit_;
+    }
+    *nmiss += threads[t].nmiss;
+    *nskip += threads[t].nskip;
+    threads[t].nmiss = 0;
+  }
+
+  /* Pass 2: drizzle each band of output rows in its own thread */
+  if (split_bands(p, lines, nthreads, band_ymin, band_ymax, error)) {
+    goto dobox_threaded_exit_;
+  }
+
+  for (t = 0; t < nthreads; ++t) {
+    threads[t].p->band_ymin = band_ymin[t];
+    threads[t].p->band_ymax = band_ymax[t];
+    threads[t].p->hit_mask = calloc(mask_size, 1);
+    if (threads[t].p->hit_mask == NULL) {
+      driz_error_set_message(error, "Out of memory");
+      goto dobox_threaded_exit_;
+    }
+  }
+
+  run_threads(drizzle_band, threads, nthreads);
+
+  for (t = 0; t < nthreads; ++t) {
+    if (driz_error_is_set(&threads[t].error)) {
+      driz_error_set_message(error, driz_error_get_message(&threads[t].error));
+      goto dobox_threaded_exit_;
+    }
+  }
+
+  /* A pixel is missed when no thread at all managed to place it */
+  hit_mask = threads[0].p->hit_mask;
+  for (t = 1; t < nthreads; ++t) {
+    for (k = 0; k < mask_size; ++k) {
+      hit_mask[k] |= threads[t].p->hit_mask[k];
+    }
+  }
+
+  for (j = 0; j < p->ny; ++j) {
+    if (lines[j].skip) continue;
+    /* Same row numbering as used by the kernel handlers */
+    row = (p->kernel == kernel_square) ? j : ystart + j;
+    for (i = lines[j].x1; i <= lines[j].x2; ++i) {
+      k = (size_t)row * (size_t)p->dnx + (size_t)(i - 1);
+      if ((hit_mask[k >> 3] & (1 << (k & 7))) == 0) {
+        ++(*nmiss);
+      }
+    }
+  }
+
+ dobox_threaded_exit_:
+  if (threads != NULL) {
+    for (t = 0; t < nthreads; ++t) {
+      if (threads[t].p != NULL) {
+        free(threads[t].p->hit_mask);
+        free(threads[t].p);
+      }
+    }
+  }
+  free(threads);
+  free(lines);
+  free(band_ymin);
+  free(band_ymax);
+
+  return driz_error_is_set(error);
+}
+
 /**
 This module does the actual mapping of input flux to output images
 using "boxer", a code written by Bill Sparks for FOC geometric
@@ -1063,23 +1756,14 @@ dobox(struct driz_param_t* p, const integer_t ystart,
       /* Output parameters */
       integer_t* nmiss, integer_t* nskip, struct driz_error_t* error) {
   const double nsig = 2.5;
-  const size_t nlut = 512;
-  const float del = 0.01;
-  integer_t j, x1, x2, last_x1, last_x2;
-  double y, dh, ofrac;
+  integer_t j, x1, x2;
+  double y, ofrac;
   kernel_handler_t kernel_handler = NULL;
   integer_t oldcon, newcon;
   integer_t np;
-  double* xi = NULL;
-  double* yi = NULL;
-  double* xtmp = NULL;
-  double* ytmp = NULL;
-  double* xo = NULL;
-  double* yo = NULL;
+  struct line_buffers_t b;
   float inv_exposure_time;
   float* data_begin, *data_end;
-  int kernel_order;
-  size_t new_buffer_size;
   size_t bit_no;
 
   assert(p);
@@ -1087,6 +1771,8 @@ dobox(struct driz_param_t* p, const integer_t ystart,
   assert(nskip);
   assert(error);
 
+  line_buffers_init(&b);
+
   /* We skip all this if there is no overlap */
   if (p->no_over) {
     /* If there is no overlap at all, set appropriate values */
@@ -1105,16 +1791,17 @@ dobox(struct driz_param_t* p, const integer_t ystart,
   assert(bit_no < 32);
   p->bv = (integer_t)(1 << bit_no);
 
-  /* Before we start we can fill the X arrays as they don't change
-     with Y */
-  new_buffer_size = (size_t)((p->kernel == kernel_square) ? p->dnx*4 : p->dnx);
-
   /* Image subset size */
   p->nsx = p->xmax - p->xmin + 1;
   p->nsy = p->ymax - p->ymin + 1;
   assert(p->pixel_fraction != 0.0);
   p->ac = 1.0 / (p->pixel_fraction * p->pixel_fraction);
 
+  /* Every output row is fair game unless drizzling in threads */
+  p->band_ymin = 0;
+  p->band_ymax = p->nsy - 1;
+  p->hit_mask = NULL;
+
   /* Recalculate the area scaling factor */
   p->scale2 = p->scale * p->scale;
 
@@ -1132,21 +1819,21 @@ dobox(struct driz_param_t* p, const integer_t ystart,
        divided by the scale so that there are never holes in the
        output */
     p->pfo = CLAMP_ABOVE(p->pfo, 1.2 / p->scale);
+    if (create_kernel_lut(p, error)) {
+      goto dobox_exit_;
+    }
     break;
   case kernel_lanczos2:
   case kernel_lanczos3:
-    kernel_order = (p->kernel == kernel_lanczos2) ? 2 : 3;
-    p->lanczos.nlut = nlut;
-    assert(p->lanczos.lut == NULL);
-    if ((p->lanczos.lut = malloc(nlut * sizeof(float))) == NULL) {
-      driz_error_set_message(error, "Out of memory");
-      goto dobox_exit_;
-    }
+    p->pfo = (p->kernel == kernel_lanczos2 ? 2.0 : 3.0) *
+      p->pixel_fraction / p->scale;
+    /* Scaled distance per output pixel */
+    p->lanczos.sdp = p->scale / p->pixel_fraction;
     /* Set up a look-up-table for Lanczos-style interpolation
        kernels */
-    create_lanczos_lut(kernel_order, nlut, del, p->lanczos.lut);
-    p->pfo = (double)kernel_order * p->pixel_fraction / p->scale;
-    p->lanczos.sdp = p->scale / del / p->pixel_fraction;
+    if (create_kernel_lut(p, error)) {
+      goto dobox_exit_;
+    }
     break;
 
   default:
@@ -1165,51 +1852,7 @@ dobox(struct driz_param_t* p, const integer_t ystart,
   /*   p->output_done[i] = 0; */
   /* } */
 
-  xi = malloc(new_buffer_size * sizeof(double));
-  if (xi == NULL) {
-    driz_error_set_message(error, "Out of memory");
-    goto dobox_exit_;
-  }
-
-  yi = malloc(new_buffer_size * sizeof(double));
-  if (yi == NULL) {
-    driz_error_set_message(error, "Out of memory");
-    goto dobox_exit_;
-  }
-
-  xtmp = malloc(new_buffer_size * sizeof(double));
-  if (xtmp == NULL) {
-    driz_error_set_message(error, "Out of memory");
-    goto dobox_exit_;
-  }
-
-  ytmp = malloc(new_buffer_size * sizeof(double));
-  if (ytmp == NULL) {
-    driz_error_set_message(error, "Out of memory");
-    goto dobox_exit_;
-  }
-
-  xo = malloc((new_buffer_size + 1) * sizeof(double));
-  if (xo == NULL) {
-    driz_error_set_message(error, "Out of memory");
-    goto dobox_exit_;
-  }
-
-  yo = malloc((new_buffer_size + 1) * sizeof(double));
-  if (yo == NULL) {
-    driz_error_set_message(error, "Out of memory");
-    goto dobox_exit_;
-  }
-
-  if (p->kernel == kernel_square) {
-    dh = 0.5 * p->pixel_fraction;
-    *mapping_4_ptr(p, xi, 1, 0) = 1.0 - dh;
-    *mapping_4_ptr(p, xi, 1, 1) = 1.0 + dh;
-    *mapping_4_ptr(p, xi, 1, 2) = 1.0 + dh;
-    *mapping_4_ptr(p, xi, 1, 3) = 1.0 - dh;
-  } else {
-    *mapping_ptr(p, xi, 0) = 1.0;
-
+  if (p->kernel != kernel_square) {
     /* Set up a function pointer to handle the appropriate kernel */
     if (p->kernel >= kernel_LAST) {
       driz_error_set_message(error, "Invalid kernel type");
@@ -1243,9 +1886,18 @@ dobox(struct driz_param_t* p, const integer_t ystart,
 
   DRIZLOG("-Drizzling using kernel = %s\n",kernel_enum2str(p->kernel));
 
+  /* The context table used with output_done is shared by all of the
+     output pixels, so it rules out threads */
+  if (p->nthreads > 1 && p->ny > 1 && p->output_done == NULL) {
+    dobox_threaded(p, ystart, kernel_handler, nmiss, nskip, error);
+    goto dobox_exit_;
+  }
+
+  if (line_buffers_alloc(p, &b, error)) {
+    goto dobox_exit_;
+  }
+
   /* This is the outer loop over all the lines in the input image */
-  last_x1 = p->dnx;
-  last_x2 = 0;
   y = (double)ystart;
   for (j = 0; j < p->ny; ++j) {
     y += 1.0;
@@ -1271,51 +1923,21 @@ dobox(struct driz_param_t* p, const integer_t ystart,
          First the cases where we just transform a single point rather
          than four - every case except the "classic" square-pixel
          kernel */
-      if (p->kernel != kernel_square) {
-        *mapping_ptr(p, xi, x1) = (double)x1;
-
-        *mapping_ptr(p, yi, x1) = y;
-        *mapping_ptr(p, yi, x1+1) = 0.0;
-
-
-        if (map_value(p, TRUE, x2 - x1 + 1,
-                      mapping_ptr(p, xi, x1), mapping_ptr(p, yi, x1),
-                      xtmp, ytmp,
-                      mapping_ptr(p, xo, x1), mapping_ptr(p, yo, x1), error)) {
-          goto dobox_exit_;
-        }
-
-        if (kernel_handler(p, y, x1, x2, xo, yo,
-                           &oldcon, &newcon, nmiss, error)) {
-          goto dobox_exit_;
-        }
-      } else {
-        if (do_kernel_square(p, j, y, x1, x2, last_x1, last_x2,
-                             xi, yi, xtmp, ytmp, xo, yo,
-                             &oldcon, &newcon, nmiss, error)) {
-          goto dobox_exit_;
-        }
+      if (drizzle_line(p, kernel_handler, j, y, x1, x2, &b,
+                       &oldcon, &newcon, nmiss, error)) {
+        goto dobox_exit_;
       }
-      last_x1 = x1;
-      last_x2 = x2;
     } else {
       /* If we are skipping a line, count it */
       ++(*nskip);
       *nmiss += p->dnx;
-      last_x1 = p->dnx;
-      last_x2 = 0;
     }
   }
 
  dobox_exit_:
-  free(p->lanczos.lut); p->lanczos.lut = NULL;
+  free(p->kernel_lut.lut); p->kernel_lut.lut = NULL;
   free(p->output_done); p->output_done = NULL;
-  free(xi); xi = NULL;
-  free(yi); yi = NULL;
-  free(xo); xo = NULL;
-  free(yo); yo = NULL;
-  free(xtmp); xtmp = NULL;
-  free(ytmp); ytmp = NULL;
+  line_buffers_free(&b);
 
   return driz_error_is_set(error);
 }
@@ -0,0 +1,259 @@
+#define NO_IMPORT_ARRAY
+#define NO_IMPORT_ASTROPY_WCS_API
+
+#include "driz_portability.h"
+#include "cdrizzlecombine.h"
+
+#include <assert.h>
+#include <math.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* Number of pixels gathered from all of the images at once */
+#define COMBINE_BLOCK 256
+/* Largest number of values to sort rather than partially order */
+#define COMBINE_SORT_MAX 16
+
+/**
+Partially order the \a n values so that \a v[k] holds the value that would
+be there once sorted, with no larger value before it and no smaller value
+after it.
+*/
+static double
+select_kth(double* v, const integer_t n, const integer_t k) {
+  integer_t left = 0, right = n - 1, i, j;
+  double pivot, tmp;
+
+  assert(k >= 0 && k < n);
+
+  while (left < right) {
+    pivot = v[(left + right) / 2];
+    i = left;
+    j = right;
+    while (i <= j) {
+      while (v[i] < pivot) ++i;
+      while (pivot < v[j]) --j;
+      if (i <= j) {
+        tmp = v[i]; v[i] = v[j]; v[j] = tmp;
+        ++i;
+        --j;
+      }
+    }
+    if (k <= j) {
+      right = j;
+    } else if (k >= i) {
+      left = i;
+    } else {
+      break;
+    }
+  }
+
+  return v[k];
+}
+
+static void
+sort_values(double* v, const integer_t n) {
+  integer_t i, j;
+  double tmp;
+
+  for (i = 1; i < n; ++i) {
+    tmp = v[i];
+    for (j = i; j > 0 && v[j-1] > tmp; --j) {
+      v[j] = v[j-1];
+    }
+    v[j] = tmp;
+  }
+}
+
+/**
+Median of the \a goodpix values left after rejecting the \a nlow lowest
+and \a nhigh highest of them.  When that would leave no value, the
+rejection gets reduced as numcombine does.
+*/
+static double
+stack_median(double* v, const integer_t goodpix, integer_t nlow,
+             integer_t nhigh) {
+  integer_t medianpix, k;
+  double hi, lo;
+
+  medianpix = goodpix - nhigh - nlow;
+  if (medianpix <= 0 && goodpix > 0) {
+    while (nhigh + nlow >= goodpix) {
+      if (nhigh > 0) nhigh = nhigh - 1;
+      if (nlow > 0) nlow = nlow - 1;
+    }
+    medianpix = goodpix - nhigh - nlow;
+  }
+  if (medianpix <= 0) {
+    return 0.0;
+  }
+
+  k = medianpix / 2 + nlow;
+
+  /* Sorting is faster than selecting for the usual small stacks */
+  if (goodpix <= COMBINE_SORT_MAX) {
+    sort_values(v, goodpix);
+    return (medianpix % 2) ? v[k] : (v[k] + v[k-1]) / 2.0;
+  }
+
+  hi = select_kth(v, goodpix, k);
+  if (medianpix % 2) {
+    return hi;
+  }
+
+  /* The next lower value is the largest of those now before it */
+  lo = v[0];
+  for (k = k - 1; k > 0; --k) {
+    if (v[k] > lo) lo = v[k];
+  }
+  return (hi + lo) / 2.0;
+}
+
+static double
+stack_average(double* v, const integer_t goodpix, const integer_t nlow,
+              const integer_t nhigh) {
+  integer_t i, averagepix = goodpix - nhigh - nlow;
+  double average = 0.0;
+
+  if (averagepix <= 0) {
+    return 0.0;
+  }
+
+  sort_values(v, goodpix);
+  for (i = nlow; i < averagepix + nlow; ++i) {
+    average += v[i];
+  }
+  return average / averagepix;
+}
+
+int
+docombine(struct combine_param_t* p, struct driz_error_t* error) {
+  const integer_t n = p->nimages;
+  const bool_t masked = (p->masks != NULL || p->thresholds != NULL);
+  double* vals = NULL;
+  integer_t* cnt = NULL;
+  const float* d;
+  const float* w = NULL;
+  const unsigned char* m = NULL;
+  size_t start, nb, j;
+  integer_t i, k, goodpix, nvalid;
+  bool_t bad, has_nan;
+  float minv, v;
+
+  assert(p);
+  assert(p->data);
+  assert(error);
+
+  if (p->thresholds != NULL && p->weights == NULL) {
+    driz_error_set_message(error, "Weight thresholds need the weights");
+    return 1;
+  }
+  if ((p->weight_sum != NULL || p->bkgd != NULL) && p->weights == NULL) {
+    driz_error_set_message(error, "Weight sums need the weights");
+    return 1;
+  }
+
+  vals = malloc((size_t)MAX(n, 1) * COMBINE_BLOCK * sizeof(double));
+  cnt = malloc(COMBINE_BLOCK * sizeof(integer_t));
+  if (vals == NULL || cnt == NULL) {
+    driz_error_set_message(error, "Out of memory");
+    free(vals);
+    free(cnt);
+    return 1;
+  }
+
+  for (start = 0; start < p->npix; start += COMBINE_BLOCK) {
+    nb = MIN((size_t)COMBINE_BLOCK, p->npix - start);
+
+    for (j = 0; j < nb; ++j) {
+      cnt[j] = 0;
+    }
+    if (p->weight_sum) {
+      memset(p->weight_sum + start, 0, nb * sizeof(float));
+    }
+    if (p->bkgd) {
+      memset(p->bkgd + start, 0, nb * sizeof(double));
+    }
+    if (p->readnoise) {
+      memset(p->readnoise + start, 0, nb * sizeof(double));
+    }
+
+    /* Gather the good values of each pixel and accumulate the sums, one
+       image after the other, in the order of the stack */
+    for (i = 0; i < n; ++i) {
+      d = p->data + (size_t)i * p->npix + start;
+      if (p->weights) {
+        w = p->weights + (size_t)i * p->npix + start;
+      }
+      if (p->masks) {
+        m = p->masks + (size_t)i * p->npix + start;
+      }
+
+      for (j = 0; j < nb; ++j) {
+        if (m) {
+          bad = (m[j] != 0);
+        } else if (p->thresholds) {
+          bad = ((double)w[j] < p->thresholds[i]);
+        } else {
+          bad = FALSE;
+        }
+
+        if (p->weight_sum) {
+          p->weight_sum[start + j] += w[j];
+        }
+        if (p->bkgd) {
+          p->bkgd[start + j] += (double)w[j] * p->bkgd_scale[i];
+        }
+        if (bad) {
+          continue;
+        }
+        if (p->readnoise) {
+          p->readnoise[start + j] += p->rdnoise2[i];
+        }
+        vals[j * n + cnt[j]++] = (double)d[j];
+      }
+    }
+
+    for (j = 0; j < nb; ++j) {
+      goodpix = cnt[j];
+
+      if (p->ngood) {
+        p->ngood[start + j] = goodpix;
+      }
+
+      if (p->minimum) {
+        /* Masked stacks ignore NaN values, others propagate them */
+        minv = 0.0f;
+        nvalid = 0;
+        has_nan = FALSE;
+        for (k = 0; k < goodpix; ++k) {
+          v = (float)vals[j * n + k];
+          if (isnan(v)) {
+            has_nan = TRUE;
+          } else if (nvalid++ == 0 || v < minv) {
+            minv = v;
+          }
+        }
+        if (goodpix > 0 && (nvalid == 0 || (has_nan && !masked))) {
+          minv = NAN;
+        }
+        p->minimum[start + j] = minv;
+      }
+
+      if (p->median) {
+        if (p->average) {
+          p->median[start + j] = (float)stack_average(
+              vals + j * n, goodpix, p->nlow, p->nhigh);
+        } else {
+          p->median[start + j] = (float)stack_median(
+              vals + j * n, goodpix, p->nlow, p->nhigh);
+        }
+      }
+    }
+  }
+
+  free(vals);
+  free(cnt);
+
+  return 0;
+}
@@ -0,0 +1,59 @@
+#ifndef CDRIZZLECOMBINE_H
+#define CDRIZZLECOMBINE_H
+
+#include "cdrizzleutil.h"
+
+/**
+Parameters of the combination of a stack of images, pixel by pixel, as
+done by the median step.  All images have \a npix pixels and are stored
+one after the other.
+*/
+struct combine_param_t {
+  integer_t nimages;
+  size_t npix;
+
+  /* Input stack */
+  const float* data; /* [nimages][npix] */
+  const float* weights; /* [nimages][npix] or NULL */
+  const unsigned char* masks; /* [nimages][npix] or NULL, non-zero is bad */
+  /* Pixels with a weight below the threshold of their image are bad,
+     when no masks are given */
+  const double* thresholds; /* [nimages] or NULL */
+
+  /* Number of low and high pixels to reject */
+  integer_t nlow;
+  integer_t nhigh;
+  /* Average the remaining pixels instead of taking their median */
+  bool_t average;
+
+  /* Background per unit weight and readnoise squared of each image */
+  const double* bkgd_scale; /* [nimages] or NULL */
+  const double* rdnoise2; /* [nimages] or NULL */
+
+  /* Output images, any of which may be NULL */
+  float* median; /* [npix] */
+  float* minimum; /* [npix] */
+  integer_t* ngood; /* [npix] */
+  float* weight_sum; /* [npix] */
+  double* bkgd; /* [npix] */
+  double* readnoise; /* [npix] */
+};
+
+/**
+Combine a stack of images in a single pass over the data.
+
+For each pixel, this computes the median (or average) of the good pixels
+after rejecting the \a nlow lowest and \a nhigh highest ones, following the
+rules of the stsci.image numcombine median and average.  It also computes
+the minimum of the good pixels, their number, the sum of the weights, the
+sum of the weights scaled by \a bkgd_scale and the sum of \a rdnoise2 over
+the good pixels, which is what the minmed algorithm needs out of the
+stack.  Pixels without any good value get a median, average and minimum
+of zero.
+
+@return Non-zero if an error occurred.
+*/
+int
+docombine(struct combine_param_t* p, struct driz_error_t* error);
+
+#endif /* CDRIZZLECOMBINE_H */
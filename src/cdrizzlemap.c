@@ -369,6 +369,56 @@ default_wcsmap_direct(struct wcsmap_param_t* m,
   return 0;
 }
 
+/**
+Bilinear interpolation of the output position from a table of nodes
+with the given number of nodes per row, within the cell starting at node
+(xi, yi) and at fractional offsets (xf, yf) within that cell.
+*/
+static inline_macro void
+interpolate_nodes(const double* table, const int stride,
+                  const int xi, const int yi,
+                  const double xf, const double yf,
+                  /* Output parameters */
+                  double* xout, double* yout) {
+  double  ixf, iyf;
+  double  tabx00, tabx01, tabx10, tabx11;
+
+  ixf = 1.0 - xf;
+  iyf = 1.0 - yf;
+
+#define TABLE_X(x, y) (table[((y)*stride + (x))*2])
+#define TABLE_Y(x, y) (table[((y)*stride + (x))*2 + 1])
+
+  tabx00 = TABLE_X(xi, yi);
+  tabx10 = TABLE_X(xi+1, yi);
+  tabx01 = TABLE_X(xi, yi+1);
+  tabx11 = TABLE_X(xi+1, yi+1);
+
+  /* Account for interpolating across 360-0 boundary */
+  if ((tabx00 - tabx10) > 359) {
+    tabx00 -= 360.0;
+    tabx01 -= 360.0;
+  } else if ((tabx00 - tabx10) < -359) {
+    tabx10 -= 360.0;
+    tabx11 -= 360.0;
+  }
+
+  *xout =
+    tabx00 * ixf * iyf +
+    tabx10 * xf * iyf +
+    tabx01 * ixf * yf +
+    tabx11 * xf * yf;
+
+  *yout =
+    TABLE_Y(xi, yi)     * ixf * iyf +
+    TABLE_Y(xi+1, yi)   * xf * iyf +
+    TABLE_Y(xi, yi+1)   * ixf * yf +
+    TABLE_Y(xi+1, yi+1) * xf * yf;
+
+#undef TABLE_X
+#undef TABLE_Y
+}
+
 static int
 default_wcsmap_interpolate(struct wcsmap_param_t* m,
                            const double xd, const double yd,
@@ -383,62 +433,47 @@ default_wcsmap_interpolate(struct wcsmap_param_t* m,
   double *yiptr;
   double *xoptr;
   double *yoptr;
-  double *table;
   double  x, y;
   int     xi, yi;
-  double  xf, yf, ixf, iyf;
-  double  tabx00, tabx01, tabx10, tabx11;
+  double  xf, yf;
+  int     level, nsub, ui, vi;
+  size_t  cell;
 
   /* do the bilinear interpolation */
   xiptr = xin;
   yiptr = yin;
   xoptr = xout;
   yoptr = yout;
-  table = m->table;
-
-#define TABLE_X(x, y) (table[((y)*m->snx + (x))*2])
-#define TABLE_Y(x, y) (table[((y)*m->snx + (x))*2 + 1])
 
-  for (i = 0; i < n; ++i) {
+  for (i = 0; i < n; ++i, ++xoptr, ++yoptr) {
     x = *xiptr++ / m->factor;
     y = *yiptr++ / m->factor;
     xi = (int)floor(x);
     yi = (int)floor(y);
     xf = x - (double)xi;
     yf = y - (double)yi;
-    ixf = 1.0 - xf;
-    iyf = 1.0 - yf;
-
-    tabx00 = TABLE_X(xi, yi);
-    tabx10 = TABLE_X(xi+1, yi);
-    tabx01 = TABLE_X(xi, yi+1);
-    tabx11 = TABLE_X(xi+1, yi+1);
-
-    /* Account for interpolating across 360-0 boundary */
-    if ((tabx00 - tabx10) > 359) {
-      tabx00 -= 360.0;
-      tabx01 -= 360.0;
-    } else if ((tabx00 - tabx10) < -359) {
-      tabx10 -= 360.0;
-      tabx11 -= 360.0;
+
+    /* Use the finer table of refined cells */
+    if (m->cell_level != NULL &&
+        xi >= 0 && xi < m->snx - 1 && yi >= 0 && yi < m->sny - 1) {
+      cell = (size_t)yi * (size_t)(m->snx - 1) + (size_t)xi;
+      level = m->cell_level[cell];
+      if (level > 0) {
+        nsub = 1 << level;
+        x = xf * (double)nsub;
+        y = yf * (double)nsub;
+        ui = MIN((int)x, nsub - 1);
+        vi = MIN((int)y, nsub - 1);
+        interpolate_nodes(m->subtable + m->cell_offset[cell], nsub + 1,
+                          ui, vi, x - (double)ui, y - (double)vi,
+                          xoptr, yoptr);
+        continue;
+      }
     }
 
-    *xoptr++ =
-      tabx00 * ixf * iyf +
-      tabx10 * xf * iyf +
-      tabx01 * ixf * yf +
-      tabx11 * xf * yf;
-
-    *yoptr++ =
-      TABLE_Y(xi, yi)     * ixf * iyf +
-      TABLE_Y(xi+1, yi)   * xf * iyf +
-      TABLE_Y(xi, yi+1)   * ixf * yf +
-      TABLE_Y(xi+1, yi+1) * xf * yf;
+    interpolate_nodes(m->table, m->snx, xi, yi, xf, yf, xoptr, yoptr);
   }
 
-#undef TABLE_X
-#undef TABLE_Y
-
   return 0;
 }
 
@@ -597,6 +632,259 @@ default_wcsmap_init(struct wcsmap_param_t* m,
   return 0;
 }
 
+/* Finest level of refinement (so that sub-cells get down to about one
+   input pixel for step sizes up to 64), and the largest number of
+   positions evaluated at once while refining */
+#define MAX_REFINE_LEVEL 6
+#define MAX_REFINE_EVALS (1 << 20)
+
+/* Keep the table of nodes of a refined cell, growing the table of all
+   refined cells (of the given capacity) as needed */
+static int
+store_refined_cell(struct wcsmap_param_t* m, const size_t cell,
+                   const int level, const double* nodes,
+                   /* Input/output parameters */
+                   size_t* capacity,
+                   struct driz_error_t* error) {
+  const size_t nvals = (size_t)((1 << level) + 1) * ((1 << level) + 1) * 2;
+  size_t new_capacity;
+  double* new_subtable;
+
+  if (level == 0) {
+    return 0;
+  }
+
+  if (m->subtable_size + nvals > *capacity) {
+    new_capacity = MAX(2 * (*capacity), m->subtable_size + nvals);
+    new_subtable = realloc(m->subtable, new_capacity * sizeof(double));
+    if (new_subtable == NULL) {
+      driz_error_set_message(error, "Out of memory");
+      return 1;
+    }
+    m->subtable = new_subtable;
+    *capacity = new_capacity;
+  }
+  memcpy(m->subtable + m->subtable_size, nodes, nvals * sizeof(double));
+  m->cell_level[cell] = (unsigned char)level;
+  m->cell_offset[cell] = m->subtable_size;
+  m->subtable_size += nvals;
+  ++(m->nrefined);
+
+  return 0;
+}
+
+int
+default_wcsmap_refine(struct wcsmap_param_t* m, double max_error,
+                      struct driz_error_t* error) {
+  const int ncx = m->snx - 1;
+  const int ncy = m->sny - 1;
+  const size_t ncells = (size_t)ncx * (size_t)ncy;
+  size_t  max_nodes, chunk, c0, c, k, nact, nkeep, nodes, n, node_size;
+  size_t  capacity = 0;
+  size_t* cells = NULL;
+  double* cur   = NULL;
+  double* next  = NULL;
+  double* xin   = NULL;
+  double* yin   = NULL;
+  double* xout  = NULL;
+  double* yout  = NULL;
+  double* ptr;
+  double  err, d, px, py, u, v;
+  int     maxlevel, level, nsub, nsub2, a, b, ui, vi, ci, cj;
+  int     status = 1;
+
+  assert(m);
+  assert(m->table);
+  assert(m->cell_level == NULL);
+
+  /* Refine down to sub-cells of about one input pixel */
+  maxlevel = 0;
+  while (maxlevel < MAX_REFINE_LEVEL &&
+         m->factor / (double)(2 << maxlevel) >= 1.0) {
+    ++maxlevel;
+  }
+
+  /* Cells get refined in chunks small enough for evaluating all the
+     nodes of their finest level at once */
+  max_nodes = (size_t)((2 << maxlevel) + 1) * (size_t)((2 << maxlevel) + 1);
+  chunk = MAX(MAX_REFINE_EVALS / max_nodes, 1);
+
+  m->max_error = max_error;
+  m->achieved_error = 0.0;
+  m->nevals = 0;
+  m->nrefined = 0;
+
+  m->cell_level = calloc(ncells, sizeof(unsigned char));
+  m->cell_offset = calloc(ncells, sizeof(size_t));
+  cells = malloc(chunk * sizeof(size_t));
+  cur = malloc(chunk * max_nodes * 2 * sizeof(double));
+  next = malloc(chunk * max_nodes * 2 * sizeof(double));
+  xin = malloc(chunk * max_nodes * sizeof(double));
+  yin = malloc(chunk * max_nodes * sizeof(double));
+  xout = malloc(chunk * max_nodes * sizeof(double));
+  yout = malloc(chunk * max_nodes * sizeof(double));
+  if (m->cell_level == NULL || m->cell_offset == NULL || cells == NULL ||
+      cur == NULL || next == NULL || xin == NULL || yin == NULL ||
+      xout == NULL || yout == NULL) {
+    driz_error_set_message(error, "Out of memory");
+    goto exit;
+  }
+
+  for (c0 = 0; c0 < ncells; c0 += chunk) {
+    /* Start from the nodes of the coarse table at the corners of each
+       cell of this chunk */
+    nact = MIN(chunk, ncells - c0);
+    for (k = 0; k < nact; ++k) {
+      cells[k] = c0 + k;
+      ci = (int)(cells[k] % (size_t)ncx);
+      cj = (int)(cells[k] / (size_t)ncx);
+      ptr = cur + k * 8;
+      for (b = 0; b < 2; ++b) {
+        for (a = 0; a < 2; ++a) {
+          *ptr++ = m->table[((cj + b) * m->snx + ci + a) * 2];
+          *ptr++ = m->table[((cj + b) * m->snx + ci + a) * 2 + 1];
+        }
+      }
+    }
+
+    for (level = 0; nact > 0; ++level) {
+      /* Evaluate the WCSs on the nodes of the next level, which also
+         sample the middle of the edges and of the sub-cells of this
+         level, where the interpolation errors are the largest */
+      nsub = 1 << level;
+      nsub2 = nsub << 1;
+      nodes = (size_t)(nsub2 + 1) * (size_t)(nsub2 + 1);
+      node_size = (size_t)(nsub + 1) * (size_t)(nsub + 1) * 2;
+      n = 0;
+      for (k = 0; k < nact; ++k) {
+        ci = (int)(cells[k] % (size_t)ncx);
+        cj = (int)(cells[k] / (size_t)ncx);
+        for (b = 0; b <= nsub2; ++b) {
+          for (a = 0; a <= nsub2; ++a) {
+            xin[n] = ((double)ci + (double)a / (double)nsub2) * m->factor;
+            yin[n] = ((double)cj + (double)b / (double)nsub2) * m->factor;
+            ++n;
+          }
+        }
+      }
+      if (default_wcsmap_direct(m, 0.0, 0.0, (integer_t)n, xin, yin,
+                                xout, yout, error)) {
+        driz_error_set_message(error,
+                               "Could not evaluate the WCSs to refine the mapping table");
+        goto exit;
+      }
+      m->nevals += (long)n;
+
+      nkeep = 0;
+      for (k = 0; k < nact; ++k) {
+        /* Largest error of the interpolation at this level */
+        err = 0.0;
+        for (b = 0; b <= nsub2; ++b) {
+          v = 0.5 * (double)b;
+          vi = MIN((int)v, nsub - 1);
+          for (a = 0; a <= nsub2; ++a) {
+            u = 0.5 * (double)a;
+            ui = MIN((int)u, nsub - 1);
+            interpolate_nodes(cur + k * node_size, nsub + 1, ui, vi,
+                              u - (double)ui, v - (double)vi, &px, &py);
+            c = k * nodes + (size_t)b * (size_t)(nsub2 + 1) + (size_t)a;
+            d = sqrt((px - xout[c]) * (px - xout[c]) +
+                     (py - yout[c]) * (py - yout[c]));
+            if (!(d <= err)) {
+              err = d;
+            }
+          }
+        }
+
+        if (err <= max_error || level >= maxlevel) {
+          /* Good enough, or as fine as it gets */
+          if (store_refined_cell(m, cells[k], level, cur + k * node_size,
+                                 &capacity, error)) {
+            goto exit;
+          }
+          if (!(err <= m->achieved_error)) {
+            m->achieved_error = err;
+          }
+        } else {
+          /* Refine the cell further using the nodes just evaluated */
+          ptr = next + nkeep * nodes * 2;
+          for (c = k * nodes; c < (k + 1) * nodes; ++c) {
+            *ptr++ = xout[c];
+            *ptr++ = yout[c];
+          }
+          cells[nkeep++] = cells[k];
+        }
+      }
+
+      ptr = cur;
+      cur = next;
+      next = ptr;
+      nact = nkeep;
+    }
+  }
+
+  status = 0;
+
+ exit:
+  free(cells);
+  free(cur);
+  free(next);
+  free(xin);
+  free(yin);
+  free(xout);
+  free(yout);
+
+  return status;
+}
+
+int
+default_wcsmap_init_table(struct wcsmap_param_t* m,
+                          pipeline_t* input,
+                          pipeline_t* output,
+                          int nx, int ny,
+                          double factor,
+                          const double* table,
+                          struct driz_error_t* error) {
+  int     snx;
+  int     sny;
+  size_t  table_size;
+
+  assert(m);
+  assert(input);
+  assert(output);
+  assert(table);
+  assert(m->input_wcs == NULL);
+  assert(m->output_wcs == NULL);
+  assert(m->table == NULL);
+
+  if (factor <= 0) {
+    driz_error_set_message(error, "A mapping table requires a positive step size");
+    return 1;
+  }
+
+  snx = (int)((double)nx / factor) + 2;
+  sny = (int)((double)ny / factor) + 2;
+  table_size = (size_t)snx * (size_t)sny * 2;
+
+  m->table = malloc(table_size * sizeof(double));
+  if (m->table == NULL) {
+    driz_error_set_message(error, "Out of memory");
+    return 1;
+  }
+  memcpy(m->table, table, table_size * sizeof(double));
+
+  m->input_wcs = input;
+  m->output_wcs = output;
+
+  m->nx = nx;
+  m->ny = ny;
+  m->snx = snx;
+  m->sny = sny;
+  m->factor = factor;
+
+  return 0;
+}
+
 void
 wcsmap_param_dump(struct wcsmap_param_t* m) {
   assert(m);
@@ -611,6 +899,9 @@ wcsmap_param_dump(struct wcsmap_param_t* m) {
 void
 wcsmap_param_free(struct wcsmap_param_t* m) {
   free(m->table);
+  free(m->cell_level);
+  free(m->cell_offset);
+  free(m->subtable);
   wcsmap_param_init(m);
 }
 
@@ -622,6 +913,15 @@ wcsmap_param_init(struct wcsmap_param_t* m) {
   m->input_wcs = NULL;
   m->output_wcs = NULL;
   m->table = NULL;
+
+  m->max_error = 0.0;
+  m->cell_level = NULL;
+  m->cell_offset = NULL;
+  m->subtable = NULL;
+  m->subtable_size = 0;
+  m->achieved_error = 0.0;
+  m->nevals = 0;
+  m->nrefined = 0;
 }
 
 /*
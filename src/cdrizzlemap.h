@@ -18,6 +18,23 @@ struct wcsmap_param_t {
   int         nx, ny;
   int         snx, sny;
   double      factor;
+
+  /* Adaptive refinement of the interpolation table.  Each cell of the
+     table (between nodes i, i+1 and j, j+1) may be split into
+     2**level x 2**level sub-cells, interpolated from their own table of
+     (2**level + 1)**2 nodes starting at cell_offset in subtable.  Cells
+     only get refined where needed to keep the interpolation within
+     max_error output pixels of the WCSs. */
+  double         max_error;
+  unsigned char* cell_level;
+  size_t*        cell_offset;
+  double*        subtable;
+  size_t         subtable_size;
+  /* Largest interpolation error found while refining, the number of
+     direct evaluations of the WCSs and the number of refined cells */
+  double         achieved_error;
+  long           nevals;
+  long           nrefined;
 };
 
 /**
@@ -51,6 +68,32 @@ default_wcsmap_init(struct wcsmap_param_t* m,
                     /* Output parameters */
                     struct driz_error_t* error);
 
+/**
+Refine the interpolation table set up by default_wcsmap_init wherever
+bilinear interpolation of the table is off by more than max_error
+output pixels from the WCSs, by splitting its cells into up to
+factor x factor sub-cells of one input pixel.
+*/
+int
+default_wcsmap_refine(struct wcsmap_param_t* m, double max_error,
+                      /* Output parameters */
+                      struct driz_error_t* error);
+
+/**
+Initialize the mapping from a previously computed interpolation table
+(as made by default_wcsmap_init) instead of evaluating the WCSs again.
+The table holds (nx / factor + 2) * (ny / factor + 2) pairs of output
+coordinates; factor must be greater than zero.
+*/
+int
+default_wcsmap_init_table(struct wcsmap_param_t* m,
+                          pipeline_t* input,
+                          pipeline_t* output,
+                          int nx, int ny, double factor,
+                          const double* table,
+                          /* Output parameters */
+                          struct driz_error_t* error);
+
 /**
 
 Declarations for supporting the DefaultMapping (pixel-based)
@@ -11,6 +11,12 @@
 #include <stdlib.h>
 #include <string.h>
 
+#ifdef _WIN32
+#include <windows.h>
+#else
+#include <pthread.h>
+#endif
+
 /*****************************************************************
  ERROR HANDLING
 */
@@ -80,6 +86,79 @@ driz_default_log_func(const char *format, ...) {
 
 driz_log_func_t driz_log_func = &driz_default_log_func;
 
+/*****************************************************************
+ THREADS
+*/
+struct driz_thread_s {
+#ifdef _WIN32
+  HANDLE handle;
+#else
+  pthread_t handle;
+#endif
+  driz_thread_func_t func;
+  void* arg;
+};
+
+#ifdef _WIN32
+static DWORD WINAPI
+driz_thread_main(LPVOID data) {
+  struct driz_thread_s* t = (struct driz_thread_s*)data;
+  t->func(t->arg);
+  return 0;
+}
+#else
+static void*
+driz_thread_main(void* data) {
+  struct driz_thread_s* t = (struct driz_thread_s*)data;
+  t->func(t->arg);
+  return NULL;
+}
+#endif
+
+int
+driz_thread_create(driz_thread_t* thread, driz_thread_func_t func, void* arg) {
+  struct driz_thread_s* t;
+
+  assert(thread);
+  assert(func);
+
+  t = malloc(sizeof(struct driz_thread_s));
+  if (t == NULL) return 1;
+
+  t->func = func;
+  t->arg = arg;
+
+#ifdef _WIN32
+  t->handle = CreateThread(NULL, 0, driz_thread_main, t, 0, NULL);
+  if (t->handle == NULL) {
+    free(t);
+    return 1;
+  }
+#else
+  if (pthread_create(&t->handle, NULL, driz_thread_main, t)) {
+    free(t);
+    return 1;
+  }
+#endif
+
+  *thread = t;
+  return 0;
+}
+
+void
+driz_thread_join(driz_thread_t thread) {
+  assert(thread);
+
+#ifdef _WIN32
+  WaitForSingleObject(thread->handle, INFINITE);
+  CloseHandle(thread->handle);
+#else
+  pthread_join(thread->handle, NULL);
+#endif
+
+  free(thread);
+}
+
 /*****************************************************************
  DATA TYPES
 */
@@ -166,14 +245,25 @@ driz_param_init(struct driz_param_t* p) {
   /* Output data */
   p->onx = 0;
   p->ony = 0;
+  p->frame_nx = 0;
+  p->frame_ny = 0;
   p->output_data = NULL;
   p->output_counts = NULL;
   p->output_context = NULL;
   p->output_done = NULL;
 
+  p->nthreads = 1;
+  p->band_ymin = 0;
+  p->band_ymax = -1;
+  p->hit_mask = NULL;
+
   p->lanczos.lut = NULL;
   p->lanczos.space = 1.0;
 
+  p->exact_kernel = FALSE;
+  p->kernel_lut.lut = NULL;
+  p->kernel_lut.nlut = 0;
+
   for (i = 0; i < MAXEN * MAXIM; ++i)
     p->intab[i] = 0;
 
@@ -37,6 +37,26 @@ void driz_default_log_func(const char *, ...);
 
 #define DRIZLOG(format, ...) ((*driz_log_func)(format, __VA_ARGS__))
 
+/*****************************************************************
+ THREADS
+*/
+
+typedef struct driz_thread_s* driz_thread_t;
+typedef void (*driz_thread_func_t)(void*);
+
+/**
+Start a native thread running func(arg).
+
+@return 1 if the thread could not be started
+*/
+int driz_thread_create(driz_thread_t* thread, driz_thread_func_t func, void* arg);
+
+/**
+Wait for a thread started with driz_thread_create to finish and
+release its resources.
+*/
+void driz_thread_join(driz_thread_t thread);
+
 /*****************************************************************
  CONVENIENCE MACROS
 */
@@ -202,6 +222,11 @@ struct driz_param_t {
   integer_t ymin;
   integer_t ymax;
 
+  /* Size of the output frame which the output arrays, covering
+     [xmin, xmax] x [ymin, ymax], are a section of */
+  integer_t frame_nx;
+  integer_t frame_ny;
+
   bool_t sub;
   bool_t no_over;
 
@@ -218,6 +243,16 @@ struct driz_param_t {
 
   integer_t* output_done; /* [nsy][nsx] */
 
+  /* Multi-threading.  When nthreads > 1 the output is split into
+     bands of rows, each one owned by a single thread; a kernel only
+     writes output rows in [band_ymin, band_ymax].  Threads record the
+     input pixels they hit in hit_mask ([dny][dnx] bits) instead of
+     counting misses directly. */
+  integer_t nthreads;
+  integer_t band_ymin;
+  integer_t band_ymax;
+  unsigned char* hit_mask;
+
   /* Stuff specific to certain kernel types */
   /* Gaussian values */
   struct {
@@ -226,6 +261,19 @@ struct driz_param_t {
   } gaussian;
   struct lanczos_param_t lanczos;
 
+  /* Finely sampled look-up table of the gaussian (as a function of the
+     squared distance) or lanczos (as a function of the scaled distance
+     along each axis) drizzle kernel, linearly interpolated by the kernel
+     loops.  With exact_kernel set, the kernel is evaluated analytically
+     instead. */
+  bool_t exact_kernel;
+  struct {
+    float* lut;
+    size_t nlut;
+    double sdp; /* table samples per unit of the tabulated argument */
+    int order;  /* order of the lanczos kernel */
+  } kernel_lut;
+
   /* Scaling */
   enum e_align_t align;
   double scale;
@@ -0,0 +1,110 @@
+""" Synthetic WCSs and input images for unit tests of the drizzle code
+which do not need any external data.
+"""
+import numpy as np
+from astropy.io import fits
+from stwcs.wcsutil import HSTWCS
+
+
+# SIP coefficients of a strongly non-linear distortion, of several pixels
+# over a couple of hundred pixels from the reference pixel
+SIP_COEFFS = {'A_2_0': 2e-4, 'A_1_1': -1e-4, 'A_0_2': 5e-5, 'A_3_0': 2e-6,
+              'A_1_2': -1e-6, 'B_2_0': -1e-4, 'B_1_1': 1.5e-4,
+              'B_0_2': 1e-4, 'B_0_3': 2e-6, 'B_2_1': 1e-6}
+
+
+def make_wcs(nx, ny, scale, rot=0.0, crpix=None, sip=None):
+    """ Return a tangent-plane `HSTWCS` for an image of ``nx`` by ``ny``
+    pixels of ``scale`` arcseconds, rotated by ``rot`` degrees, with its
+    reference pixel at ``crpix`` (the center of the image by default).
+    With ``sip``, a dictionary of third order SIP coefficients such as
+    `SIP_COEFFS`, the WCS also has that distortion.
+    """
+    if crpix is None:
+        crpix = (nx / 2.0, ny / 2.0)
+    c = np.cos(np.deg2rad(rot))
+    s = np.sin(np.deg2rad(rot))
+    cdelt = scale / 3600.0
+
+    hdr = fits.Header()
+    hdr['CTYPE1'] = 'RA---TAN'
+    hdr['CTYPE2'] = 'DEC--TAN'
+    hdr['CRVAL1'] = 10.0
+    hdr['CRVAL2'] = 20.0
+    hdr['CRPIX1'] = crpix[0]
+    hdr['CRPIX2'] = crpix[1]
+    hdr['CD1_1'] = -cdelt * c
+    hdr['CD1_2'] = cdelt * s
+    hdr['CD2_1'] = cdelt * s
+    hdr['CD2_2'] = cdelt * c
+    if sip is not None:
+        hdr['CTYPE1'] = 'RA---TAN-SIP'
+        hdr['CTYPE2'] = 'DEC--TAN-SIP'
+        hdr['A_ORDER'] = 3
+        hdr['B_ORDER'] = 3
+        hdr.update(sip)
+
+    wcs = HSTWCS(fits.HDUList([fits.PrimaryHDU(header=hdr)]))
+    wcs.pixel_shape = (nx, ny)
+    return wcs
+
+
+class SyntheticChip:
+    """ The attributes of an `imageObject` chip used by the drizzle step,
+    for a SCI extension written out to ``filename``.
+    """
+    def __init__(self, filename, wcs):
+        self.wcs = wcs
+        self.wcslin_pscale = wcs.pscale
+        self.header = {'extname': 'SCI', 'extver': 1}
+        self.outputNames = {'data': filename, 'outSky': filename + '.none',
+                            'staticMask': None, 'crmaskImage': None,
+                            'pixmap': None}
+        self.computedSky = None
+        self.in_units = 'cps'
+        self._chip = 1
+        self._effGain = 1.0
+        self._exptime = 1.0
+        self._wtscl = 1.0
+
+
+class SyntheticImage:
+    """ The interface of an `imageObject` used by the drizzle step, for a
+    single chip image held in memory.
+    """
+    scienceExt = 'SCI'
+    inmemory = True
+
+    def __init__(self, chip, outfinal):
+        self.chip = chip
+        self.outputNames = {'outFinal': outfinal}
+        self.virtualOutputs = {}
+
+    def returnAllChips(self, extname=None, exclude=None):
+        return [self.chip]
+
+    def set_wtscl(self, chip, wtscl_par):
+        pass
+
+    def buildMask(self, chip, bits=0, write=False):
+        return np.ones(self.chip.wcs.array_shape, dtype=np.uint16)
+
+
+def make_images(path, nimages, scale=0.05, seed=0):
+    """ Write ``nimages`` dithered and rotated 40x30 input images of random
+    values to the directory ``path`` and return them as `SyntheticImage`
+    objects.
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(nimages):
+        wcs = make_wcs(40, 30, scale, rot=7.0 * i,
+                       crpix=(20.0 + 3.3 * i, 15.0 - 2.1 * i))
+        filename = str(path.joinpath('input%d_flt.fits' % i))
+        sci = fits.ImageHDU(rng.random((30, 40)).astype(np.float32),
+                            name='SCI', ver=1)
+        fits.HDUList([fits.PrimaryHDU(), sci]).writeto(filename,
+                                                       overwrite=True)
+        images.append(SyntheticImage(SyntheticChip(filename, wcs),
+                                     str(path.joinpath('final_drz.fits'))))
+    return images
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from drizzlepac import ablot, cdriz, wcs_functions
+
+from .synthetic_data import make_wcs
+
+
+@pytest.fixture(autouse=True)
+def clear_pixel_maps():
+    wcs_functions.clear_pixel_maps()
+    yield
+    wcs_functions.clear_pixel_maps()
+
+
+def make_median(seed=0):
+    """ Return a 120x100 median image with sources, and its WCS. """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:100, :120]
+    median = rng.normal(10.0, 1.0, (100, 120))
+    for _ in range(15):
+        x0, y0 = rng.uniform(0, 120), rng.uniform(0, 100)
+        median += rng.uniform(50.0, 500.0) * np.exp(
+            -((x - x0)**2 + (y - y0)**2) / 3.0)
+    return median.astype(np.float32), make_wcs(120, 100, 0.05)
+
+
+@pytest.mark.parametrize('interp', ['nearest', 'linear', 'poly3', 'poly5'])
+@pytest.mark.parametrize('crpix', [
+    (40.0, 30.0),    # within the median
+    (85.0, 30.0),    # off its first columns
+    (-5.0, 30.0),    # off its last columns
+    (40.0, 60.0),    # off its first rows
+    (40.0, -15.0),   # off its last rows
+    (-5.0, -15.0),   # off a corner
+    (-80.0, 30.0),   # off the median altogether
+])
+def test_blot_source_bbox(interp, crpix):
+    """ Blotting a chip from the part of the median it maps onto must give
+    the same image as blotting it from the whole median, but where pixels
+    fall within a pixel past the last row or column of the median: `tblot`
+    interpolates those from past the end of the median array either way.
+    """
+    median, median_wcs = make_median()
+    chip_wcs = make_wcs(80, 60, 0.04, rot=13.0, crpix=crpix)
+    mapping = wcs_functions.get_pixel_map(chip_wcs, median_wcs, 10)
+    pix_ratio = median_wcs.pscale / chip_wcs.pscale
+
+    expected = np.zeros((60, 80), dtype=np.float32)
+    cdriz.tblot(median, expected, 1, 120, 1, 100, pix_ratio, 1.0, 1.0, 1.0,
+                'center', interp, 500.0, 0.0, 1.0, 1, mapping)
+    result = ablot.do_blot(median, median_wcs, chip_wcs, 500.0,
+                           coeffs=False, interp=interp)
+
+    bbox = ablot._blot_source_bbox(mapping, (60, 80), median.shape, interp)
+    if crpix != (40.0, 30.0):
+        assert bbox is not None
+    if crpix != (-80.0, 30.0):
+        assert np.count_nonzero(expected)
+
+    y, x = np.mgrid[1:61, 1:81].astype(np.float64)
+    xout, yout = mapping(x.ravel(), y.ravel())
+    past_end = ((xout > 120) & (xout <= 121)) | ((yout > 100) & (yout <= 101))
+    defined = ~past_end.reshape(60, 80)
+    assert np.count_nonzero(~defined) < 0.05 * defined.size
+    assert np.array_equal(result[defined], expected[defined])
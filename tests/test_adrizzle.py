@@ -0,0 +1,175 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from drizzlepac import adrizzle, sparsecontext, util
+
+from .synthetic_data import make_images, make_wcs
+
+
+PARAMS = {'pixfrac': 1.0, 'fillval': 'INDEF', 'stepsize': 10,
+          'wt_scl': 'exptime', 'bits': 0, 'wht_type': None,
+          'num_threads': 1, 'exact_kernel': False, 'max_map_error': None}
+
+
+def drizzle_sections(kernel, pix_ratio, nsections, size):
+    """ Drizzle one rotated input image onto an output frame split into
+    ``nsections`` by ``nsections`` sections, drizzled one after the other
+    into arrays of their own which then get pasted into the frame.
+    """
+    rng = np.random.default_rng(1)
+    insci = rng.random((30, 40)).astype(np.float32)
+    inwht = np.ones_like(insci)
+    input_wcs = make_wcs(40, 30, 0.05, rot=7.0)
+    output_wcs = make_wcs(int(40 * size / pix_ratio),
+                          int(30 * size / pix_ratio), 0.05 * pix_ratio)
+
+    ny, nx = output_wcs.array_shape
+    outsci = np.zeros((ny, nx), dtype=np.float32)
+    outwht = np.zeros((ny, nx), dtype=np.float32)
+    outctx = np.zeros((1, ny, nx), dtype=np.int32)
+    xedges = np.linspace(0, nx, nsections + 1).astype(int)
+    yedges = np.linspace(0, ny, nsections + 1).astype(int)
+    for y0, y1 in zip(yedges[:-1], yedges[1:]):
+        for x0, x1 in zip(xedges[:-1], xedges[1:]):
+            sci = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+            wht = np.zeros((y1 - y0, x1 - x0), dtype=np.float32)
+            ctx = np.zeros((1, y1 - y0, x1 - x0), dtype=np.int32)
+            adrizzle.do_driz(insci, input_wcs, inwht, output_wcs,
+                             sci, wht, ctx, 1.0, 'cps', 1.0,
+                             wcslin_pscale=input_wcs.pscale, kernel=kernel,
+                             xmin=x0 + 1, ymin=y0 + 1)
+            outsci[y0:y1, x0:x1] = sci
+            outwht[y0:y1, x0:x1] = wht
+            outctx[:, y0:y1, x0:x1] = ctx
+    return outsci, outwht, outctx
+
+
+@pytest.mark.parametrize('kernel', ['square', 'point', 'turbo', 'gaussian',
+                                    'lanczos2', 'lanczos3'])
+@pytest.mark.parametrize('pix_ratio', [1.0, 0.25, 0.1])
+@pytest.mark.parametrize('size', [1.6, 0.6])
+def test_sections_match_full_frame(kernel, pix_ratio, size):
+    """ Sections of the output frame, including those receiving flux from
+    input pixels landing further away than the default 5 pixel margin and
+    those at the edges of a frame smaller than the input, must match a
+    full-frame drizzle exactly.
+    """
+    full = drizzle_sections(kernel, pix_ratio, 1, size)
+    tiled = drizzle_sections(kernel, pix_ratio, 4, size)
+    for full_arr, tiled_arr in zip(full, tiled):
+        assert np.array_equal(full_arr, tiled_arr)
+
+
+def drizzle_tiles(tmp_path, monkeypatch, kernel, pool_size, memmap,
+                  nimages=3, output_wcs=None, nplanes=1, sparse=False):
+    """ Run the final drizzle of ``nimages`` input images in tiles, and
+    return the drizzled arrays along with the runs of the compact context
+    image (`None` unless ``sparse`` is set).
+    """
+    monkeypatch.setattr(adrizzle.tempfile, 'tempdir', str(tmp_path))
+    # Only imported by adrizzle on machines with several cores
+    monkeypatch.setattr(adrizzle, 'multiprocessing', multiprocessing,
+                        raising=False)
+    images = make_images(tmp_path, nimages)
+    if output_wcs is None:
+        output_wcs = make_wcs(200, 160, 0.0125, rot=-20.0)
+    paramDict = dict(PARAMS, kernel=kernel)
+
+    sci, wht, ctx, runs = adrizzle.run_driz_tiles(
+        images, output_wcs, output_wcs.deepcopy(), paramDict, np.nan,
+        nplanes, pool_size, None, memmap=memmap, sparse=sparse)
+    return np.array(sci), np.array(wht), np.array(ctx), runs
+
+
+@pytest.mark.parametrize('kernel', ['square', 'gaussian', 'lanczos3'])
+def test_tiles_match_full_frame(tmp_path, monkeypatch, kernel):
+    """ The final drizzle run in parallel tiles must give the same output
+    as a single tile.
+    """
+    full = drizzle_tiles(tmp_path, monkeypatch, kernel, 1, False)
+    tiled = drizzle_tiles(tmp_path, monkeypatch, kernel, 3, False)
+    for full_arr, tiled_arr in zip(full[:3], tiled[:3]):
+        assert np.array_equal(full_arr, tiled_arr, equal_nan=True)
+
+
+@pytest.mark.parametrize('kernel', ['square', 'gaussian', 'lanczos3'])
+def test_memmap_matches_in_memory(tmp_path, monkeypatch, kernel):
+    """ The final drizzle run out-of-core, in memory-mapped tiles, must give
+    the same output as drizzling the whole frame in memory.
+    """
+    full = drizzle_tiles(tmp_path, monkeypatch, kernel, 1, False)
+    # Small enough for out-of-core drizzling to need 8 tiles
+    monkeypatch.setattr(adrizzle, '_MEMMAP_TILE_SIZE', 4 * 3 * 200 * 20)
+    for pool_size in [1, 2]:
+        tiled = drizzle_tiles(tmp_path, monkeypatch, kernel, pool_size, True)
+        for full_arr, tiled_arr in zip(full[:3], tiled[:3]):
+            assert np.array_equal(full_arr, tiled_arr, equal_nan=True)
+
+
+@pytest.mark.parametrize('kernel', ['square', 'lanczos3'])
+@pytest.mark.parametrize('pool_size,memmap', [(1, False), (3, False),
+                                              (1, True)])
+def test_sparse_context(tmp_path, monkeypatch, kernel, pool_size, memmap):
+    """ The compact context image must convert back into exactly the
+    context planes of a standard drizzle of the same images.
+    """
+    # More inputs than fit in a single context plane
+    output_wcs = make_wcs(300, 240, 0.05)
+    sci, wht, ctx, _ = drizzle_tiles(tmp_path, monkeypatch, kernel, 1, False,
+                                     nimages=40, output_wcs=output_wcs,
+                                     nplanes=2)
+    assert np.any(ctx[1] != 0)
+
+    tiled = drizzle_tiles(tmp_path, monkeypatch, kernel, pool_size, memmap,
+                          nimages=40, output_wcs=output_wcs, nplanes=1,
+                          sparse=True)
+    assert np.array_equal(sci, tiled[0], equal_nan=True)
+    assert np.array_equal(wht, tiled[1])
+    runs = tiled[3]
+    assert set(runs[:, 0]) == set(range(1, 41))
+
+    planes = sparsecontext.context_to_planes((runs, sci.shape), nplanes=2)
+    assert np.array_equal(planes, ctx)
+
+    # Through the CTX table written out to the final product
+    hdu = sparsecontext.build_table_hdu(runs, sci.shape)
+    assert np.array_equal(sparsecontext.context_to_planes(hdu), ctx)
+
+
+@pytest.mark.parametrize('memmap,sparse', [(False, False), (True, False),
+                                           (False, True)])
+def test_pool_tiles(tmp_path, monkeypatch, memmap, sparse):
+    """ The final drizzle run in the tiles drizzled by the workers of a
+    pool, started before the sky of the images got computed, must give the
+    same output as a single tile.
+    """
+    monkeypatch.setattr(adrizzle.tempfile, 'tempdir', str(tmp_path))
+    monkeypatch.setattr(adrizzle, 'multiprocessing', multiprocessing,
+                        raising=False)
+    images = make_images(tmp_path, 3)
+    output_wcs = make_wcs(200, 160, 0.0125, rot=-20.0)
+    paramDict = dict(PARAMS, kernel='square')
+
+    def drizzle(pool_size, pool=None):
+        sci, wht, ctx, runs = adrizzle.run_driz_tiles(
+            images, output_wcs, output_wcs.deepcopy(), paramDict, np.nan, 1,
+            pool_size, None, memmap=memmap, sparse=sparse, pool=pool)
+        return np.array(sci), np.array(wht), np.array(ctx), runs
+
+    pool = util.WorkerPool(images, 2)
+    try:
+        for i, img in enumerate(images):
+            img.chip.computedSky = 0.25 * (i + 1)
+        tiled = drizzle(3, pool=pool)
+    finally:
+        pool.close()
+    full = drizzle(1)
+
+    for full_arr, tiled_arr in zip(full[:3], tiled[:3]):
+        assert np.array_equal(full_arr, tiled_arr, equal_nan=True)
+    if sparse:
+        assert np.array_equal(full[3], tiled[3])
+    assert not np.array_equal(full[0], drizzle_tiles(
+        tmp_path, monkeypatch, 'square', 1, False)[0], equal_nan=True)
@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+
+from drizzlepac import cdriz
+
+from .synthetic_data import make_wcs
+
+
+def drizzle(kernel, pix_ratio, nthreads, pixfrac=1.0, exact_kernel=False):
+    """ Drizzle three dithered and rotated input images onto the same output
+    frame with ``nthreads`` threads, and return the output arrays along
+    with the numbers of missed pixels and skipped lines.
+    """
+    rng = np.random.default_rng(2)
+    output_wcs = make_wcs(int(70 / pix_ratio), int(40 / pix_ratio),
+                          0.05 * pix_ratio, rot=-10.0)
+    ny, nx = output_wcs.array_shape
+    outsci = np.zeros((ny, nx), dtype=np.float32)
+    outwht = np.zeros((ny, nx), dtype=np.float32)
+    outctx = np.zeros((ny, nx), dtype=np.int32)
+
+    results = []
+    for i in range(3):
+        insci = rng.random((60, 80)).astype(np.float32)
+        inwht = rng.random((60, 80)).astype(np.float32)
+        inwht[5:9, :] = 0.0
+        input_wcs = make_wcs(80, 60, 0.05, rot=11.0 * i,
+                             crpix=(35.0 + 4.7 * i, 25.0 - 3.1 * i))
+        mapping = cdriz.DefaultWCSMapping(input_wcs, output_wcs, 80, 60, 10)
+        _vers, nmiss, nskip = cdriz.tdriz(
+            insci, inwht, outsci, outwht, outctx, i + 1, 0, 1, 1, 60,
+            pix_ratio, 1.0, 1.0, 'center', pixfrac, kernel, 'cps', 1.0, 1.0,
+            'INDEF', 0, 0, 1, mapping, nthreads, int(exact_kernel))
+        results.append((nmiss, nskip))
+    return outsci, outwht, outctx, results
+
+
+@pytest.mark.parametrize('kernel', ['square', 'point', 'turbo', 'gaussian',
+                                    'lanczos2', 'lanczos3'])
+@pytest.mark.parametrize('pix_ratio', [1.0, 0.5])
+@pytest.mark.parametrize('nthreads', [2, 3, 8])
+def test_tdriz_threads(kernel, pix_ratio, nthreads):
+    """ Drizzling with several threads must give the same output, and count
+    the same missed pixels and skipped lines, as drizzling serially.
+    """
+    serial = drizzle(kernel, pix_ratio, 1)
+    threaded = drizzle(kernel, pix_ratio, nthreads)
+    for serial_arr, threaded_arr in zip(serial[:3], threaded[:3]):
+        assert np.array_equal(serial_arr, threaded_arr, equal_nan=True)
+    assert serial[3] == threaded[3]
+
+
+@pytest.mark.parametrize('kernel', ['square', 'point', 'turbo', 'gaussian',
+                                    'lanczos2', 'lanczos3'])
+@pytest.mark.parametrize('pix_ratio', [1.0, 0.5])
+@pytest.mark.parametrize('pixfrac', [1.0, 0.6])
+def test_tdriz_exact_kernel(kernel, pix_ratio, pixfrac):
+    """ The kernels interpolated from look-up tables must be within 1e-6 of
+    the analytic kernels, relative to their peak value: the output weights,
+    and fluxes (science times weight), must not differ by more than that
+    relative to their largest value, allowing for single precision.
+    """
+    tabulated = drizzle(kernel, pix_ratio, 1, pixfrac=pixfrac)
+    exact = drizzle(kernel, pix_ratio, 1, pixfrac=pixfrac, exact_kernel=True)
+    if kernel in ['square', 'point', 'turbo']:
+        for arr, exact_arr in zip(tabulated[:3], exact[:3]):
+            assert np.array_equal(arr, exact_arr)
+        return
+
+    bound = 1e-6 + 2 * np.finfo(np.float32).eps
+    flux = tabulated[0].astype(np.float64) * tabulated[1]
+    exact_flux = exact[0].astype(np.float64) * exact[1]
+    assert np.abs(flux - exact_flux).max() <= bound * np.abs(exact_flux).max()
+    wht_diff = np.abs(tabulated[1] - exact[1]).max()
+    assert 0 < wht_diff <= bound * np.abs(exact[1]).max()
+    assert np.array_equal(tabulated[2], exact[2])
+    assert tabulated[3] == exact[3]
+
+
+def map_and_drizzle(mapping, kernel):
+    """ Drizzle an 80x60 image onto a finer, rotated output frame with
+    ``mapping``, and blot the output back onto the input frame.
+    """
+    rng = np.random.default_rng(0)
+    insci = rng.random((60, 80)).astype(np.float32)
+    inwht = np.ones_like(insci)
+    outsci = np.zeros((80, 140), dtype=np.float32)
+    outwht = np.zeros((80, 140), dtype=np.float32)
+    outctx = np.zeros((80, 140), dtype=np.int32)
+    _vers, nmiss, nskip = cdriz.tdriz(
+        insci, inwht, outsci, outwht, outctx, 1, 0, 1, 1, 60, 0.5, 1.0, 1.0,
+        'center', 1.0, kernel, 'cps', 1.0, 1.0, 'INDEF', 0, 0, 1, mapping)
+    blotted = np.zeros((60, 80), dtype=np.float32)
+    cdriz.tblot(outsci, blotted, 1, 140, 1, 80, 0.5, 1.0, 1.0, 1.0,
+                'center', 'poly5', 1.0, 0.0, 1.0, 1, mapping)
+    return outsci, outwht, outctx, blotted, nmiss, nskip
+
+
+def make_mapping():
+    output_wcs = make_wcs(140, 80, 0.025, rot=-10.0)
+    input_wcs = make_wcs(80, 60, 0.05, rot=11.0, crpix=(35.0, 25.0))
+    return cdriz.DefaultWCSMapping(input_wcs, output_wcs, 80, 60, 10)
+
+
+@pytest.mark.parametrize('kernel', ['square', 'point', 'turbo', 'gaussian',
+                                    'lanczos3'])
+def test_python_mapping(kernel):
+    """ A Python mapping, evaluated over blocks of rows, must give the same
+    output as the same mapping evaluated line by line in C, in far fewer
+    calls than there are lines.
+    """
+    mapping = make_mapping()
+    sizes = []
+
+    def py_mapping(x, y):
+        sizes.append(len(x))
+        return mapping(x, y)
+
+    expected = map_and_drizzle(mapping, kernel)
+    result = map_and_drizzle(py_mapping, kernel)
+
+    for arr, expected_arr in zip(result, expected):
+        assert np.array_equal(arr, expected_arr)
+    assert len(sizes) < 10
+    assert min(sizes) > 140
+
+
+@pytest.mark.parametrize('ncalls', [0, 1, 3])
+def test_python_mapping_error(ncalls):
+    """ An exception raised by a Python mapping, in its first or a later
+    call, must reach the caller.
+    """
+    mapping = make_mapping()
+    calls = []
+
+    def py_mapping(x, y):
+        calls.append(len(x))
+        if len(calls) > ncalls:
+            raise ValueError('mapping failed')
+        return mapping(x, y)
+
+    with pytest.raises(ValueError, match='mapping failed'):
+        map_and_drizzle(py_mapping, 'square')
+    assert len(calls) == ncalls + 1
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+from drizzlepac import drizCR, quickDeriv
+
+
+def reference_cr_mask(input_image, blot_data, blot_deriv, gain, rn, backg,
+                      snr, scale, grow, ctegrow, cte_dir):
+    """ The cosmic ray mask, computed by convolving the masks with boxes of
+    ones and with the CTE tail using ``scipy.signal.convolve2d``.
+    """
+    snr1, snr2 = snr
+    mult1, mult2 = scale
+
+    t1 = np.absolute(input_image - blot_data)
+    ta = np.sqrt(gain * np.abs(blot_data + backg) + rn**2)
+    tmp1 = t1 <= mult1 * blot_deriv + snr1 * ta / gain
+    kernel = np.ones((3, 3), dtype=np.uint16)
+    tmp2 = signal.convolve2d(tmp1, kernel, boundary='symm', mode='same')
+    cr_mask = (t1 <= mult2 * blot_deriv + snr2 * ta / gain) | (tmp2 >= 9)
+
+    cr_grow_kernel = np.ones((grow, grow), dtype=np.uint16)
+    cr_grow_kernel_conv = signal.convolve2d(
+        cr_mask, cr_grow_kernel, boundary='symm', mode='same'
+    )
+    cr_ctegrow_kernel = np.zeros((2 * ctegrow + 1, 2 * ctegrow + 1))
+    if cte_dir == 1:
+        cr_ctegrow_kernel[0:ctegrow, ctegrow] = 1
+    elif cte_dir == -1:
+        cr_ctegrow_kernel[ctegrow + 1:2 * ctegrow + 1, ctegrow] = 1
+    cr_ctegrow_kernel_conv = signal.convolve2d(
+        cr_mask, cr_ctegrow_kernel, boundary='symm', mode='same'
+    )
+
+    cr_grow_mask = cr_grow_kernel_conv >= grow**2
+    cr_ctegrow_mask = cr_ctegrow_kernel_conv >= ctegrow
+    return cr_grow_mask & cr_ctegrow_mask
+
+
+def make_chip(shape, seed=0):
+    """ Return an image with sources and cosmic rays, the blotted median
+    without the cosmic rays and its derivative.
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    y, x = np.mgrid[:ny, :nx]
+    blot_data = np.full(shape, 30.0, dtype=np.float32)
+    for _ in range(8):
+        x0, y0 = rng.uniform(0, nx), rng.uniform(0, ny)
+        flux = rng.uniform(100.0, 5000.0)
+        blot_data += flux * np.exp(-((x - x0)**2 + (y - y0)**2) / 4.0)
+
+    input_image = blot_data + rng.normal(0.0, 5.0, shape).astype(np.float32)
+    hits = rng.random(shape) < 0.02
+    input_image[hits] += rng.uniform(50.0, 2000.0, hits.sum())
+    input_image[ny // 2, :] += 1000.0  # a cosmic ray along a whole row
+    blot_deriv = quickDeriv.qderiv(blot_data)
+    return input_image, blot_data, blot_deriv
+
+
+@pytest.mark.parametrize('shape', [(37, 53), (5, 64), (64, 3)])
+@pytest.mark.parametrize('grow', [1, 2, 3, 4, 5])
+@pytest.mark.parametrize('ctegrow,cte_dir', [(0, 1), (1, 1), (4, 1),
+                                             (1, -1), (4, -1), (3, 0)])
+@pytest.mark.parametrize('block_size', [None, 1, 100])
+def test_cr_mask(monkeypatch, shape, grow, ctegrow, cte_dir, block_size):
+    """ The cosmic ray mask computed with box erosions, in blocks of rows
+    of any size, must match the one computed with convolutions.
+    """
+    if block_size is not None:
+        monkeypatch.setattr(drizCR, '_CR_BLOCK_SIZE', block_size)
+    input_image, blot_data, blot_deriv = make_chip(shape)
+    args = (input_image, blot_data, blot_deriv, 7.0, 5.0, 10.0, (4.0, 3.0),
+            (0.5, 0.4), grow, ctegrow, cte_dir)
+
+    expected = reference_cr_mask(*args)
+    cr_mask = drizCR._cr_mask(*args)
+
+    assert cr_mask.dtype == bool
+    assert not expected.all()
+    assert np.array_equal(cr_mask, expected)
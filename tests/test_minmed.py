@@ -0,0 +1,169 @@
+import numpy as np
+import pytest
+
+from stsci.image import numcombine
+
+from drizzlepac import cdriz, minmed
+
+
+def make_stack(nimages, ties=False, seed=0):
+    """ Return a float32 stack of ``nimages`` 24x30 images, with cosmic-ray
+    like outliers, and a stack of masks (True for bad pixels) masking about
+    a third of the pixels, all pixels of a few rows, and all pixels but one
+    in a few others.  With ``ties``, pixel values are small integers, so
+    that many pixels of the stack have the same value.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (nimages, 24, 30)
+    if ties:
+        images = rng.integers(0, 4, shape).astype(np.float32)
+    else:
+        images = rng.normal(100.0, 10.0, shape).astype(np.float32)
+        images[rng.random(shape) < 0.05] += 5000.0
+
+    masks = rng.random(shape) < 0.3
+    masks[:, 3, :] = True
+    masks[:, 7, :] = True
+    masks[1:, 10, :] = True
+    masks[:-1, 11, :] = True
+    return images, masks
+
+
+@pytest.mark.parametrize('nimages', [1, 2, 3, 4, 7, 12])
+@pytest.mark.parametrize('comb_type', ['median', 'mean'])
+@pytest.mark.parametrize('nlow,nhigh', [(0, 0), (0, 1), (1, 1), (1, 2)])
+@pytest.mark.parametrize('ties', [False, True])
+@pytest.mark.parametrize('use_masks', [False, True])
+def test_combine_stack(nimages, comb_type, nlow, nhigh, ties, use_masks):
+    """ The median or mean of `cdriz.combine_stack` must match
+    ``num_combine`` for the same rejection, with or without masks.
+    """
+    if nimages - nlow - nhigh < 1:
+        pytest.skip('No pixel left after rejection')
+    images, masks = make_stack(nimages, ties=ties)
+    if not use_masks:
+        masks = None
+
+    expected = numcombine.num_combine(images, masks=masks,
+                                      combination_type=comb_type,
+                                      nlow=nlow, nhigh=nhigh)
+    result = cdriz.combine_stack(
+        images, masks=None if masks is None else masks.view(np.uint8),
+        nlow=nlow, nhigh=nhigh, average=comb_type == 'mean')[0]
+
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize('nimages', [2, 3, 4, 7, 12])
+@pytest.mark.parametrize('ties', [False, True])
+@pytest.mark.parametrize('use_masks', [False, True])
+def test_min_med(monkeypatch, nimages, ties, use_masks):
+    """ `minmed.min_med` must give the same results through
+    `cdriz.combine_stack` as through ``num_combine`` and numpy.
+    """
+    images, masks = make_stack(nimages, ties=ties)
+    rng = np.random.default_rng(1)
+    weights = rng.uniform(500.0, 1000.0, images.shape).astype(np.float32)
+    if not use_masks:
+        masks = None
+    readnoise = list(rng.uniform(3.0, 5.0, nimages))
+    exptime = list(rng.uniform(400.0, 600.0, nimages))
+    background = list(rng.uniform(10.0, 50.0, nimages))
+
+    def combine():
+        return minmed.min_med(
+            list(images), list(weights), readnoise, exptime, background,
+            weight_masks=None if masks is None else list(masks),
+            combine_grow=1, combine_nsigma1=4, combine_nsigma2=3)
+
+    result = combine()
+    monkeypatch.setattr(minmed, 'cdriz', None)
+    expected = combine()
+
+    assert np.array_equal(result, expected)
+
+
+def make_approx_stack(kind, nimages, seed=0):
+    """ Return a float32 stack of ``nimages`` 20x25 images of the given kind
+    of values, and their weights.
+    """
+    rng = np.random.default_rng(seed)
+    shape = (nimages, 20, 25)
+    if kind == 'gaussian':
+        images = rng.normal(100.0, 10.0, shape)
+    elif kind == 'cosmic_rays':
+        images = rng.normal(100.0, 10.0, shape)
+        images[rng.random(shape) < 0.1] += rng.uniform(1e3, 1e5)
+    elif kind == 'bimodal':
+        images = np.where(rng.random(shape) < 0.5, 0.0, 1000.0)
+        images += rng.normal(0.0, 1.0, shape)
+    else:
+        images = np.full(shape, 7.25)
+    weights = rng.uniform(0.0, 1000.0, shape)
+    return images.astype(np.float32), weights.astype(np.float32)
+
+
+def median_bound(images, good, nbins):
+    """ Largest error allowed for the approximate median: ``1 / nbins**2``
+    of the standard deviation of the good pixels, plus the rounding of the
+    result to single precision.
+    """
+    n = np.maximum(good.sum(axis=0), 1)
+    mean = np.sum(images * good, axis=0, dtype=np.float64) / n
+    std = np.sqrt(np.sum(((images - mean) * good)**2, axis=0) / n)
+    return std / nbins**2 + 2 * np.finfo(np.float32).eps * np.abs(mean)
+
+
+@pytest.mark.parametrize('kind', ['gaussian', 'cosmic_rays', 'bimodal',
+                                  'constant'])
+@pytest.mark.parametrize('nimages', range(1, 61))
+@pytest.mark.parametrize('nlow,nhigh', [(0, 0), (0, 1), (1, 1), (2, 2)])
+@pytest.mark.parametrize('nbins', [10, 100])
+def test_approx_median(kind, nimages, nlow, nhigh, nbins):
+    """ `minmed.approx_median` must be within ``1 / nbins**2`` of the
+    standard deviation of the good pixels of the exact median.
+    """
+    if nimages - nlow - nhigh < 1:
+        pytest.skip('No pixel left after rejection')
+    images, weights = make_approx_stack(kind, nimages)
+    thresholds = [250.0] * nimages
+    masks = weights < 250.0
+
+    expected = numcombine.num_combine(images, masks=masks,
+                                      combination_type='median',
+                                      nlow=nlow, nhigh=nhigh)
+    result = minmed.approx_median(lambda i: (images[i], weights[i]),
+                                  nimages, weight_thresholds=thresholds,
+                                  nlow=nlow, nhigh=nhigh, nbins=nbins)
+
+    bound = median_bound(images, ~masks, nbins)
+    assert np.all(np.abs(result.astype(np.float64) - expected) <= bound)
+
+
+@pytest.mark.parametrize('kind', ['gaussian', 'cosmic_rays', 'constant'])
+@pytest.mark.parametrize('nimages', [2, 3, 4, 5, 8, 13, 30])
+def test_approx_min_med(kind, nimages):
+    """ `minmed.approx_min_med` must be within the bound of `approx_median`
+    of `minmed.min_med`, but for the few pixels where the approximation of
+    the median changes the choice between the median and the minimum.
+    """
+    images, weights = make_approx_stack(kind, nimages, seed=1)
+    rng = np.random.default_rng(2)
+    readnoise = list(rng.uniform(3.0, 5.0, nimages))
+    exptime = list(rng.uniform(400.0, 600.0, nimages))
+    background = list(rng.uniform(10.0, 50.0, nimages))
+    thresholds = [250.0] * nimages
+    masks = weights < 250.0
+
+    expected = minmed.min_med(list(images), list(weights), readnoise,
+                              exptime, background, weight_masks=list(masks))
+    result = minmed.approx_min_med(lambda i: (images[i], weights[i]),
+                                   nimages, readnoise, exptime, background,
+                                   weight_thresholds=thresholds, nbins=100)
+
+    minimum = np.where(masks, np.inf, images).min(axis=0)
+    minimum[np.isinf(minimum)] = 0
+    bound = median_bound(images, ~masks, 100)
+    flipped = np.abs(result.astype(np.float64) - expected) > bound
+    assert np.all((result == minimum) | (expected == minimum) | ~flipped)
+    assert flipped.mean() < 0.01
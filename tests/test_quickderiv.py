@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from drizzlepac import quickDeriv
+
+
+def reference_qderiv(array):
+    """ The derivative as computed, in double precision, by the original
+    ``qderiv``: the largest absolute difference with each neighbour shifted
+    onto a whole array of zeros.
+    """
+    ny, nx = array.shape
+    out = np.zeros(array.shape, dtype=np.float64)
+    shifts = [
+        ((slice(0, ny - 1), slice(1, nx - 1)),
+         (slice(0, ny - 1), slice(0, nx - 2))),
+        ((slice(0, ny - 1), slice(0, nx - 2)),
+         (slice(0, ny - 1), slice(1, nx - 1))),
+        ((slice(1, ny - 1), slice(0, nx - 1)),
+         (slice(0, ny - 2), slice(0, nx - 1))),
+        ((slice(0, ny - 2), slice(0, nx - 1)),
+         (slice(1, ny - 1), slice(0, nx - 1))),
+    ]
+    for dst, src in shifts:
+        shifted = np.zeros(array.shape, dtype=np.float64)
+        shifted[dst] = array[src]
+        out = np.maximum(np.fabs(array - shifted), out)
+    return out
+
+
+def make_image(shape, dtype, seed=0):
+    """ Return an image with negative values, sources and a flat area. """
+    rng = np.random.default_rng(seed)
+    if np.issubdtype(dtype, np.integer):
+        image = rng.integers(-1000, 1000, shape)
+    else:
+        image = rng.normal(0.0, 10.0, shape)
+        image[rng.random(shape) < 0.05] += 5000.0
+    image[:shape[0] // 2, :shape[1] // 2] = 7
+    return image.astype(dtype)
+
+
+@pytest.mark.parametrize('shape', [(37, 53), (2, 2), (1, 9), (9, 1),
+                                   (2, 40), (40, 2), (3, 3)])
+@pytest.mark.parametrize('dtype,result_dtype', [
+    (np.float32, np.float32), (np.float64, np.float64),
+    (np.int16, np.float32), (np.int32, np.float64)])
+@pytest.mark.parametrize('block_size', [None, 1, 5, 100])
+def test_qderiv(monkeypatch, shape, dtype, result_dtype, block_size):
+    """ The derivative computed block of rows after block of rows must be
+    the same, edge rows and columns included, as the one computed by the
+    original ``qderiv`` over whole arrays, in the precision of the input.
+    """
+    if block_size is not None:
+        monkeypatch.setattr(quickDeriv, '_BLOCK_SIZE', block_size)
+    image = make_image(shape, dtype)
+    expected = reference_qderiv(image).astype(result_dtype)
+
+    result = quickDeriv.qderiv(image)
+    assert result.dtype == result_dtype
+    assert np.array_equal(result, expected)
+
+    out = np.full(shape, np.nan, dtype=np.float64)
+    assert quickDeriv.qderiv(image, out=out) is out
+    assert np.array_equal(out, reference_qderiv(image))
@@ -0,0 +1,225 @@
+import logging
+import os
+
+import numpy as np
+import pytest
+
+from stsci.skypac.skystatistics import SkyStats
+
+from drizzlepac import sky
+
+
+class FakeChip:
+    def __init__(self, chip, signature, image_shape):
+        self._chip = chip
+        self.signature = signature
+        self.image_shape = image_shape
+        self.outputNames = {'staticMask': None}
+
+
+class FakeImage:
+    """ The parts of an `imageObject` that `sky._buildStaticDQUserMask`
+    uses, for an in-memory image with one DQ array per chip.
+    """
+    inmemory = True
+    maskExt = 'DQ'
+
+    def __init__(self, dqarrs, filename='fake_flt.fits'):
+        self._filename = filename
+        self.virtualOutputs = {}
+        self.dqarrs = dqarrs
+        self.chips = {
+            'SCI,{:d}'.format(i + 1):
+                FakeChip(i + 1, (filename, i + 1), dqarrs[i].shape)
+            for i in range(len(dqarrs))
+        }
+
+    def __getitem__(self, ext):
+        return self.chips[ext]
+
+    def getData(self, exten=None, attach=False):
+        return self.dqarrs[int(exten.split(',')[1]) - 1]
+
+    def buildMask(self, chip, bits=0):
+        return (self.dqarrs[chip - 1] & ~bits == 0).astype(np.uint8)
+
+
+def build_mask(img, ext, cache_dir, cache_size=None, sky_bits=16,
+               sky_sample=None):
+    tmpmask, _ = sky._buildStaticDQUserMask(
+        img, ext, sky_bits, False, None, None, True,
+        cache_dir=None if cache_dir is None else str(cache_dir),
+        cache_size=cache_size, sky_sample=sky_sample
+    )
+    return tmpmask.hdu[0].data
+
+
+def cached_files(cache_dir):
+    return sorted(f for f in os.listdir(str(cache_dir))
+                  if f.endswith('_skymatch_mask.fits'))
+
+
+def cache_name(img, cache_dir, sky_bits=16):
+    key = sky._skyMaskCacheKey(img, 'SCI,1', sky_bits,
+                               (img.dqarrs[0], None, None))
+    return sky._skyMaskCacheName(str(cache_dir), key)
+
+
+def make_dq(seed, shape=(64, 64)):
+    rng = np.random.default_rng(seed)
+    return rng.choice(np.array([0, 16, 32], dtype=np.int16), shape)
+
+
+def test_skymask_cache_hit_miss(tmp_path):
+    """ A mask built for a second time must be read from the cache and be
+    equal to the one first built, while a chip with another DQ array must
+    get a mask of its own.
+    """
+    cache_dir = tmp_path / 'cache'
+    img = FakeImage([make_dq(0), make_dq(1)])
+
+    first = build_mask(img, 'SCI,1', cache_dir)
+    assert len(cached_files(cache_dir)) == 1
+    assert np.array_equal(first, img.buildMask(1, bits=16))
+
+    # hit:
+    fname = os.path.join(str(cache_dir), cached_files(cache_dir)[0])
+    os.utime(fname, (0, 0))
+    second = build_mask(img, 'SCI,1', cache_dir)
+    assert np.array_equal(first, second)
+    assert len(cached_files(cache_dir)) == 1
+    assert os.stat(fname).st_mtime > 0
+
+    # miss, for other DQ flags or other sky bits:
+    other = build_mask(img, 'SCI,2', cache_dir)
+    assert np.array_equal(other, img.buildMask(2, bits=16))
+    assert len(cached_files(cache_dir)) == 2
+    build_mask(img, 'SCI,1', cache_dir, sky_bits=32)
+    assert len(cached_files(cache_dir)) == 3
+
+
+def test_skymask_cache_eviction(tmp_path):
+    """ The least recently used masks must get evicted until the cache is
+    within ``skymask_cachesize``, but never the mask just cached.
+    """
+    cache_dir = tmp_path / 'cache'
+    imgs = [FakeImage([make_dq(i)], filename='img{:d}.fits'.format(i))
+            for i in range(6)]
+    for i, img in enumerate(imgs[:5]):
+        build_mask(img, 'SCI,1', cache_dir)
+        os.utime(cache_name(img, cache_dir), (1000 + i, 1000 + i))
+    assert len(cached_files(cache_dir)) == 5
+    size = os.path.getsize(cache_name(imgs[0], cache_dir))
+
+    # a hit makes the oldest mask the most recently used one:
+    build_mask(imgs[0], 'SCI,1', cache_dir)
+    os.utime(cache_name(imgs[0], cache_dir), (2000, 2000))
+
+    cache_size = 3.5 * size / (1024 * 1024)
+    build_mask(imgs[5], 'SCI,1', cache_dir, cache_size=cache_size)
+    kept = [os.path.isfile(cache_name(img, cache_dir)) for img in imgs]
+    assert kept == [True, False, False, False, True, True]
+    total = sum(os.path.getsize(os.path.join(str(cache_dir), f))
+                for f in cached_files(cache_dir))
+    assert total <= cache_size * 1024 * 1024
+
+    # a cache smaller than one mask keeps only the mask just cached:
+    build_mask(imgs[1], 'SCI,1', cache_dir, cache_size=0)
+    assert cached_files(cache_dir) == [
+        os.path.basename(cache_name(imgs[1], cache_dir))
+    ]
+
+
+def test_skymask_cache_unwritable(tmp_path, caplog):
+    """ When the cache cannot be written, the mask must still be built,
+    with a warning.
+    """
+    cache_dir = tmp_path / 'cache'
+    cache_dir.write_text('not a directory')
+    img = FakeImage([make_dq(0)])
+    with caplog.at_level(logging.WARNING):
+        mask = build_mask(img, 'SCI,1', cache_dir)
+    assert np.array_equal(mask, img.buildMask(1, bits=16))
+    assert 'Could not cache sky mask' in caplog.text
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_skymask_all_masked(tmp_path, caplog, cached):
+    """ Masks leaving no pixel must be reported, also when cached. """
+    cache_dir = tmp_path / 'cache'
+    img = FakeImage([np.full((16, 16), 32, dtype=np.int16)])
+    if cached:
+        build_mask(img, 'SCI,1', cache_dir)
+    caplog.clear()
+    with caplog.at_level(logging.WARNING):
+        build_mask(img, 'SCI,1', cache_dir)
+    assert 'All pixels masked out' in caplog.text
+
+
+SKYPARS = {'skylower': None, 'skyupper': None, 'skyclip': 5,
+           'skylsigma': 4.0, 'skyusigma': 4.0, 'skywidth': 0.1}
+
+
+def make_sky(seed, shape=(300, 400)):
+    """ Return an image of a sky of 100 with noise and a few sources. """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    y, x = np.mgrid[:ny, :nx]
+    data = rng.normal(100.0, 10.0, shape)
+    for _ in range(20):
+        x0, y0 = rng.uniform(0, nx), rng.uniform(0, ny)
+        data += rng.uniform(100.0, 2000.0) * np.exp(
+            -((x - x0)**2 + (y - y0)**2) / 8.0)
+    return data.astype(np.float32)
+
+
+@pytest.mark.parametrize('cache', [False, True])
+def test_skysample_mask(tmp_path, cache):
+    """ The sampled sky mask must keep about ``skysample`` pixels, always
+    the same ones, among the good pixels of the DQ mask.
+    """
+    img = FakeImage([make_dq(0, shape=(300, 400))])
+    cache_dir = tmp_path / 'cache' if cache else None
+    dqmask = img.buildMask(1, bits=16)
+
+    mask = build_mask(img, 'SCI,1', cache_dir, sky_sample=1000)
+    sample = sky._skySampleMask((300, 400), 1000)
+    assert np.count_nonzero(sample) == 1000
+    assert np.array_equal(mask, dqmask & sample)
+    assert np.array_equal(build_mask(img, 'SCI,1', cache_dir,
+                                     sky_sample=1000), mask)
+
+    # without a DQ mask, or sampling more pixels than the chip has:
+    assert np.array_equal(build_mask(img, 'SCI,1', cache_dir, sky_bits=None,
+                                     sky_sample=1000), sample)
+    assert np.array_equal(build_mask(img, 'SCI,1', cache_dir,
+                                     sky_sample=300 * 400), dqmask)
+
+
+@pytest.mark.parametrize('skystat', ['mean', 'median', 'mode'])
+def test_skysample_sky(skystat):
+    """ The sky of the sampled pixels, computed as ``skymatch`` does, must be
+    within a few times the reported error of the sky of all the pixels, and
+    the error must be about the rms difference between the two.
+    """
+    skypars = dict(SKYPARS, skystat=skystat, skysample=10000)
+    stats = SkyStats(skystat=skystat, lower=None, upper=None, nclip=5,
+                     lsig=4.0, usig=4.0, binwidth=0.1)
+    dqmask = make_dq(0, shape=(300, 400)) != 32
+    mask = dqmask & sky._skySampleMask((300, 400), 10000).astype(bool)
+
+    diffs = []
+    errors = []
+    for seed in range(40):
+        data = make_sky(seed)
+        full, _npix = stats.calc_sky(data[dqmask])
+        sampled, npix = stats.calc_sky(data[mask])
+        skyval, error = sky._skySampleError(data, mask, skypars)
+        assert skyval == sampled
+        assert 0 < error
+        assert abs(sampled - full) < 5 * error
+        diffs.append(sampled - full)
+        errors.append(error)
+
+    ratio = np.sqrt(np.mean(np.square(diffs)) / np.mean(np.square(errors)))
+    assert 0.5 < ratio < 2.0
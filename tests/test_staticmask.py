@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from stsci.imagestats import ImageStats
+
+from drizzlepac import staticMask
+
+
+def make_chip(kind, dtype, shape=(300, 200), seed=0):
+    """ Return a chip of sky and sources, with the pixels flagged in its DQ
+    array (bad columns, saturated and dead pixels) set to the values they
+    typically take in calibrated images.
+    """
+    rng = np.random.default_rng(seed)
+    chip = rng.normal(50.0, 8.0, shape)
+    chip[rng.random(shape) < 0.01] += rng.uniform(100.0, 5000.0)
+    if kind == 'masked':
+        chip[:, 17:20] = 0.0
+        chip[rng.random(shape) < 0.02] = 65535.0
+        chip[40:60, 100:180] = -1.0
+    elif kind == 'constant':
+        chip[:] = 3.0
+    return chip.astype(dtype)
+
+
+@pytest.mark.parametrize('kind', ['random', 'masked', 'constant'])
+@pytest.mark.parametrize('dtype', [np.float32, np.float64, np.int16])
+@pytest.mark.parametrize('block_size', [None, 1000])
+def test_chip_stats(monkeypatch, kind, dtype, block_size):
+    """ The mode, standard deviation and number of bins of the histogram of
+    `staticMask._chipStats` must be those of ``ImageStats``, however the
+    rows get split into blocks.
+    """
+    if block_size is not None:
+        monkeypatch.setattr(staticMask, '_BLOCK_SIZE', block_size)
+    chip = make_chip(kind, dtype)
+
+    stats = ImageStats(chip, nclip=3, fields='mode')
+    mode, stddev, nbins = staticMask._chipStats(chip, nclip=3)
+
+    assert nbins == len(stats.histogram)
+    assert stddev == stats.stddev
+    assert mode == stats.mode
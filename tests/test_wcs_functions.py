@@ -0,0 +1,162 @@
+import glob
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from drizzlepac import cdriz, imageObject, wcs_functions
+
+from .synthetic_data import SIP_COEFFS, make_wcs
+
+
+@pytest.fixture(autouse=True)
+def clear_pixel_maps():
+    wcs_functions.clear_pixel_maps()
+    yield
+    wcs_functions.clear_pixel_maps()
+
+
+def make_wcs_pair(i=0):
+    """ Return the WCSs of an 80x60 input image and of an output frame. """
+    input_wcs = make_wcs(80, 60, 0.05, rot=11.0 + 5.0 * i,
+                         crpix=(35.0 + i, 25.0))
+    output_wcs = make_wcs(120, 100, 0.04, rot=-10.0)
+    return input_wcs, output_wcs
+
+
+def drizzle(mapping, output_wcs):
+    """ Drizzle an 80x60 image with the given mapping. """
+    insci = np.random.default_rng(0).random((60, 80)).astype(np.float32)
+    inwht = np.ones_like(insci)
+    ny, nx = output_wcs.array_shape
+    outsci = np.zeros((ny, nx), dtype=np.float32)
+    outwht = np.zeros((ny, nx), dtype=np.float32)
+    outctx = np.zeros((ny, nx), dtype=np.int32)
+    cdriz.tdriz(insci, inwht, outsci, outwht, outctx, 1, 0, 1, 1, 60, 1.0,
+                1.0, 1.0, 'center', 1.0, 'square', 'cps', 1.0, 1.0, 'INDEF',
+                0, 0, 1, mapping)
+    return outsci, outwht
+
+
+def test_pixel_map_hit(tmp_path):
+    """ Pixel maps re-used from memory, or from their sidecar file, must be
+    the same as those computed afresh.
+    """
+    input_wcs, output_wcs = make_wcs_pair()
+    fresh = cdriz.DefaultWCSMapping(input_wcs, output_wcs, 80, 60, 10)
+    sidecar = str(tmp_path / 'input_flt_sci1_pixmap')
+
+    first = wcs_functions.get_pixel_map(input_wcs, output_wcs, 10,
+                                        sidecar=sidecar)
+    assert len(glob.glob(sidecar + '_*.npy')) == 1
+    from_memory = wcs_functions.get_pixel_map(input_wcs, output_wcs, 10,
+                                              sidecar=sidecar)
+    wcs_functions.clear_pixel_maps()
+    from_file = wcs_functions.get_pixel_map(input_wcs, output_wcs, 10,
+                                            sidecar=sidecar)
+
+    expected = drizzle(fresh, output_wcs)
+    for mapping in [first, from_memory, from_file]:
+        assert np.array_equal(mapping.table, fresh.table)
+        for arr, expected_arr in zip(drizzle(mapping, output_wcs), expected):
+            assert np.array_equal(arr, expected_arr)
+
+
+def test_pixel_map_cache_size(monkeypatch):
+    """ The least recently used pixel maps must get dropped from memory once
+    the cache grows beyond ``_PIXEL_MAP_CACHE_SIZE`` bytes, but for the one
+    just added.
+    """
+    pairs = [make_wcs_pair(i) for i in range(4)]
+    keys = [wcs_functions.pixel_map_key(i, o, 80, 60, 10) for i, o in pairs]
+    nbytes = cdriz.DefaultWCSMapping(*pairs[0], 80, 60, 10).table.nbytes
+    monkeypatch.setattr(wcs_functions, '_PIXEL_MAP_CACHE_SIZE',
+                        int(2.5 * nbytes))
+
+    for pair in pairs[:2]:
+        wcs_functions.get_pixel_map(*pair, 10)
+    # a hit makes the first one the most recently used:
+    wcs_functions.get_pixel_map(*pairs[0], 10)
+    wcs_functions.get_pixel_map(*pairs[2], 10)
+    assert list(wcs_functions._pixel_maps) == [keys[0], keys[2]]
+
+    monkeypatch.setattr(wcs_functions, '_PIXEL_MAP_CACHE_SIZE', 0)
+    wcs_functions.get_pixel_map(*pairs[3], 10)
+    assert list(wcs_functions._pixel_maps) == [keys[3]]
+
+
+def test_clean_removes_sidecars(tmp_path):
+    """ `imageObject.clean` must remove the sidecar files of the pixel maps
+    of all the chips, and only those.
+    """
+    chips = []
+    for i, pair in enumerate(make_wcs_pair(i) for i in range(2)):
+        sidecar = str(tmp_path / 'input_flt_sci{:d}_pixmap'.format(i + 1))
+        wcs_functions.get_pixel_map(*pair, 10, sidecar=sidecar)
+        wcs_functions.get_pixel_map(*pair, 5, sidecar=sidecar)
+        chips.append(SimpleNamespace(outputNames={'pixmap': sidecar}))
+    other = tmp_path / 'other_flt_sci1_pixmap_0123.npy'
+    np.save(str(other), np.zeros(3))
+    assert len(glob.glob(str(tmp_path / '*_pixmap_*.npy'))) == 5
+
+    img = SimpleNamespace(_filename='input_flt.fits',
+                          outputNames={'outMedian': None},
+                          returnAllChips=lambda extname=None: chips)
+    imageObject.baseImageObject.clean(img)
+
+    assert glob.glob(str(tmp_path / '*.npy')) == [str(other)]
+    assert os.path.exists(str(other))
+
+
+def distorted_map_errors(mapping, input_wcs, output_wcs):
+    """ Return the distances between the positions given by ``mapping`` and
+    the exact ones, at the centers and corners of all input pixels.
+    """
+    nx, ny = input_wcs.pixel_shape
+    y, x = np.mgrid[0.5:ny + 1:0.5, 0.5:nx + 1:0.5]
+    x = x.ravel()
+    y = y.ravel()
+    xexact, yexact = output_wcs.wcs_world2pix(
+        *input_wcs.all_pix2world(x, y, 1), 1)
+    xout, yout = mapping(x, y)
+    return np.hypot(xout - xexact, yout - yexact)
+
+
+@pytest.mark.parametrize('stepsize', [10, 50])
+@pytest.mark.parametrize('max_error', [0.1, 0.01, 0.001])
+def test_adaptive_pixel_map(stepsize, max_error):
+    """ Adaptive pixel maps must stay within ``max_error`` output pixels of
+    the exact mapping of a distorted WCS, refining only some of the cells
+    of the grid when the fixed grid does not.
+    """
+    input_wcs = make_wcs(200, 150, 0.05, rot=11.0, crpix=(90.0, 70.0),
+                         sip=SIP_COEFFS)
+    output_wcs = make_wcs(300, 260, 0.05, rot=-10.0)
+    # the grid extends a cell beyond the image
+    ncells = (200 // stepsize + 1) * (150 // stepsize + 1)
+
+    fixed = wcs_functions.get_pixel_map(input_wcs, output_wcs, stepsize)
+    adaptive = wcs_functions.get_pixel_map(input_wcs, output_wcs, stepsize,
+                                           max_error=max_error)
+
+    errors = distorted_map_errors(adaptive, input_wcs, output_wcs)
+    assert errors.max() <= max_error
+    assert adaptive.achieved_error <= max_error
+    if distorted_map_errors(fixed, input_wcs, output_wcs).max() > max_error:
+        assert 0 < adaptive.nrefined <= ncells
+    else:
+        assert adaptive.nrefined == 0
+    # adaptive pixel maps get re-used from memory:
+    assert wcs_functions.get_pixel_map(input_wcs, output_wcs, stepsize,
+                                       max_error=max_error) is adaptive
+
+
+def test_exact_pixel_map():
+    """ With a ``max_error`` of 0, the mapping must be the exact one. """
+    input_wcs = make_wcs(200, 150, 0.05, rot=11.0, crpix=(90.0, 70.0),
+                         sip=SIP_COEFFS)
+    output_wcs = make_wcs(300, 260, 0.05, rot=-10.0)
+    mapping = wcs_functions.get_pixel_map(input_wcs, output_wcs, 10,
+                                          max_error=0)
+    assert np.all(distorted_map_errors(mapping, input_wcs, output_wcs) == 0)